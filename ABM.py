@@ -1,5 +1,6 @@
 
 
+import heapq
 import numpy as np
 import numpy.ma as ma
 import matplotlib.pyplot as plt
@@ -8,6 +9,11 @@ import datetime as dt
 import matplotlib as mpl
 
 
+# targets of the policy actions in each block of five (move, eat, procreate), as in the GridPPM
+# of the actor-critic: down, left, stay, right, up
+POLICY_TARGETS = ((1, 0), (0, -1), (0, 0), (0, 1), (-1, 0))
+
+
 class Agent:
     """
     This class provides an object, which can have the following attributes:
@@ -130,17 +136,24 @@ class Grid:
         - TakeAction - basically, the actual simulation step. This function determines the given
           index' kintype, and acts accordingly to that with the above methods Move, Eat, Die,
           createOffspring, fr_update...
+        - TakePolicyAction - same as TakeAction, but the action was chosen by a trained policy.
+        - step - one timestep, every agent acts once. With policy rules (see policyrules.py), the
+          actions of all agents are chosen in batches at the beginning of the timestep.
         - plot - plots the whole goddamn thing. if you have a list of the numbers of prey & pred at
           each timestep (-> get_num_pred, ..), you can use them as an input list to create density
           plots over time.
     """
 
-    __slots__ = ['_width', '_height', '_maxPop', '_grid', '_preddict', '_preydict']
+    __slots__ = ['_width', '_height', '_maxPop', '_grid', '_preddict', '_preydict', '_foodres',
+                 '_rules']
 
     def __init__(self, width, height, rhoprey, rhopred, foodresPrey, foodresPred,
-                 MaxFoodReservePrey, MaxFoodReservePred, pBreedPrey, pBreedPred, pFlee):
+                 MaxFoodReservePrey, MaxFoodReservePred, pBreedPrey, pBreedPred, pFlee,
+                 rules=None):
         self._width = width
         self._height = height
+        self._foodres = (foodresPrey, foodresPred)  # of the offspring, for step
+        self._rules = rules  # a PolicyRules or None for the default rules
         self._maxPop = self._width * self._height  # maximal population
         dt = 'U' + str(len(str(uuid.uuid4())) + 1)  # datatype for array
         # initialization of empty grid and dictionaries
@@ -298,22 +311,29 @@ class Grid:
 
         if(len(possibleMoves) > 0):
             k, j = possibleMoves[np.random.choice(len(possibleMoves))]
-            agent.set_fr(agent.get_fr() - 3) # reduce foodreserve, TODO, maybe 4?
-            if(kin == "B"):
-                p = Prey(FoodReserve=foodresPrey, MaxFoodReserve=agent.get_maxfr(),
-                         pBreed=agent.get_pBreed())
-                self._grid[k,j] = p.get_ID()
-                self._preydict[p.get_ID()] = p
-
-            else:
-                p = Predator(FoodReserve=foodresPred, MaxFoodReserve=agent.get_maxfr(),
-                             pBreed=agent.get_pBreed())
-                self._grid[k,j] = p.get_ID()
-                self._preddict[p.get_ID()] = p
+            self._spawn(agent, kin, (k, j), foodresPrey, foodresPred)
 
         else:
             pass
 
+    def _spawn(self, agent, kin, index, foodresPrey, foodresPred):
+        """
+        Place an offspring of agent at the (empty) index and reduce the agent's food reserve.
+        """
+        k, j = index
+        agent.set_fr(agent.get_fr() - 3) # reduce foodreserve, TODO, maybe 4?
+        if(kin == "B"):
+            p = Prey(FoodReserve=foodresPrey, MaxFoodReserve=agent.get_maxfr(),
+                     pBreed=agent.get_pBreed())
+            self._grid[k,j] = p.get_ID()
+            self._preydict[p.get_ID()] = p
+
+        else:
+            p = Predator(FoodReserve=foodresPred, MaxFoodReserve=agent.get_maxfr(),
+                         pBreed=agent.get_pBreed())
+            self._grid[k,j] = p.get_ID()
+            self._preddict[p.get_ID()] = p
+
     def fr_update(self, agent):
         fr = agent.get_fr()
         agent.set_fr(fr + 3)  # TODO make this optional!
@@ -357,8 +377,106 @@ class Grid:
         else:
             pass  # something to do for empty grid cells?
 
-    def plot(self, densities=None, currenttimestep=None, timesteps=1000, title='', figsize=(9,12),
-             colourbar=True, ticks=False, filepath='plots/', filename='', dpi=300, fmt='png'):
+    def TakePolicyAction(self, index, action, foodresPrey, foodresPred):
+        """
+        Same as TakeAction, but the agent at index does the given action of a trained policy.
+        The actions come in blocks of five: move, eat and procreate, each with the targets of
+        POLICY_TARGETS. As in the GridPPM, preys eat on the spot or on an empty target, predators
+        try to eat the prey in the target and procreating needs an empty target and more than half
+        the maximal food reserve. Impossible actions do nothing.
+        """
+        y, x = index
+        ID = self._grid[y,x]
+        kin = ID[0]
+        agent = self._preydict[ID] if kin == "B" else self._preddict[ID]
+
+        fr = agent.get_fr()  # if food reserve is too low, the agent dies
+        if(fr -1 <= 0):
+            self.Die(index)
+            return
+
+        agent.set_fr(fr-1)  # decrease the foodreserve by 1
+        block, target = divmod(int(action), 5)
+        dy, dx = POLICY_TARGETS[target]
+        j = (y+dy+self._height)%self._height
+        i = (x+dx+self._width)%self._width
+        content = self._grid[j,i]
+        stay = (dy, dx) == (0, 0)
+
+        if(block == 0):  # move
+            if(content == ""):
+                self.Move(index, (j, i))
+
+        elif(block == 1):  # eat
+            if(kin == "B"):
+                if(stay or content == ""):
+                    self.fr_update(agent)
+                    if(not stay):
+                        self.Move(index, (j, i))
+
+            elif(len(content) and content[0] == "B"):
+                if(np.random.rand() > self._preydict[content].get_pFlee()):
+                    self.fr_update(agent)
+                    self.Die((j, i))
+                    self.Move(index, (j, i))
+
+        elif(block == 2 and content == "" and agent.get_fr() > agent.get_maxfr()//2):  # procreate
+            if(np.random.rand() <= agent.get_pBreed()):
+                self._spawn(agent, kin, (j, i), foodresPrey, foodresPred)
+
+    def _kind_and_fr(self):
+        """
+        Return the grid of kinds (-1 predator, 0 empty, 1 prey) and the grid of food reserves.
+        """
+        first = self._grid.astype('U1')  # the kin letters
+        kind = (first == "B").astype(np.int8) - (first == "J").astype(np.int8)
+        fr = np.zeros(self._grid.shape, dtype=np.float32)
+        y, x = np.nonzero(kind)
+        agents = [self._preydict.get(ID) or self._preddict[ID] for ID in self._grid[y, x]]
+        fr[y, x] = [a.get_fr() for a in agents]
+        return kind, fr
+
+    def step(self):
+        """
+        Take one timestep, every agent on the grid acts once in random order.
+        With the default rules this is the same as calling TakeAction for every agent. With
+        policy rules, the actions of the agents of the kins with a policy are chosen at the
+        beginning of the timestep, from the neighbourhoods at that time, in batches. An agent
+        that was eaten before its turn doesn't act, and neither do the offspring born during the
+        timestep.
+        """
+        foodresPrey, foodresPred = self._foodres
+        _y, _x = np.where(self._grid != '')  # indices of agents
+        if(self._rules is None):
+            idc = np.array([_y, _x]).T
+            np.random.shuffle(idc)  # shuffle the indices
+            for j, i in idc:
+                self.TakeAction([j, i], foodresPrey, foodresPred)
+            return
+
+        IDs = self._grid[_y, _x]
+        actions = np.full(len(IDs), -1, dtype=np.int64)  # -1: default rules
+        kind, fr = self._kind_and_fr()
+        for kin in self._rules.kins:
+            sel = np.nonzero(kind[_y, _x] == (1 if kin == "B" else -1))[0]
+            if(len(sel)):
+                actions[sel] = self._rules.actions(kin, kind, fr, (_y[sel], _x[sel]))
+
+        # agents only move in their own turn, so an agent that isn't at its place anymore was eaten
+        for n in np.random.permutation(len(IDs)):
+            if(self._grid[_y[n], _x[n]] != IDs[n]):
+                continue
+
+            if(actions[n] < 0):
+                self.TakeAction([_y[n], _x[n]], foodresPrey, foodresPred)
+
+            else:
+                self.TakePolicyAction((_y[n], _x[n]), actions[n], foodresPrey, foodresPred)
+
+    def _plotarr(self):
+        """
+        Return an array of the grid with 1 for preys, -1 for predators and 0 for empty cells.
+        """
         # the code below assumes, that self._grid is a numpy array of strings.
         plotarr = np.zeros(shape=(self._height, self._width))
 
@@ -371,6 +489,12 @@ class Grid:
             else:
                 plotarr[j,i] = -1
 
+        return plotarr
+
+    def plot(self, densities=None, currenttimestep=None, timesteps=1000, title='', figsize=(9,12),
+             colourbar=True, ticks=False, filepath='plots/', filename='', dpi=300, fmt='png'):
+        plotarr = self._plotarr()
+
         if(densities):
             densities = list(densities)  # ensure type
 
@@ -432,7 +556,7 @@ class Grid:
             ax.set_xticks([])
             ax.set_yticks([])
 
-        info = " Prey: " + str(len(self._preydict)) + ", Pred: " + str(len(self._preddict))
+        info = " Prey: " + str(self.get_num_prey()) + ", Pred: " + str(self.get_num_pred())
 
         if(len(title)):
             title = title + info
@@ -451,3 +575,620 @@ class Grid:
 
     def timestamp(self):
         return str(dt.datetime.now())
+
+
+class EventGrid(Grid):
+    """
+    This class provides an event driven engine for the same model as Grid.
+    Instead of updating every agent in every step, it keeps the following:
+        - food reserves are computed lazily from the value at the last update and the number of
+          steps since then. Without eating or breeding, a prey gains 2 (-1 +3) per step up to its
+          maximum and a predator loses 1 per step.
+        - starvation of predators and breeding attempts are events in priority queues. A
+          predator starves at a known step, unless it eats before. Since an agent tries to breed
+          with pBreed in every step its food reserve is above half the maximum, the next attempt
+          is drawn from a geometric distribution. Events that became outdated (e.g. by eating)
+          are skipped when they come up.
+        - counts of the occupied cells and the preys in every 9-neighbourhood, such that agents
+          which can't move and predators without preys around are skipped without looking at
+          their neighbourhood.
+        - agents that are alone in their 5x5 neighbourhood and have no breeding attempt in the
+          step can't interact with anyone in it: whatever the others do, all the cells around them
+          stay empty until they act. They take their random step all at once, with array
+          operations, and only the remaining agents act one after the other in random order.
+    Every agent acts at most once per step (like in StripedGrid), while in Grid an agent that
+    moves onto a cell that comes later in the order acts (and eats) again. Together with the
+    starving agents being removed at the beginning of the step, the dynamics are close to those
+    of Grid, but not the same step by step.
+
+    It provides the following methods in addition to Grid:
+        - step - simulate a single timestep
+        - get_fr - the current food reserve of the agent with the given ID
+        - get_clock - the number of simulated timesteps
+    """
+
+    __slots__ = ['_width', '_height', '_maxPop', '_grid', '_preddict', '_preydict', '_kind',
+                 '_nOcc', '_nPrey', '_pos', '_stamp', '_version', '_starving', '_breeding',
+                 '_due', '_clock', '_seq', '_nbhIdx', '_acted',
+                 '_foodresPrey', '_foodresPred']
+
+    # offsets of the 9-neighbourhood, in the same order as get_Nbh
+    DELTAS = [(dy, dx) for dy in (-1, 0, 1) for dx in (-1, 0, 1)]
+
+    def __init__(self, width, height, rhoprey, rhopred, foodresPrey, foodresPred,
+                 MaxFoodReservePrey, MaxFoodReservePred, pBreedPrey, pBreedPred, pFlee):
+        super().__init__(width, height, rhoprey, rhopred, foodresPrey, foodresPred,
+                         MaxFoodReservePrey, MaxFoodReservePred, pBreedPrey, pBreedPred, pFlee)
+        self._foodresPrey = foodresPrey
+        self._foodresPred = foodresPred
+        self._clock = 0
+        self._seq = 0  # tie breaker for events at the same step
+        self._starving = []  # heaps of (step, seq, ID, version)
+        self._breeding = []
+        self._stamp = dict()  # ID -> (food reserve at the beginning of step, step)
+        self._version = dict()  # ID -> [starve version, breed version]
+        self._pos = dict()  # ID -> (y, x)
+        self._due = set()  # IDs with a breeding attempt in the current step
+        self._kind = np.zeros((self._height, self._width), dtype=np.int8)  # 1 prey, -1 predator
+        self._nOcc = np.zeros((self._height, self._width), dtype=np.int8)
+        self._nPrey = np.zeros((self._height, self._width), dtype=np.int8)
+        self._acted = np.zeros((self._height, self._width), dtype=np.int32)  # last step + 1
+        # index arrays of the 9-neighbourhood of every cell, computed once
+        dy, dx = np.array(self.DELTAS).T
+        self._nbhIdx = [[((y + dy) % self._height, (x + dx) % self._width)
+                         for x in range(self._width)] for y in range(self._height)]
+
+        _y, _x = np.where(self._grid != '')
+        for j, i in zip(_y, _x):
+            ID = self._grid[j, i]
+            self._place((j, i), ID)
+            self._stamp[ID] = (self._get_agent(ID).get_fr(), 0)
+            self._version[ID] = [0, 0]
+            self._schedule(ID)
+
+    def get_clock(self):
+        """
+        getter function for the number of simulated timesteps.
+        """
+        return self._clock
+
+    def _get_agent(self, ID):
+        """
+        Return the agent object of the given ID.
+        """
+        return self._preydict[ID] if ID[0] == "B" else self._preddict[ID]
+
+    def get_fr(self, ID, t=None):
+        """
+        Return the food reserve of the agent with the given ID at the beginning of step t
+        (default: the current step).
+        """
+        t = self._clock if t is None else t
+        fr, t0 = self._stamp[ID]
+        if ID[0] == "B":
+            return min(fr + 2 * (t - t0), self._preydict[ID].get_maxfr())
+
+        return fr - (t - t0)
+
+    def _restamp(self, ID, fr, t):
+        """
+        Set the food reserve of ID at the beginning of step t.
+        """
+        self._stamp[ID] = (fr, t)
+        self._get_agent(ID).set_fr(fr)  # keep the agent object roughly up to date
+
+    # neighbourhood bookkeeping ------------------------------------------------------------------
+    def _place(self, index, ID):
+        """
+        Put ID on the (empty) cell index and update the neighbourhood counts.
+        """
+        self._grid[index] = ID
+        self._pos[ID] = index
+        prey = ID[0] == "B"
+        self._kind[index] = 1 if prey else -1
+        nbh = self._nbhIdx[index[0]][index[1]]
+        self._nOcc[nbh] += 1
+        if prey:
+            self._nPrey[nbh] += 1
+
+    def _clear(self, index):
+        """
+        Empty the cell index and update the neighbourhood counts.
+        """
+        prey = self._kind[index] == 1
+        self._grid[index] = ""
+        self._kind[index] = 0
+        nbh = self._nbhIdx[index[0]][index[1]]
+        self._nOcc[nbh] -= 1
+        if prey:
+            self._nPrey[nbh] -= 1
+
+    def _empty_nbh(self, index):
+        """
+        Return the empty cells of the neighbourhood of index.
+        """
+        ys, xs = self._nbhIdx[index[0]][index[1]]
+        empty = self._kind[ys, xs] == 0
+        return list(zip(ys[empty], xs[empty]))
+
+    # events -------------------------------------------------------------------------------------
+    def _push(self, t, event, ID):
+        """
+        Add an event for ID at step t, with the current version of that event type.
+        """
+        self._seq += 1
+        if event == "starve":
+            heapq.heappush(self._starving, (t, self._seq, ID, self._version[ID][0]))
+        else:
+            heapq.heappush(self._breeding, (t, self._seq, ID, self._version[ID][1]))
+
+    def _pop(self, event):
+        """
+        Yield the IDs of the valid events of the given type up to the current step.
+        """
+        k, heap = (0, self._starving) if event == "starve" else (1, self._breeding)
+        while len(heap) and heap[0][0] <= self._clock:
+            _, _, ID, version = heapq.heappop(heap)
+            versions = self._version.get(ID)
+            if versions is not None and versions[k] == version:  # else outdated or dead
+                yield ID
+
+    def _invalidate(self, ID, event):
+        """
+        Make the pending events of that type for ID outdated.
+        """
+        self._version[ID][0 if event == "starve" else 1] += 1
+
+    def _breeding_from(self, ID, t):
+        """
+        Return the first step >= t at which ID is allowed to breed, None if never (without eating).
+        An agent may breed in step t, if its food reserve after step t is above half its maximum.
+        """
+        threshold = self._get_agent(ID).get_maxfr() // 2
+        if ID[0] == "B":
+            fr, t0 = self._stamp[ID]
+            maxfr = self._preydict[ID].get_maxfr()
+            if min(fr + 2 * (t + 1 - t0), maxfr) > threshold:
+                return t
+            if maxfr <= threshold:
+                return None
+            # fr + 2 * (s + 1 - t0) > threshold
+            return max(t, t0 - 1 + (threshold - fr) // 2 + 1)
+
+        return t if self.get_fr(ID, t + 1) > threshold else None
+
+    def _schedule(self, ID, t=None):
+        """
+        Schedule the starvation (predators) and the next breeding attempt of ID from step t on and
+        return the step of that attempt (None if there is none).
+        """
+        t = self._clock if t is None else t
+        self._invalidate(ID, "starve")
+        fr, t0 = self._stamp[ID]
+        if ID[0] == "J":
+            # the predator dies in the step it enters with a food reserve <= 1
+            self._push(max(t, t0 + int(np.ceil(fr - 1))), "starve", ID)
+
+        elif fr <= 1:  # preys only gain food, unless they start with too little
+            self._push(max(t, t0), "starve", ID)
+
+        self._invalidate(ID, "breed")
+        start = self._breeding_from(ID, t)
+        if start is not None:
+            pBreed = self._get_agent(ID).get_pBreed()
+            if pBreed > 0:
+                start += np.random.geometric(pBreed) - 1
+                self._push(start, "breed", ID)
+                return start
+
+        return None
+
+    def _breed(self, ID, index):
+        """
+        Let ID, which acts from the cell index, breed in the current step if it is still allowed
+        to (predators might have lost food) and there is an empty cell around index.
+        """
+        t = self._clock
+        self._due.discard(ID)
+        if self._breeding_from(ID, t) == t:
+            empties = self._empty_nbh(index)
+            if len(empties):
+                agent = self._get_agent(ID)
+                self._restamp(ID, self.get_fr(ID, t + 1) - 3, t + 1)
+                cell = empties[np.random.randint(len(empties))]
+                if ID[0] == "B":
+                    p = Prey(FoodReserve=self._foodresPrey, MaxFoodReserve=agent.get_maxfr(),
+                             pBreed=agent.get_pBreed())
+                    self._preydict[p.get_ID()] = p
+                    frNew = self._foodresPrey
+
+                else:
+                    p = Predator(FoodReserve=self._foodresPred, MaxFoodReserve=agent.get_maxfr(),
+                                 pBreed=agent.get_pBreed())
+                    self._preddict[p.get_ID()] = p
+                    frNew = self._foodresPred
+
+                newID = p.get_ID()
+                self._place(cell, newID)
+                self._acted[cell] = t + 1  # newborns act from the next step on
+                self._stamp[newID] = (frNew, t + 1)
+                self._version[newID] = [0, 0]
+                self._schedule(newID, t + 1)
+
+        self._schedule(ID, t + 1)
+
+    def _walk_isolated(self):
+        """
+        Let the agents that are alone in their 5x5 neighbourhood and have no breeding attempt in
+        this step move to a random cell around them, all at once. Their 9-neighbourhoods are
+        disjoint and no other agent can enter them in this step, so the order doesn't matter.
+        Preys only gain food and predators can't eat here, which the lazy food reserves cover.
+        """
+        occ = (self._kind != 0).astype(np.int8)
+        rows = sum(np.roll(occ, d, axis=0) for d in range(-2, 3))
+        box = sum(np.roll(rows, d, axis=1) for d in range(-2, 3))  # grids < 5 never qualify
+        ys, xs = np.nonzero((box == 1) & (occ == 1))
+        IDs = self._grid[ys, xs]
+        if len(self._due) and len(IDs):
+            keep = ~np.isin(IDs, list(self._due))
+            ys, xs, IDs = ys[keep], xs[keep], IDs[keep]
+        if not len(IDs):
+            return
+
+        steps = np.array([d for d in self.DELTAS if d != (0, 0)])
+        dy, dx = steps[np.random.randint(len(steps), size=len(IDs))].T
+        ny, nx = (ys + dy) % self._height, (xs + dx) % self._width
+
+        kind = self._kind[ys, xs]
+        prey = kind == 1
+        for oy, ox in self.DELTAS:  # the neighbourhoods of different agents don't overlap
+            self._nOcc[(ys + oy) % self._height, (xs + ox) % self._width] -= 1
+            self._nOcc[(ny + oy) % self._height, (nx + ox) % self._width] += 1
+            self._nPrey[(ys[prey] + oy) % self._height, (xs[prey] + ox) % self._width] -= 1
+            self._nPrey[(ny[prey] + oy) % self._height, (nx[prey] + ox) % self._width] += 1
+
+        self._grid[ys, xs] = ""
+        self._grid[ny, nx] = IDs
+        self._kind[ys, xs] = 0
+        self._kind[ny, nx] = kind
+        self._acted[ny, nx] = self._clock + 1
+        self._pos.update(zip(IDs.tolist(), zip(ny.tolist(), nx.tolist())))
+
+    # overwritten methods of Grid ----------------------------------------------------------------
+    def Die(self, index):
+        """
+        Remove the agent at index from the grid, the dictionaries and the bookkeeping.
+        """
+        ID = self._grid[index]
+        self._clear(index)
+        if ID[0] == "B":
+            del self._preydict[ID]
+        else:
+            del self._preddict[ID]
+        del self._pos[ID], self._stamp[ID], self._version[ID]  # pending events become invalid
+        self._due.discard(ID)
+
+    def Move(self, index, direction=None):
+        """
+        Move the agent at index to direction, or to a random empty cell of its neighbourhood.
+        """
+        if direction is None:
+            if self._nOcc[index] >= 9:  # nowhere to go, skip the neighbourhood
+                return
+            empties = self._empty_nbh(index)
+            direction = empties[np.random.randint(len(empties))]
+
+        ID = self._grid[index]
+        self._clear(index)
+        self._place(tuple(direction), ID)
+
+    def Eat(self, index, ID):
+        """
+        Try to eat a random prey of the neighbourhood, otherwise move.
+        """
+        if self._nPrey[index] == 0:  # no prey around, skip the neighbourhood
+            self.Move(index)
+            return
+
+        ys, xs = self._nbhIdx[index[0]][index[1]]
+        prey = self._kind[ys, xs] == 1
+        preys = list(zip(ys[prey], xs[prey]))
+        roll = np.random.rand()
+        food = preys[np.random.randint(len(preys))]
+        if roll > self._preydict[self._grid[food]].get_pFlee():
+            t = self._clock
+            maxfr = self._preddict[ID].get_maxfr()
+            self._restamp(ID, min(self.get_fr(ID, t) - 1 + 3, maxfr), t + 1)
+            self.Die(food)
+            self.Move(index, food)
+            if self._schedule(ID, t) == t:  # may already breed in this step
+                self._due.add(ID)
+
+    def TakeAction(self, index, foodresPrey=None, foodresPred=None):
+        """
+        Let the agent at index act like in Grid: preys breed and move, predators eat (or move)
+        and breed. Food reserve and starvation are handled by the events, only agents with a
+        breeding attempt in this step try to breed. Agents act at most once per step.
+        """
+        kind = self._kind[index]
+        if kind == 0 or self._acted[index] > self._clock:
+            return
+
+        ID = self._grid[index]
+        if kind == 1:
+            if ID in self._due:
+                self._breed(ID, index)
+            self.Move(index)
+
+        else:
+            self.Eat(index, ID)
+            if ID in self._due:
+                self._breed(ID, index)  # around the cell it started from, like in Grid
+
+        self._acted[self._pos[ID]] = self._clock + 1
+
+    def step(self):
+        """
+        Simulate a single timestep: the starving agents die, the isolated agents take their random
+        step at once, then every other agent acts in random order.
+        """
+        for ID in self._pop("starve"):
+            self.Die(self._pos[ID])
+
+        self._due = set(self._pop("breed"))
+        self._walk_isolated()
+
+        _y, _x = np.where((self._kind != 0) & (self._acted <= self._clock))  # indices of agents
+        idc = np.array([_y, _x]).T
+        np.random.shuffle(idc)  # shuffle the indices
+        for j, i in idc:
+            self.TakeAction((j, i))
+
+        self._clock += 1
+
+
+def _stripe_phase(kind, fr, acted, rows, t, params, rng):
+    """
+    Let every agent on the given rows act once, in random order, like Grid.TakeAction.
+    kind, fr and acted are the shared planes; acted holds the step + 1 an agent last acted in, such
+    that agents which moved onto a later cell (or were just born) don't act twice.
+    """
+    height, width = kind.shape
+    maxPrey, maxPred, pBreedPrey, pBreedPred, pFlee, frPrey, frPred = params
+    _y, _x = np.nonzero(kind[rows[0]:rows[1]])
+    idc = np.array([_y + rows[0], _x]).T
+    rng.shuffle(idc)
+
+    def nbh(y, x):
+        return [((y + dy) % height, (x + dx) % width) for dy in (-1, 0, 1) for dx in (-1, 0, 1)]
+
+    def offspring(y, x, k, f):
+        # place an offspring of kind k on a random empty cell around (y, x), return if succesful
+        empties = [n for n in nbh(y, x) if kind[n] == 0]
+        if len(empties):
+            n = empties[rng.randint(len(empties))]
+            kind[n], fr[n], acted[n] = k, f, t + 1
+            return True
+        return False
+
+    for y, x in idc:
+        k = kind[y, x]
+        if k == 0 or acted[y, x] == t + 1:
+            continue
+
+        f = fr[y, x] - 1
+        if f <= 0:  # starvation
+            kind[y, x] = 0
+            continue
+
+        acted[y, x] = t + 1
+        if k == 1:
+            f = min(f + 3, maxPrey)
+            if f > maxPrey // 2 and rng.rand() <= pBreedPrey:
+                if offspring(y, x, 1, frPrey):
+                    f -= 3
+
+            fr[y, x] = f
+            empties = [n for n in nbh(y, x) if kind[n] == 0]
+            if len(empties):
+                n = empties[rng.randint(len(empties))]
+                kind[n], fr[n], acted[n] = 1, f, t + 1
+                kind[y, x] = 0
+
+        else:
+            cells = nbh(y, x)
+            preys = [n for n in cells if kind[n] == 1]
+            here = (y, x)
+            if len(preys):
+                roll = rng.rand()
+                food = preys[rng.randint(len(preys))]
+                if roll > pFlee:
+                    f = min(f + 3, maxPred)
+                    kind[y, x] = 0
+                    here = food
+
+            else:
+                empties = [n for n in cells if kind[n] == 0]
+                if len(empties):
+                    here = empties[rng.randint(len(empties))]
+                    kind[y, x] = 0
+
+            kind[here], acted[here] = -1, t + 1
+            if f > maxPred // 2 and rng.rand() <= pBreedPred:
+                if offspring(y, x, -1, frPred):  # around the cell it started from, like in Grid
+                    f -= 3
+
+            fr[here] = f
+
+
+def _stripe_worker(names, shape, stripe, params, seed, barrier, conn):
+    """
+    Process owning the rows stripe = (start, stop) of the shared planes. Every step is done in two
+    phases, separated by a barrier: one half of the stripe acts, then the other. The upper half
+    goes first in even steps and the lower half in odd ones, such that neither half is favoured.
+    An agent only reaches one row beyond the rows it is on, thus as long as every half has at least
+    2 rows, no two processes ever touch the same cell in the same phase.
+    """
+    from multiprocessing import shared_memory
+    shms = [shared_memory.SharedMemory(name=n) for n in names]
+    kind, fr, acted = [np.ndarray(shape, dtype=dt, buffer=shm.buf)
+                       for shm, dt in zip(shms, (np.int8, np.int8, np.int32))]
+    rng = np.random.RandomState(seed)
+    start, stop = stripe
+    middle = (start + stop) // 2
+
+    try:
+        while True:
+            t = conn.recv()
+            if t is None:
+                break
+
+            halves = [(start, middle), (middle, stop)]
+            if t % 2:
+                halves.reverse()
+            _stripe_phase(kind, fr, acted, halves[0], t, params, rng)
+            barrier.wait()
+            _stripe_phase(kind, fr, acted, halves[1], t, params, rng)
+            conn.send(t)
+
+    finally:
+        del kind, fr, acted
+        for shm in shms:
+            shm.close()
+
+
+class StripedGrid(Grid):
+    """
+    This class provides the same model as Grid for very large grids, simulated by several
+    processes. Instead of agent objects, the state is kept in planes in shared memory:
+        - kind - 1 for preys, -1 for predators and 0 for empty cells
+        - fr - the food reserve of the agent on a cell
+        - acted - the step (+1) in which the agent on a cell acted last
+    The torus is split into horizontal stripes of at least 4 rows, each owned by a worker process.
+    Within a step, first one half of every stripe acts, then, after a barrier, the other half; the
+    upper halves go first in even steps, the lower ones in odd steps. Agents may move, eat and
+    breed across the stripe borders, since the rows next to an active half always belong to a half
+    that is idle in that phase. The agents of a half act in random order. Unlike in Grid, where an
+    agent that moves onto a cell later in the order acts again, every agent acts at most once per
+    step (see acted) and newborns only from the next step on. So the dynamics are close to those of
+    Grid, but not the same.
+
+    It provides the following methods in addition to Grid:
+        - step - simulate a single timestep
+        - close - stop the workers and free the shared memory (also done on exit of a with block)
+    get_grid returns a copy of the kind plane.
+    """
+
+    __slots__ = ['_width', '_height', '_maxPop', '_shms', '_kind', '_fr', '_acted', '_clock',
+                 '_workers', '_conns']
+
+    def __init__(self, width, height, rhoprey, rhopred, foodresPrey, foodresPred,
+                 MaxFoodReservePrey, MaxFoodReservePred, pBreedPrey, pBreedPred, pFlee,
+                 workers=None):
+        import multiprocessing as mp
+        from multiprocessing import shared_memory
+
+        self._width = width
+        self._height = height
+        self._maxPop = self._width * self._height  # maximal population
+        self._clock = 0
+        self._workers = []
+        self._conns = []
+
+        shape = (self._height, self._width)
+        self._shms = [shared_memory.SharedMemory(create=True,
+                                                 size=self._maxPop * np.dtype(dt).itemsize)
+                      for dt in (np.int8, np.int8, np.int32)]
+        self._kind, self._fr, self._acted = [np.ndarray(shape, dtype=dt, buffer=shm.buf)
+                                             for shm, dt in zip(self._shms,
+                                                                (np.int8, np.int8, np.int32))]
+        self._kind[:] = 0
+        self._fr[:] = 0
+        self._acted[:] = 0
+
+        # populate, like Grid
+        Nprey = int(rhoprey * self._maxPop)  # number of prey
+        Npred = int(rhopred * self._maxPop)  # number of pred
+        idx = np.arange(self._maxPop)
+        np.random.shuffle(idx)
+        kind, fr = self._kind.reshape(-1), self._fr.reshape(-1)
+        kind[idx[:Nprey]], fr[idx[:Nprey]] = 1, foodresPrey
+        kind[idx[Nprey:Nprey+Npred]], fr[idx[Nprey:Nprey+Npred]] = -1, foodresPred
+
+        # stripes of at least 4 rows
+        if workers is None:
+            workers = mp.cpu_count()
+        n = max(1, min(workers, self._height // 4))
+        bounds = np.linspace(0, self._height, n + 1).astype(int)
+
+        params = (MaxFoodReservePrey, MaxFoodReservePred, pBreedPrey, pBreedPred, pFlee,
+                  foodresPrey, foodresPred)
+        names = [shm.name for shm in self._shms]
+        barrier = mp.Barrier(n)
+        for start, stop in zip(bounds[:-1], bounds[1:]):
+            parent, child = mp.Pipe()
+            w = mp.Process(target=_stripe_worker, daemon=True,
+                           args=(names, shape, (start, stop), params,
+                                 np.random.randint(2**31), barrier, child))
+            w.start()
+            self._workers.append(w)
+            self._conns.append(parent)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def get_grid(self):
+        """
+        getter function for a copy of the kind plane.
+        """
+        return self._kind.copy()
+
+    def get_num_prey(self):
+        """
+        getter function for the number of preys.
+        """
+        return int(np.count_nonzero(self._kind == 1))
+
+    def get_num_pred(self):
+        """
+        getter function for number of preds.
+        """
+        return int(np.count_nonzero(self._kind == -1))
+
+    def get_clock(self):
+        """
+        getter function for the number of simulated timesteps.
+        """
+        return self._clock
+
+    def _plotarr(self):
+        return self._kind.astype(float)
+
+    def step(self):
+        """
+        Simulate a single timestep on all stripes and wait for the workers to finish it.
+        """
+        for conn in self._conns:
+            conn.send(self._clock)
+        for conn in self._conns:
+            conn.recv()
+        self._clock += 1
+
+    def close(self):
+        """
+        Stop the workers and free the shared memory.
+        """
+        for conn, w in zip(self._conns, self._workers):
+            conn.send(None)
+            w.join()
+        self._conns, self._workers = [], []
+
+        if self._shms:
+            del self._kind, self._fr, self._acted
+            for shm in self._shms:
+                shm.close()
+                shm.unlink()
+            self._shms = []
@@ -1,6 +1,8 @@
 """This file provides the functionality for the actor critic neural network."""
 
+import copy
 import warnings
+from collections import OrderedDict
 
 import numpy as np
 from collections import namedtuple, deque
@@ -12,6 +14,9 @@ import torch.nn.functional as F
 from torch.autograd import Variable
 from torch.distributions import Categorical
 
+from checkpoint import atomic_save
+from packing import PackedStates
+
 
 # set mode for the actor_critic
 def init(*, mode: str='cpu', goal: str="training", policy_kind: str="fc"):
@@ -49,8 +54,10 @@ def init(*, mode: str='cpu', goal: str="training", policy_kind: str="fc"):
     dtype = torch.cuda.FloatTensor if use_cuda else torch.FloatTensor
 
 
-# instance of namedtuple to be used in policy
-SavedAction = namedtuple('SavedAction', ['log_prob', 'value', 'action_nr'])
+# instance of namedtuple to be used in policy, mask holds the valid actions
+# as bits of an int if the actions were masked
+SavedAction = namedtuple('SavedAction', ['log_prob', 'value', 'action_nr', 'mask'],
+                         defaults=(None,))
 
 
 class ConvPolicy(nn.Module):
@@ -75,8 +82,8 @@ class ConvPolicy(nn.Module):
         self.action_head = nn.Linear(*action_head)
         self.value_head = nn.Linear(*value_head)
 
-    def forward(self, input_data: tuple) -> tuple:
-        """Forward the given input image."""
+    def features(self, input_data: tuple) -> torch.Tensor:
+        """Return the (batch, features) output of the last hidden layer."""
         image, add_info = input_data  # we assume this structure
 
         # propagation through first layer
@@ -85,13 +92,21 @@ class ConvPolicy(nn.Module):
 
         # flattening the outputs and concatenating to  a single tensor
         process = process.view(process.size(0), -1)  # flatten the tensor
-        add_info = add_info.view(add_info.size(0), -1)  # flatten
-        process = torch.cat([process[0], add_info[0]], -1)  # concatenate layers
+        add_info = add_info.view(process.size(0), -1)  # flatten
+        process = torch.cat([process, add_info], -1)  # concatenate layers
 
         # further propagation
         process = F.relu(self.hidden1(process))
         process = F.relu(self.hidden2(process))
-        process = F.relu(self.hidden3(process))
+        return F.relu(self.hidden3(process))
+
+    def forward(self, input_data: tuple) -> tuple:
+        """Forward the given input image.
+
+        The outputs always keep the batch dimension, also for a single state,
+        such that a traced copy works for any batch size.
+        """
+        process = self.features(input_data)
         action_scores = self.action_head(process)
         state_value = self.value_head(process)
 
@@ -136,12 +151,16 @@ class Policy(nn.Module):
         self.value_head = nn.Linear(*value_head)
 
     # methods -----------------------------------------------------------------
-    def forward(self, input_vector: torch.Tensor) -> tuple:
-        """Forward the given input_vector through the layers and return the two outputs."""
+    def features(self, input_vector: torch.Tensor) -> torch.Tensor:
+        """Return the output of the last hidden layer."""
         input_vector = F.relu(self.affine1(input_vector))  # Layer 1
         input_vector = F.relu(self.affine2(input_vector))  # Layer 2
         input_vector = F.relu(self.affine3(input_vector))  # Layer 3
-        input_vector = F.relu(self.affine4(input_vector))  # Layer 4
+        return F.relu(self.affine4(input_vector))  # Layer 4
+
+    def forward(self, input_vector: torch.Tensor) -> tuple:
+        """Forward the given input_vector through the layers and return the two outputs."""
+        input_vector = self.features(input_vector)
         action_scores = self.action_head(input_vector)  # action layer
         state_value = self.value_head(input_vector)  # state value layer
 
@@ -149,11 +168,722 @@ class Policy(nn.Module):
         return F.softmax(action_scores, dim=-1), state_value
 
 
+class MultiHeadPolicy(nn.Module):
+    """A policy with a shared trunk and one action and value head per kin.
+
+    The trunk is a ConvPolicy (if conv1 is given) or a Policy without their
+    heads. The kin is given as index into kins. `for_kin` returns a view
+    with the usual single policy interface, which can be used in the policy
+    dict of env.step.
+    """
+
+    # slots -------------------------------------------------------------------
+    __slots__ = ['trunk', 'action_heads', 'value_heads']  # kins is copied along
+
+    # init --------------------------------------------------------------------
+    def __init__(self, *, kins: tuple, action_head: tuple, value_head: tuple,
+                 **layers):
+        """Initialise the trunk and the heads."""
+        super(MultiHeadPolicy, self).__init__()
+
+        self.kins = tuple(kins)
+        trunk = ConvPolicy if 'conv1' in layers else Policy
+        self.trunk = trunk(action_head=action_head, value_head=value_head,
+                           **layers)
+        self.trunk.action_head = None  # replaced by the heads per kin
+        self.trunk.value_head = None
+        self.action_heads = nn.ModuleList([nn.Linear(*action_head)
+                                           for _ in self.kins])
+        self.value_heads = nn.ModuleList([nn.Linear(*value_head)
+                                          for _ in self.kins])
+
+    # methods -----------------------------------------------------------------
+    def forward(self, input_data, kin: int) -> tuple:
+        """Propagate the input through the trunk and the heads of kin."""
+        process = self.trunk.features(input_data)
+        single = process.dim() == 1  # like Policy, the batch dimension is kept
+        process = process.view(-1, process.size(-1))
+
+        action_scores = self.action_heads[kin](process)
+        state_value = self.value_heads[kin](process)
+
+        if single:  # single unbatched state
+            return F.softmax(action_scores[0], dim=-1), state_value[0]
+
+        return F.softmax(action_scores, dim=-1), state_value
+
+    def kin_index(self, kin: str) -> int:
+        """Return the index of the heads of kin."""
+        return self.kins.index(kin)
+
+    def for_kin(self, kin: str) -> nn.Module:
+        """Return a view of the policy for the given kin."""
+        return KinPolicy(model=self, kin=self.kin_index(kin))
+
+
+class KinPolicy(nn.Module):
+    """A view of a MultiHeadPolicy that always uses the heads of a single kin.
+
+    It shares every parameter with the MultiHeadPolicy.
+    """
+
+    # slots -------------------------------------------------------------------
+    __slots__ = ['model']  # kin is copied along
+
+    # init --------------------------------------------------------------------
+    def __init__(self, *, model: MultiHeadPolicy, kin: int):
+        """Initialise the view."""
+        super(KinPolicy, self).__init__()
+        self.model = model
+        self.kin = kin
+
+    # methods -----------------------------------------------------------------
+    def forward(self, input_data) -> tuple:
+        """Propagate the input through the trunk and the heads of kin."""
+        return self.model(input_data, self.kin)
+
+
+class StagingBuffer:
+    """Reusable float32 tensors that states are copied into before a forward pass.
+
+    It has the following attributes:
+        - shapes, a tuple with the shape of a single item for each input of
+            the policy, e.g. ((1, 7, 7), (2,)) for ConvPolicy or ((51,),) for
+            Policy
+        - capacity, the number of states that fit into the buffer, it grows
+            (by doubling) if more states are requested
+
+    The tensors are allocated once and filled in place through numpy views,
+    so there are no allocations per state once the buffer is large enough.
+    If CUDA is used, the host tensors are pinned and copied asynchronously
+    into preallocated device tensors.
+
+    Since the tensors are overwritten, the outputs of a forward pass must not
+    be needed for a backward pass after the next fill, i.e. the buffer is
+    meant for inference without gradients.
+    """
+
+    # slots -------------------------------------------------------------------
+    __slots__ = ['_shapes', '_capacity', '_host', '_views', '_device']
+
+    # init --------------------------------------------------------------------
+    def __init__(self, *, shapes: tuple, capacity: int=1):
+        """Initialise the buffer for the given item shapes."""
+        self._shapes = tuple(tuple(shp) for shp in shapes)
+        self._capacity = 0
+        self._host = ()
+        self._views = ()
+        self._device = ()
+        self.reserve(capacity)
+
+    # properties --------------------------------------------------------------
+    @property
+    def shapes(self) -> tuple:
+        """Return the shapes of a single item of each input."""
+        return self._shapes
+
+    @property
+    def capacity(self) -> int:
+        """Return the number of states that fit into the buffer."""
+        return self._capacity
+
+    # methods -----------------------------------------------------------------
+    def reserve(self, n: int) -> None:
+        """Make sure, that n states fit into the buffer."""
+        if n <= self._capacity:
+            return
+
+        capacity = max(n, 2 * self._capacity)
+        self._host = tuple(torch.empty((capacity,) + shp, dtype=torch.float32,
+                                       pin_memory=use_cuda)
+                           for shp in self._shapes)
+        self._views = tuple(t.numpy() for t in self._host)  # shared memory
+        if use_cuda:
+            self._device = tuple(torch.empty_like(t, device='cuda')
+                                 for t in self._host)
+        self._capacity = capacity
+
+    def fill(self, i: int, state) -> None:
+        """Copy a single state into slot i, state is a (list of) numpy array(s)."""
+        if len(self._shapes) == 1 and isinstance(state, np.ndarray):
+            state = (state,)
+
+        for view, s in zip(self._views, state):
+            view[i] = np.reshape(s, view.shape[1:])  # copies, no allocation
+
+    def fill_batch(self, *inputs: np.ndarray) -> int:
+        """Copy whole batches of states, one (N, ...) array per input, and return N."""
+        n = len(inputs[0])
+        self.reserve(n)
+        for view, inp in zip(self._views, inputs):
+            view[:n] = np.reshape(inp, (n,) + view.shape[1:])
+
+        return n
+
+    def tensors(self, n: int, host: bool=False) -> tuple:
+        """Return the first n filled states as tensors, one per input.
+
+        If host is set, the cpu tensors are returned even if CUDA is used.
+        """
+        if use_cuda and not host:
+            for h, d in zip(self._host, self._device):
+                d[:n].copy_(h[:n], non_blocking=True)
+            return tuple(d[:n] for d in self._device)
+
+        return tuple(h[:n] for h in self._host)
+
+
+# buffers for the single state inference in select_action, keyed by shapes
+_staging = {}
+
+
+def _staging_buffer(state) -> StagingBuffer:
+    """Return the StagingBuffer that fits the structure of state."""
+    if conv:
+        image, side = state
+        shapes = ((1,) + np.shape(image), np.shape(side))
+    else:
+        shapes = (np.shape(state),)
+
+    if shapes not in _staging:
+        _staging[shapes] = StagingBuffer(shapes=shapes)
+
+    return _staging[shapes]
+
+
+def set_threads(*, intra_op: int=0, inter_op: int=0) -> None:
+    """Set the number of threads torch uses within and between operations.
+
+    0 keeps the default of torch. Tiny per agent forward passes are usually
+    fastest with a single intra-op thread. The number of inter-op threads can
+    only be set once and before any parallel work, otherwise a warning is
+    issued.
+    """
+    if intra_op:
+        torch.set_num_threads(intra_op)
+
+    if inter_op:
+        try:
+            torch.set_num_interop_threads(inter_op)
+        except RuntimeError as e:
+            warnings.warn("Could not set the number of inter-op threads: {}"
+                          "".format(e), RuntimeWarning)
+
+
+def example_state(*, view: tuple, n_side: int=2):
+    """Return a zero state of the given view shape, as returned by the environment."""
+    if conv:
+        return [np.zeros(view), np.zeros(n_side)]
+
+    return np.zeros(int(np.prod(view)) + n_side)
+
+
+def export_policy(model: nn.Module, *, example, fuse: bool=True):
+    """Return a traced and frozen copy of model for inference on single states.
+
+    The copy doesn't share the parameters with model, so it has to be
+    exported again after every optimisation step. example is a state as
+    returned by the environment, see `example_state`. If fuse is set, the
+    frozen module is optimised for inference, which fuses e.g. Linear and
+    ReLU where the backend supports it.
+
+    select_action recognises the exported module and stores the states, the
+    actions and their log probabilities as float; the log probabilities and
+    values with gradients are then recomputed by the eager model in
+    finish_episode.
+    """
+    buf = _staging_buffer(example)
+    buf.fill(0, example)
+    inputs = buf.tensors(1)
+    inputs = tuple(t.clone() for t in inputs) if conv else inputs[0].clone()
+
+    model_was_training = model.training
+    model.eval()
+    with torch.no_grad():
+        traced = torch.jit.trace(model, (inputs,))
+        traced = torch.jit.freeze(traced)
+        if fuse:
+            traced = torch.jit.optimize_for_inference(traced)
+    model.train(model_was_training)
+
+    return traced
+
+
+def quantize_policy(model: nn.Module) -> nn.Module:
+    """Return a copy of model with dynamically quantised int8 Linear layers.
+
+    The copy is meant for rollouts only, like the exported policies it has to
+    be created again after every optimisation step. Convolutional layers stay
+    float32. Quantised kernels only run on the cpu.
+    """
+    quantized = torch.quantization.quantize_dynamic(copy.deepcopy(model).cpu().eval(),
+                                                    {nn.Linear},
+                                                    dtype=torch.qint8)
+    quantized.inference_only = True  # tells select_action not to track gradients
+    return quantized
+
+
+def policy_divergence(*, reference: nn.Module, candidate: nn.Module,
+                      views: np.ndarray, sides: np.ndarray) -> dict:
+    """Compare the action distributions of two policies on recorded states.
+
+    views and sides are the arrays of recorded states, e.g. of Trajectories.
+    Returns a dict with the mean and max KL divergence KL(reference ||
+    candidate), the max total variation distance and the fraction of states
+    for which the most probable action agrees.
+    """
+    n = len(views)
+    views = torch.from_numpy(np.asarray(views, dtype=np.float32))
+    sides = torch.from_numpy(np.asarray(sides, dtype=np.float32))
+    if conv:
+        inputs = (views.view(n, 1, *views.shape[1:]), sides)
+    else:
+        inputs = torch.cat([views.view(n, -1), sides], -1)
+
+    def on(model):
+        """Return the inputs on the device of model, quantised models run on the cpu."""
+        params = next(model.parameters(), None)
+        if getattr(model, 'inference_only', False) or params is None:
+            return inputs
+
+        if conv:
+            return tuple(t.to(params.device) for t in inputs)
+        return inputs.to(params.device)
+
+    with torch.no_grad():
+        p, _ = reference(on(reference))
+        q, _ = candidate(on(candidate))
+
+    p, q = p.view(n, -1).cpu(), q.view(n, -1).cpu()
+    eps = np.finfo(np.float32).eps
+    kl = (p * (torch.log(p + eps) - torch.log(q + eps))).sum(-1)
+    tv = 0.5 * (p - q).abs().sum(-1)
+    return {'mean_kl': kl.mean().item(), 'max_kl': kl.max().item(),
+            'max_tv': tv.max().item(),
+            'argmax_agreement': (p.argmax(-1) == q.argmax(-1)).float().mean().item()}
+
+
+def _sample_cdf(cdf: np.ndarray) -> np.ndarray:
+    """Draw an action from every row of cumulative probabilities (inverse CDF)."""
+    u = np.random.rand(*cdf.shape[:-1], 1).astype(cdf.dtype)
+    actions = (cdf < u).sum(-1)  # first action with cdf >= u
+    return np.minimum(actions, cdf.shape[-1] - 1)
+
+
+def _cdf_log_prob(cdf: np.ndarray, action: int) -> float:
+    """Return the log probability of action from a row of cumulative probabilities."""
+    p = cdf[action] - (cdf[action - 1] if action > 0 else 0.)
+    return float(np.log(max(p, np.finfo(np.float32).tiny)))
+
+
+def _mask_to_int(mask: np.ndarray) -> int:
+    """Return the boolean action mask as bits of an int, to keep the memories small."""
+    return int(np.asarray(mask, dtype=np.int64) @ (1 << np.arange(len(mask), dtype=np.int64)))
+
+
+def _int_to_mask(bits: list, n_actions: int) -> np.ndarray:
+    """Return the boolean masks (N, n_actions) of ints from `_mask_to_int`."""
+    bits = np.asarray(bits, dtype=np.int64)[:, None]
+    return ((bits >> np.arange(n_actions, dtype=np.int64)) & 1).astype(bool)
+
+
+def _mask_probs(probs: torch.Tensor, mask: np.ndarray) -> torch.Tensor:
+    """Return probs restricted to the actions in mask and renormalised."""
+    mask = torch.as_tensor(np.asarray(mask), device=probs.device)
+    masked = probs * mask.view(probs.shape).to(probs.dtype)
+    return masked / masked.sum(-1, keepdim=True).clamp(min=np.finfo(np.float32).tiny)
+
+
+def _mask_cdf(cdf: np.ndarray, mask: np.ndarray) -> np.ndarray:
+    """Return the cumulative probabilities restricted to the actions in mask."""
+    probs = np.diff(cdf, axis=-1, prepend=0) * mask
+    cdf = np.cumsum(probs, axis=-1)
+    return cdf / np.maximum(cdf[..., -1:], np.finfo(np.float32).tiny)
+
+
+def _probs_to_cdf(probs: torch.Tensor) -> np.ndarray:
+    """Return the cumulative probabilities of (N, A) probs as float32, ending in exactly 1."""
+    cdf = torch.cumsum(probs.double(), -1).cpu().numpy()
+    cdf /= cdf[:, -1:]
+    return cdf.astype(np.float32)
+
+
+class PolicyTable:
+    """The action probabilities of a policy for every state of a small state space.
+
+    It has the following attributes:
+        - n_cells, the number of cells of the neighbourhood, each holding -1
+            (predator), 0 (empty) or 1 (prey)
+        - max_food_reserve, the food reserve is an int between 0 and this
+
+    A state is packed into a single code, the neighbourhood as a number in
+    base 3 times (max_food_reserve + 1) plus the food reserve. `compile`
+    propagates every state through the policy at once and keeps the
+    cumulative probabilities, thus sampling an action is a table lookup and a
+    comparison with a uniform random number (inverse CDF). The table has to
+    be compiled again after every optimisation step.
+
+    States that don't fit (e.g. a float food reserve) have no code, for
+    those select_action falls back to the network.
+    """
+
+    # slots -------------------------------------------------------------------
+    __slots__ = ['_n_cells', '_max_fr', '_powers', '_cdf']
+
+    # the largest number of states that is compiled into a table
+    MAX_STATES = 2**20
+
+    # init --------------------------------------------------------------------
+    def __init__(self, *, n_cells: int, max_food_reserve: int):
+        """Initialise an empty table for the given state space."""
+        if not self.enumerable(n_cells=n_cells,
+                               max_food_reserve=max_food_reserve):
+            raise ValueError("{} cells with a food reserve up to {} are too "
+                             "many states for a table.".format(n_cells,
+                                                               max_food_reserve))
+
+        self._n_cells = n_cells
+        self._max_fr = int(max_food_reserve)
+        self._powers = 3**np.arange(n_cells, dtype=np.int64)
+        self._cdf = None
+
+    # properties --------------------------------------------------------------
+    @property
+    def n_cells(self) -> int:
+        """Return the number of cells of the neighbourhood."""
+        return self._n_cells
+
+    @property
+    def max_food_reserve(self) -> int:
+        """Return the maximal food reserve."""
+        return self._max_fr
+
+    @property
+    def n_states(self) -> int:
+        """Return the number of states in the table."""
+        return 3**self._n_cells * (self._max_fr + 1)
+
+    @property
+    def compiled(self) -> bool:
+        """Return whether the table holds the probabilities of a policy."""
+        return self._cdf is not None
+
+    # staticmethods -----------------------------------------------------------
+    @staticmethod
+    def enumerable(*, n_cells: int, max_food_reserve) -> bool:
+        """Return whether the state space is small enough for a table."""
+        if max_food_reserve is None or max_food_reserve != int(max_food_reserve):
+            return False
+
+        return 3**n_cells * (int(max_food_reserve) + 1) <= PolicyTable.MAX_STATES
+
+    # methods -----------------------------------------------------------------
+    def states(self) -> tuple:
+        """Return the neighbourhoods (N, n_cells) and food reserves (N,) of all codes."""
+        codes = np.arange(self.n_states, dtype=np.int64)
+        nbh, fr = np.divmod(codes, self._max_fr + 1)
+        digits = (nbh[:, None] // self._powers) % 3
+        return (digits - 1).astype(np.float32), fr.astype(np.float32)
+
+    def compile(self, model, batch_size: int=65536) -> None:
+        """Evaluate model on every state and store the cumulative probabilities."""
+        nbh, fr = self.states()
+        side = int(np.sqrt(self._n_cells))
+        cdf = []
+        with torch.no_grad():
+            for start in range(0, len(fr), batch_size):
+                n = len(fr[start:start + batch_size])
+                views = torch.from_numpy(nbh[start:start + n])
+                frs = torch.from_numpy(fr[start:start + n]).view(n, 1)
+                if conv:
+                    inputs = (views.view(n, 1, side, side).type(dtype),
+                              frs.type(dtype))
+                else:
+                    inputs = torch.cat([views, frs], -1).type(dtype)
+
+                probs, _ = model(inputs)
+                cdf.append(_probs_to_cdf(probs.view(n, -1)))
+
+        self._cdf = np.concatenate(cdf)
+
+    def code(self, state) -> Optional[int]:
+        """Return the code of a state as given by the environment, None if it has none."""
+        if isinstance(state, (list, tuple)):
+            nbh, fr = np.ravel(state[0]), np.ravel(state[1])
+            fr = fr[0] if len(fr) == 1 else None
+        else:
+            nbh, fr = state[:-1], state[-1]
+
+        if (len(nbh) != self._n_cells or fr is None or fr != int(fr) or
+                not 0 <= fr <= self._max_fr):
+            return None
+
+        digits = np.asarray(nbh, dtype=np.int64) + 1
+        if digits.min() < 0 or digits.max() > 2:
+            return None
+
+        return int(digits @ self._powers) * (self._max_fr + 1) + int(fr)
+
+    def __getitem__(self, codes) -> np.ndarray:
+        """Return the cumulative probabilities of the given codes."""
+        return self._cdf[codes]
+
+    def sample(self, codes: np.ndarray) -> np.ndarray:
+        """Draw an action for each of the given codes."""
+        return _sample_cdf(self._cdf[codes])
+
+    def log_prob(self, code: int, action: int) -> float:
+        """Return the log probability of action in the state with the given code."""
+        return _cdf_log_prob(self._cdf[code], action)
+
+
+class InferenceCache:
+    """A least recently used cache of the action distributions of policies.
+
+    It has the following attributes:
+        - capacity, the maximal number of cached states, the least recently
+            used one is dropped first
+        - hits and misses, the number of states that were found in the cache
+            and that had to be propagated
+
+    The key of a state is the id of the policy and the bytes of the state,
+    the neighbourhood packed as int8 and the side information as float32,
+    thus identical states of the same policy share an entry. Within a batch
+    every distinct state is only propagated once.
+
+    The cached distributions belong to the current weights, so the cache has
+    to be cleared after every optimisation step, either by calling
+    `invalidate` or automatically by `watch`ing the optimizers. The weight
+    version counts the invalidations.
+    """
+
+    # slots -------------------------------------------------------------------
+    __slots__ = ['_capacity', '_entries', '_version', '_hits', '_misses',
+                 '_hooks']
+
+    # init --------------------------------------------------------------------
+    def __init__(self, *, capacity: int=65536):
+        """Initialise an empty cache."""
+        if not isinstance(capacity, int) or capacity < 1:
+            raise ValueError("capacity must be a positive int, but {} was "
+                             "given.".format(capacity))
+
+        self._capacity = capacity
+        self._entries = OrderedDict()  # key -> cumulative probabilities
+        self._version = 0
+        self._hits = 0
+        self._misses = 0
+        self._hooks = []
+
+    # properties --------------------------------------------------------------
+    @property
+    def capacity(self) -> int:
+        """Return the maximal number of cached states."""
+        return self._capacity
+
+    @property
+    def version(self) -> int:
+        """Return the weight version, i.e. the number of invalidations."""
+        return self._version
+
+    @property
+    def hits(self) -> int:
+        """Return the number of states found in the cache."""
+        return self._hits
+
+    @property
+    def misses(self) -> int:
+        """Return the number of states that were propagated."""
+        return self._misses
+
+    def __len__(self) -> int:
+        """Return the number of cached states."""
+        return len(self._entries)
+
+    # methods -----------------------------------------------------------------
+    def watch(self, optimizer) -> None:
+        """Invalidate the cache after every step of optimizer."""
+        self._hooks.append(optimizer.register_step_post_hook(
+            lambda *args: self.invalidate()))
+
+    def invalidate(self) -> None:
+        """Drop all entries, the weights changed."""
+        self._entries.clear()
+        self._version += 1
+
+    def reset_stats(self) -> None:
+        """Set the number of hits and misses to 0."""
+        self._hits = 0
+        self._misses = 0
+
+    @staticmethod
+    def key(model, state) -> bytes:
+        """Return the key of state (as given by the environment) for model."""
+        if isinstance(state, (list, tuple)):
+            view, side = state
+        else:
+            view, side = state[:-2], state[-2:]
+
+        prefix = "{}:".format(id(model)).encode()
+        return (prefix + np.asarray(view, dtype=np.int8).tobytes() +
+                np.asarray(side, dtype=np.float32).tobytes())
+
+    def cdfs(self, *, model, states: list) -> np.ndarray:
+        """Return the cumulative action probabilities (N, A) of model for states.
+
+        Only the distinct states that aren't cached yet are propagated, in a
+        single batch.
+        """
+        n = len(states)
+        keys = [self.key(model, s) for s in states]
+        out = [None] * n
+        missing = OrderedDict()  # key -> index of the first state with it
+        for i, k in enumerate(keys):
+            cdf = self._entries.get(k)
+            if cdf is not None:
+                self._entries.move_to_end(k)
+                out[i] = cdf
+                self._hits += 1
+            elif k not in missing:
+                missing[k] = i
+                self._misses += 1
+            else:
+                self._hits += 1  # a duplicate in the batch
+
+        if missing:
+            idx = list(missing.values())
+            new = _forward_cdfs(model=model, states=[states[i] for i in idx])
+            fresh = dict(zip(missing.keys(), new))
+            for k, cdf in fresh.items():
+                self._entries[k] = cdf
+                if len(self._entries) > self._capacity:
+                    self._entries.popitem(last=False)  # least recently used
+
+            for i, k in enumerate(keys):
+                if out[i] is None:
+                    out[i] = fresh[k]
+
+        return np.stack(out)
+
+
+def _forward_cdfs(*, model, states: list) -> np.ndarray:
+    """Propagate a batch of states without gradients, return the cumulative probabilities."""
+    n = len(states)
+    if conv:
+        inputs = (np.stack([s[0] for s in states]),
+                  np.stack([s[1] for s in states]))
+    else:
+        inputs = (np.stack(states),)
+
+    buf = _staging_buffer(states[0])
+    buf.fill_batch(*inputs)
+    host = getattr(model, 'inference_only', False)
+    with torch.no_grad():
+        inputs = buf.tensors(n, host=host)
+        inputs = inputs if conv else inputs[0]
+        probs, _ = model(inputs)
+
+    return _probs_to_cdf(probs.view(n, -1))
+
+
+def _recompute_actions(*, model, states, saved_actions) -> list:
+    """Return the SavedActions with log probabilities and values of model.
+
+    Used for actions that were chosen by an exported policy, which doesn't
+    keep track of gradients. All states of an agent are propagated at once.
+    """
+    n = len(saved_actions)
+    if isinstance(states, PackedStates):  # unpack all at once
+        inputs = [t.type(dtype) for t in states.codec.to_tensors(states.records(n))]
+
+    else:
+        states = list(states)[:n]
+        if conv:
+            inputs = (np.stack([s[0] for s in states])[:, None],
+                      np.stack([s[1] for s in states]))
+        else:
+            inputs = (np.stack(states),)
+
+        inputs = [Variable(torch.from_numpy(i).float().type(dtype)) for i in inputs]
+
+    probs, values = model(inputs if conv else inputs[0])
+    probs, values = probs.view(n, -1), values.view(n, -1)
+    if any(sa.mask is not None for sa in saved_actions):
+        all_actions = (1 << probs.shape[-1]) - 1
+        probs = _mask_probs(probs, _int_to_mask([all_actions if sa.mask is None
+                                                 else sa.mask
+                                                 for sa in saved_actions],
+                                                probs.shape[-1]))
+
+    actions = torch.tensor([sa.action_nr for sa in saved_actions],
+                           device=probs.device)
+    log_probs = Categorical(probs).log_prob(actions)
+    return [SavedAction(lp, v, sa.action_nr, sa.mask)
+            for lp, v, sa in zip(log_probs, values, saved_actions)]
+
+
 # defining necessary functions - move to a class maybe? /shrug
-def select_action(*, model, agent, state) -> float:
-    """Select an action based on the weighted possibilities given as the output from the model."""
+def select_action(*, model, agent, state, table: PolicyTable=None,
+                  cache: InferenceCache=None, masker=None) -> float:
+    """Select an action based on the weighted possibilities given as the output from the model.
+
+    If a compiled PolicyTable of model is given, the action is looked up in
+    it, unless the state has no code in the table. If an InferenceCache is
+    given, the distribution is taken from it, if the state was seen before
+    with the current weights.
+
+    masker is a functional like `env.action_masks`, which returns the valid
+    actions of states of a kin. If given, the probabilities of the other
+    actions are set to 0, so the sampled action is always executable. Without
+    it, every action can be sampled.
+    """
     # state should be a list of numpy arrays [np.array(nbh), np.array(fr)]
     agent.memory.States.append(state)  # save the state
+    mask = masker(states=[state], kin=agent.kin)[0] if masker is not None else None
+    bits = _mask_to_int(mask) if mask is not None else None
+
+    cdf = None
+    code = table.code(state) if table is not None and table.compiled else None
+    if code is not None:
+        cdf = table[code]
+
+    elif (cache is not None and
+            not any([isinstance(el, torch.Tensor) for el in state])):
+        cdf = cache.cdfs(model=model, states=[state])[0]
+
+    if cdf is not None:
+        if mask is not None:
+            cdf = _mask_cdf(cdf, mask)
+        action = int(_sample_cdf(cdf))
+        if train:  # the gradients are recomputed in finish_episode
+            agent.memory.Actions.append(SavedAction(_cdf_log_prob(cdf, action),
+                                                    None, action, bits))
+        return action
+
+    exported = (isinstance(model, torch.jit.ScriptModule) or
+                getattr(model, 'inference_only', False))
+    if ((not train or exported) and
+            not any([isinstance(el, torch.Tensor) for el in state])):
+        # no gradients needed, so the state can go through a reused buffer
+        buf = _staging_buffer(state)
+        buf.fill(0, state)
+        with torch.no_grad():
+            # the quantised policies run on the cpu
+            inputs = buf.tensors(1, host=getattr(model, 'inference_only',
+                                                 False))
+            probs, state_value = model(inputs if conv else inputs[0])
+            probs = probs.view(-1)  # a batch of one
+            if mask is not None:
+                probs = _mask_probs(probs, mask)
+
+        cat_dist = Categorical(probs)
+        action = cat_dist.sample()
+        if train:  # the gradients are recomputed in finish_episode
+            agent.memory.Actions.append(SavedAction(cat_dist.log_prob(action).item(),
+                                                    None, action.item(), bits))
+
+        return action.item()
+
     if conv:
         if not any([isinstance(el, Variable) for el in state]):
             for i, s in enumerate(state):
@@ -167,18 +897,32 @@ def select_action(*, model, agent, state) -> float:
     else:
         state = torch.from_numpy(state).float().type(dtype)  # float creates a float tensor
         probs, state_value = model(Variable(state))  # propagate the state as Variable
+
+    probs, state_value = probs.view(-1), state_value.view(-1)  # single state
+    if mask is not None:
+        probs = _mask_probs(probs, mask)
     cat_dist = Categorical(probs)  # categorical distribution
     action = cat_dist.sample()  # I think I should e-greedy right at this point
     if train:
         agent.memory.Actions.append(SavedAction(cat_dist.log_prob(action),
-                                                state_value, action.item()))
+                                                state_value, action.item(),
+                                                bits))
     return action.item()  # just output a number and not additionally the type
 
 
-# defining what to do after the episode finished.
-def finish_episode(*, model, optimizer, history, gamma: float=0.1,
-                   return_means: bool=False) -> Optional[tuple]:
-    """Calculate the losses and backprop them through the models NN."""
+# losses of all agents in the history
+def _episode_losses(*, model, history, gamma: float, bootstraps: list=None,
+                    normalize: bool=True) -> tuple:
+    """Calculate the loss of every agent in history.
+
+    If bootstraps is given, it holds for every agent the value of the state
+    after its last step, which is used as return after the last reward
+    (otherwise 0). If normalize is set, the returns of every agent are
+    normalised to zero mean and unit variance.
+
+    Returns a deque of the losses per agent, a deque of all rewards and a
+    deque with the chosen actions of every agent.
+    """
     # initialize a few variables
     # eps needs to be tensor now{}
     eps = Tensor([np.finfo(np.float32).eps])  # machine epsilon
@@ -186,9 +930,13 @@ def finish_episode(*, model, optimizer, history, gamma: float=0.1,
     returns_to_average = deque()
     species_actions = deque()  # init
     actions_per_agent = deque()  # init
-    for (_, agent_rewards, saved_actions) in history:
+    for i, (states, agent_rewards, saved_actions) in enumerate(history):
+        if saved_actions and saved_actions[0].value is None:
+            # chosen by an exported policy, get the gradients from model
+            saved_actions = _recompute_actions(model=model, states=states,
+                                               saved_actions=saved_actions)
 
-        R = 0  # The discounted reward
+        R = bootstraps[i] if bootstraps is not None else 0  # discounted reward
         rewards = deque()
         policy_losses = deque()
         state_value_losses = deque()
@@ -203,16 +951,17 @@ def finish_episode(*, model, optimizer, history, gamma: float=0.1,
             rewards.appendleft(R)  # deque power baby!
 
         rewards = torch.Tensor(rewards).type(dtype)  # use gpu if available
-        rewards = (rewards - rewards.mean()) / (rewards.std() + eps)
-        # I think the eps should take care of my problem of NaNs. Somehow it
-        # doesn't work, but the effect is the same as if I just switch the NaNs
-        # to 0.
-        # converting NaNs to 0.
-        rewards[rewards != rewards] = 0  # should convert all NaN to 0
+        if normalize:
+            rewards = (rewards - rewards.mean()) / (rewards.std() + eps)
+            # I think the eps should take care of my problem of NaNs. Somehow it
+            # doesn't work, but the effect is the same as if I just switch the NaNs
+            # to 0.
+            # converting NaNs to 0.
+            rewards[rewards != rewards] = 0  # should convert all NaN to 0
 
         actions_per_agent.clear()  # clear the deque
         # now interate over all probability-state value-reward pairs
-        for (log_prob, state_value, action), r in zip(saved_actions, rewards):
+        for (log_prob, state_value, action, _), r in zip(saved_actions, rewards):
             actions_per_agent.append(action)  # save action for later
             reward = r - state_value.item()  # get the value, needs `Variable`
             policy_losses.append(-log_prob * reward)
@@ -222,12 +971,23 @@ def finish_episode(*, model, optimizer, history, gamma: float=0.1,
 
         species_actions.append(actions_per_agent.copy())
 
-        # empty the gradient of the optimizer
-        optimizer.zero_grad()
-
         # calculate the loss
         losses.append(torch.stack(list(policy_losses)).sum() + torch.stack(list(state_value_losses)).sum())
 
+    return losses, returns_to_average, species_actions
+
+
+# defining what to do after the episode finished.
+def finish_episode(*, model, optimizer, history, gamma: float=0.1,
+                   return_means: bool=False) -> Optional[tuple]:
+    """Calculate the losses and backprop them through the models NN."""
+    losses, returns_to_average, species_actions = _episode_losses(model=model,
+                                                                  history=history,
+                                                                  gamma=gamma)
+
+    # empty the gradient of the optimizer
+    optimizer.zero_grad()
+
     # average all losses
     loss = torch.stack(list(losses)).mean()
 
@@ -245,10 +1005,78 @@ def finish_episode(*, model, optimizer, history, gamma: float=0.1,
         return loss, ret_avg, species_actions.copy()
 
 
+def finish_segment(*, model, optimizer, history, bootstraps: list,
+                   gamma: float=0.1) -> tuple:
+    """Train on the most recent segment of the agents' trajectories.
+
+    This is the truncated n-step variant of finish_episode: bootstraps holds
+    for every memory in history the value of the agent's current state, or
+    0 if the agent is dead. The discounted returns start from that value and
+    are not normalised, since a segment can be just a few steps long.
+
+    Returns the loss and the mean reward. The memories can be cleared
+    afterwards.
+    """
+    losses, returns, _ = _episode_losses(model=model, history=history,
+                                         gamma=gamma, bootstraps=bootstraps,
+                                         normalize=False)
+
+    optimizer.zero_grad()
+    loss = torch.stack(list(losses)).mean()
+    loss.backward()
+    optimizer.step()
+
+    return loss, np.mean(returns)
+
+
+def state_value(*, model, state) -> float:
+    """Return the value of a single state without tracking gradients."""
+    buf = _staging_buffer(state)
+    buf.fill(0, state)
+    with torch.no_grad():
+        inputs = buf.tensors(1, host=getattr(model, 'inference_only', False))
+        _, value = model(inputs if conv else inputs[0])
+
+    return value.item()
+
+
+def finish_episode_shared(*, model: MultiHeadPolicy, optimizer, histories: dict,
+                          gamma: float=0.1, bootstraps: dict=None) -> dict:
+    """Calculate the losses of all kins and backprop them in a single pass.
+
+    histories maps the kins of model to their history. The loss is the mean
+    over the agents of every kin. Returns a dict that maps every kin to the
+    tuple (loss, mean reward, species actions) like finish_episode.
+
+    If bootstraps (a dict of kin to list of values) is given, the update is
+    done on a segment like in finish_segment.
+    """
+    losses = deque()
+    means = {}
+    for kin, history in histories.items():
+        kin_losses, returns, actions = _episode_losses(model=model.for_kin(kin),
+                                                       history=history,
+                                                       gamma=gamma,
+                                                       bootstraps=(bootstraps[kin]
+                                                                   if bootstraps
+                                                                   else None),
+                                                       normalize=not bootstraps)
+        losses.extend(kin_losses)
+        means[kin] = (torch.stack(list(kin_losses)).mean().detach(),
+                      np.mean(returns), actions)
+
+    optimizer.zero_grad()
+    loss = torch.stack(list(losses)).mean()
+    loss.backward()
+    optimizer.step()
+
+    return means
+
+
 # saving function
 def save_checkpoint(state: dict, filename: str) -> None:
     """Save the given model state to file."""
     if filename[-8:] != ".pth.tar":
         filename += ".pth.tar"
 
-    torch.save(state, filename)  # stores the given parameters
+    atomic_save(state, filename)  # stores the given parameters
@@ -7,6 +7,18 @@ from typing import Callable, NamedTuple, Union
 
 memory = namedtuple('Memory', ('States', 'Rewards', 'Actions'))
 
+# container for the states in new memories, see `init`
+_states_factory = deque
+
+
+def init(*, states: Callable=deque) -> None:
+    """Set the factory of the containers for the states in the agents' memories.
+
+    E.g. `partial(PackedStates, codec)` stores the states packed.
+    """
+    global _states_factory
+    _states_factory = states
+
 
 class Agent:
     """
@@ -71,7 +83,7 @@ class Agent:
         if mem is not None:
             self.memory = mem
         else:
-            self.memory = memory(deque(), deque(), deque())  # initialize empty lists
+            self.memory = memory(_states_factory(), deque(), deque())  # initialize empty lists
 
     # magic method ------------------------------------------------------------
     def __str__(self) -> str:
@@ -0,0 +1,275 @@
+"""This file provides the functionality for writing checkpoints safely and in the background."""
+
+import os
+import copy
+import pickle
+import queue
+import threading
+import warnings
+
+import numpy as np
+from collections import deque
+from typing import Any, Iterator
+
+import torch
+
+
+def snapshot(obj: Any) -> Any:
+    """Return a copy of obj that doesn't share memory with the live simulation.
+
+    Tensors are detached, moved to the cpu and cloned, such that the optimizer
+    can keep on updating the parameters while the copy is serialised.
+    Containers are copied recursively, everything else is deep copied.
+    """
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().cpu().clone()
+
+    elif isinstance(obj, dict):
+        return type(obj)((k, snapshot(v)) for k, v in obj.items())
+
+    elif isinstance(obj, deque):
+        return deque((snapshot(v) for v in obj), maxlen=obj.maxlen)
+
+    elif isinstance(obj, (list, tuple)) and not hasattr(obj, '_fields'):
+        return type(obj)(snapshot(v) for v in obj)
+
+    elif isinstance(obj, np.ndarray):
+        return obj.copy()
+
+    else:
+        return copy.deepcopy(obj)
+
+
+def atomic_save(obj: Any, filename: str) -> None:
+    """Save obj with torch.save such that filename is either complete or untouched.
+
+    The data is written to a temporary file in the same directory, synced to
+    disk and then renamed, which is atomic on POSIX file systems.
+    """
+    tmpname = filename + ".tmp"
+    with open(tmpname, "wb") as f:
+        torch.save(obj, f)
+        f.flush()
+        os.fsync(f.fileno())  # make sure the data actually is on disk
+
+    os.replace(tmpname, filename)  # atomic
+
+    # sync the directory, such that the rename survives a crash as well
+    dirname = os.path.dirname(os.path.abspath(filename))
+    try:
+        fd = os.open(dirname, os.O_RDONLY)
+    except OSError:  # e.g. not possible on some platforms
+        return
+
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+class StatisticsLog:
+    """An append-only log file of the simulation statistics.
+
+    Every record is a dictionary which is pickled and appended to the end of
+    the file, so saving only ever costs the new rows and not the entire
+    history. `append` returns the file size after writing, which is stored in
+    the corresponding checkpoint. On resume, `truncate` cuts off records that
+    were written after the checkpoint, e.g. due to a crash.
+    """
+
+    # slots -------------------------------------------------------------------
+    __slots__ = ['_filename']
+
+    # init --------------------------------------------------------------------
+    def __init__(self, filename: str):
+        """Initialise the log, the file is created with the first record."""
+        self._filename = filename
+
+    # properties --------------------------------------------------------------
+    @property
+    def filename(self) -> str:
+        """Return the filename of the log."""
+        return self._filename
+
+    # methods -----------------------------------------------------------------
+    def append(self, record: dict) -> int:
+        """Append the record to the log and return the new size of the file."""
+        with open(self._filename, "ab") as f:
+            pickle.dump(record, f, protocol=pickle.HIGHEST_PROTOCOL)
+            f.flush()
+            os.fsync(f.fileno())
+            return f.tell()
+
+    def truncate(self, offset: int) -> None:
+        """Cut off everything that was written after offset."""
+        if os.path.exists(self._filename) and os.path.getsize(self._filename) > offset:
+            os.truncate(self._filename, offset)
+
+    def records(self) -> Iterator[dict]:
+        """Iterate over all records in the log."""
+        if not os.path.exists(self._filename):
+            return
+
+        with open(self._filename, "rb") as f:
+            while True:
+                try:
+                    yield pickle.load(f)
+                except EOFError:
+                    return
+
+    def collect(self, key: str) -> deque:
+        """Return the concatenated rows of key from all records."""
+        rows = deque()
+        for record in self.records():
+            rows.extend(record.get(key, ()))
+
+        return rows
+
+
+class CheckpointWriter:
+    """Write checkpoints in a background thread.
+
+    It has the following attributes:
+        - keep, the number of checkpoints to keep on disk, older ones written
+            by this writer are deleted. 0 keeps every checkpoint.
+        - asynchronous, if False, every checkpoint is written directly on
+            the calling thread
+        - written, a deque of the checkpoint files written so far (oldest
+            first)
+
+    The state passed to `save` is snapshotted on the calling thread, so the
+    simulation can go on right away. Serialisation, fsync and rotation happen
+    on the worker thread. Every checkpoint is written via `atomic_save`, thus
+    a crash during saving never corrupts the latest resumable state.
+
+    If statistics are given to `save`, they are first appended to the
+    StatisticsLog and the resulting log position is stored in the checkpoint
+    as 'stats_log' and 'stats_offset'. Checkpoints saved with rotate=False,
+    e.g. a fixed file that is replaced over and over, are neither counted nor
+    deleted by the rotation.
+    """
+
+    # slots -------------------------------------------------------------------
+    __slots__ = ['_keep', '_asynchronous', '_written', '_queue', '_thread',
+                 '_error']
+
+    # init --------------------------------------------------------------------
+    def __init__(self, *, keep: int=0, asynchronous: bool=True):
+        """Initialise the writer and start the worker thread if wanted."""
+        if not isinstance(keep, int) or keep < 0:
+            raise ValueError("keep must be a positive int or 0, but {} was "
+                             "given.".format(keep))
+
+        self._keep = keep
+        self._asynchronous = asynchronous
+        self._written = deque()
+        self._queue = queue.Queue()
+        self._thread = None
+        self._error = None
+
+        if self._asynchronous:
+            self._thread = threading.Thread(target=self._worker,
+                                            name="CheckpointWriter",
+                                            daemon=True)
+            self._thread.start()
+
+    # properties --------------------------------------------------------------
+    @property
+    def keep(self) -> int:
+        """Return the number of checkpoints that are kept on disk."""
+        return self._keep
+
+    @property
+    def asynchronous(self) -> bool:
+        """Return whether the checkpoints are written in the background."""
+        return self._asynchronous
+
+    @property
+    def written(self) -> deque:
+        """Return the filenames of the checkpoints written so far."""
+        return self._written
+
+    # methods -----------------------------------------------------------------
+    def save(self, *, state: dict, filename: str, statistics: dict=None,
+             log: StatisticsLog=None, rotate: bool=True) -> None:
+        """Snapshot the given state (and statistics) and write it to filename."""
+        self._raise_error()
+
+        if filename[-8:] != ".pth.tar":
+            filename += ".pth.tar"
+
+        if (statistics is None) != (log is None):
+            raise ValueError("statistics and log have to be given together.")
+
+        state = snapshot(state)
+        statistics = snapshot(statistics) if statistics is not None else None
+
+        if self._asynchronous:
+            self._queue.put((state, filename, statistics, log, rotate))
+
+        else:
+            self._write(state, filename, statistics, log, rotate)
+
+    def flush(self) -> None:
+        """Block until every pending checkpoint is written."""
+        if self._asynchronous:
+            self._queue.join()
+
+        self._raise_error()
+
+    def close(self) -> None:
+        """Write the pending checkpoints and stop the worker thread."""
+        if self._thread is not None:
+            self._queue.put(None)  # poison pill
+            self._thread.join()
+            self._thread = None
+            self._asynchronous = False  # writing directly from now on
+
+        self._raise_error()
+
+    def _raise_error(self) -> None:
+        """Raise the last error of the worker thread on the calling thread."""
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise RuntimeError("writing a checkpoint failed.") from error
+
+    def _worker(self) -> None:
+        """Take checkpoints from the queue and write them, until None arrives."""
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+
+                self._write(*item)
+
+            except Exception as e:  # handed over to the main thread
+                warnings.warn("Writing checkpoint {} failed: {}"
+                              "".format(item[1], e), RuntimeWarning)
+                self._error = e
+
+            finally:
+                self._queue.task_done()
+
+    def _write(self, state: dict, filename: str, statistics: dict=None,
+               log: StatisticsLog=None, rotate: bool=True) -> None:
+        """Write a single checkpoint and rotate the old ones."""
+        if log is not None:
+            state['stats_log'] = log.filename
+            state['stats_offset'] = log.append(statistics)
+
+        atomic_save(state, filename)
+        if not rotate:
+            return
+
+        self._written.append(filename)
+
+        # rotation, only ever deletes files this writer created
+        while self._keep and len(self._written) > self._keep:
+            old = self._written.popleft()
+            try:
+                os.remove(old)
+            except FileNotFoundError:
+                pass
@@ -1,20 +1,27 @@
 """Providing the environment."""
 import warnings
+import queue
+import threading
 
 import random as rd
 import numpy as np
 import numpy.ma as ma
 import matplotlib.pyplot as plt
 import matplotlib as mpl
+from functools import partial
 from collections import namedtuple, deque
-from typing import Union, Callable, NamedTuple
+from typing import Union, Callable, NamedTuple, Optional
 from gym.utils import seeding
 
-from tools import type_check, timestamp, function_call_counter
+from tools import type_check, timestamp, function_call_counter, StepProfiler
 
 hist = namedtuple('history', ('Predator', 'Prey'))  # history of agent memory
 orientedHistory = namedtuple('history', ('OrientedPredator', 'OrientedPrey'))
 
+# array representation of a grid, one plane per agent attribute
+GridArrays = namedtuple('GridArrays', ('kind', 'food', 'orient', 'generation',
+                                       'p_breed', 'p_eat', 'p_flee'))
+
 
 def init(*, goal: str="training", policy_kind: str="conv"):
     """Initialize some global variables to set the environment to act in a specific behaviour.
@@ -30,6 +37,18 @@ def init(*, goal: str="training", policy_kind: str="conv"):
     conv = True if policy_kind == "conv" else False
 
 
+def _split_states(states: list, n_side: int) -> tuple:
+    """Return the neighbourhoods (N, ...) and side information (N, n_side) of a list of states."""
+    if conv:
+        views = np.stack([np.asarray(s[0], dtype=float) for s in states])
+        sides = np.stack([np.ravel(s[1]).astype(float) for s in states])
+    else:
+        flat = np.stack([np.asarray(s, dtype=float) for s in states])
+        views, sides = flat[:, :-n_side], flat[:, -n_side:]
+
+    return views, sides
+
+
 class Environment:
     """The environment class.
 
@@ -47,6 +66,7 @@ class Environment:
         - _np_random, a variable needed for seeding
         - history, a named tuple with one deque each agent_type to store all
             experiences an agent undergoes in its life
+        - profiler, an optional StepProfiler that times the phases of `step`
 
     Most of the attributes are property managed.
     """
@@ -54,7 +74,7 @@ class Environment:
     # slots -------------------------------------------------------------------
     __slots__ = ['_dim', '_densities', '_agent_types', '_agent_kwargs',
                  '_max_pop', '_env', '_agents_set', '_agents_tuple',
-                 '_np_random', '_history']  # _agent_named_properties
+                 '_np_random', '_history', '_profiler']  # _agent_named_properties
 
     # init --------------------------------------------------------------------
     def __init__(self, *, dim: tuple, agent_types: Union[Callable, tuple],
@@ -71,6 +91,7 @@ class Environment:
         self._agent_types = None
         self._np_random = None
         self._history = None  # keeps every memory of every agent
+        self._profiler = None  # profiling is disabled by default
 
         # set property managed attribute(s)
         self.dim = dim
@@ -213,6 +234,22 @@ class Environment:
         else:
             self._history = history
 
+    # profiler
+    @property
+    def profiler(self) -> Optional[StepProfiler]:
+        """Return the step profiler, None if profiling is disabled."""
+        return self._profiler
+
+    @profiler.setter
+    def profiler(self, profiler: Optional[StepProfiler]) -> None:
+        """Set (or unset with None) the step profiler."""
+        if not (profiler is None or isinstance(profiler, StepProfiler)):
+            raise TypeError("profiler must be of type StepProfiler or None but"
+                            " {} was given.".format(type(profiler)))
+
+        else:
+            self._profiler = profiler
+
     # staticmethods -----------------------------------------------------------
 
     # methods -----------------------------------------------------------------
@@ -261,6 +298,7 @@ class GridPPM(Environment):
         - REWARDS, a dictionary that maps representations of actions to actual
             rewards.
         - KIN_LOOKUP, a dictionary that maps agent.__name__'s to int.
+        - PROCREATION_FOOD_RESERVE, the food reserve an agent needs to procreate.
 
     Only nbh_type is property managed, all other _nbh_* attributes are set within the nbh_type property method.
     """
@@ -278,6 +316,11 @@ class GridPPM(Environment):
 
     KIN_LOOKUP = {"Predator": -1, "Prey": 1}
 
+    PROCREATION_FOOD_RESERVE = 5
+
+    # targets of the actions in each block of five in action_lookup: D, L, '', R, U
+    _TARGETS = np.array([(1, 0), (0, -1), (0, 0), (0, 1), (-1, 0)])
+
     __slots__ = ['action_lookup', 'shuffled_agent_list', '_nbh_lr', '_nbh_ur',
                  'state', 'eaten_prey', '_nbh_type', '_nbh_range']
 
@@ -788,7 +831,7 @@ class GridPPM(Environment):
             target_index = tuple((np.array(index) + delta) % self.dim)  # bounds again!
             target_content = self.env[target_index]  # == agent_uuid if delta is [0,0]
 
-            if agent.food_reserve >= 5:  # FIXME: no hardcoding!
+            if agent.food_reserve >= self.PROCREATION_FOOD_RESERVE:
                 if target_content is not None:
                     # can't procreate without space
                     return self.REWARDS['wrong_action']
@@ -821,6 +864,33 @@ class GridPPM(Environment):
         return procreate_and_move
 
     # methods for actor-critic ------------------------------------------------
+    def action_masks(self, *, states: list, kin: str) -> np.ndarray:
+        """Return a boolean mask (N, 15) of the actions that aren't wrong actions in the given states.
+
+        The states are the ones returned by `index_to_state` for agents of
+        kin, the mask is computed from the kind values in the neighbourhood and
+        the food reserve, which is reduced once more before the agent acts.
+        """
+        views, fr = _split_states(states, 1)
+        n, r = len(views), self._nbh_range
+        views = views.reshape(n, r, r)
+        dy, dx = self._TARGETS.T
+        cells = views[:, r//2 + dy, r//2 + dx]  # (N, 5)
+        fr = fr[:, 0] - (1 if self.agent_kwargs['mortality'] else 0)
+
+        center = np.zeros(5, dtype=bool)
+        center[2] = True
+        empty = (cells == 0) & ~center
+        move = empty | center
+        if kin == "Predator":
+            eat = (cells == 1) & ~center  # only preys around
+
+        else:
+            eat = empty | center
+
+        procreate = empty & (fr >= self.PROCREATION_FOOD_RESERVE)[:, None]
+        return np.concatenate([move, eat, procreate], axis=1)
+
     def reset(self) -> tuple:
         """Reset the environment and return the state and the object of the first popped element of the shuffled agents list."""
         # clear the sets
@@ -852,6 +922,10 @@ class GridPPM(Environment):
 
     def step(self, *, model: Callable, agent: Callable, index: tuple, action: int, returnidx: tuple=None) -> tuple:
         """The method starts from the current state, takes an action and records the return of it."""
+        prof = self._profiler  # None if profiling is disabled
+        if prof is not None:
+            prof.start()
+
         reward = 0  # initialize reward
         instadeath = False
         # reduce food_reserve
@@ -865,12 +939,18 @@ class GridPPM(Environment):
             if agent.got_eaten:
                 reward = self.REWARDS['death_prey']
 
+        if prof is not None:
+            prof.lap('metabolism')
+
         # if mortality is set, then check if agent starved
         if self.agent_kwargs['mortality']:
             if (agent.food_reserve <= 0) and (reward == 0):  # if agent not dead already
                 self._die(index=index)
                 reward = self.REWARDS['death_starvation']  # more death!
 
+        if prof is not None:
+            prof.lap('starvation')
+
         # statistical death
         if (agent.kin == "Predator") and (len(self._agents_tuple.Predator)
                                           > 1):
@@ -880,6 +960,9 @@ class GridPPM(Environment):
                 reward = self.REWARDS['instadeath']  # should be zero
                 instadeath = True
 
+        if prof is not None:
+            prof.lap('instadeath')
+
         if (reward == 0) and not instadeath:
             act = self.action_lookup[action]  # select action from lookup
             reward = act(index=index)  # get reward for acting
@@ -889,6 +972,9 @@ class GridPPM(Environment):
                                    " last action was {} by agent {}"
                                    "".format(act, agent))
 
+            if prof is not None:
+                prof.lap('action')
+
         # save the reward
         if training:
             agent.memory.Rewards.append(reward)
@@ -907,8 +993,13 @@ class GridPPM(Environment):
         else:
             done = False  # no harm in being explicit
 
+        if prof is not None:
+            prof.lap('reward')
+
         if returnidx is not None:  # keep the old index in the system
             self.state = self.index_to_state(index=returnidx)
+            if prof is not None:
+                prof.lap('state')
             return reward, self.state, done, returnidx
 
         elif not final_action:
@@ -922,6 +1013,8 @@ class GridPPM(Environment):
 
             if self.env[newindex] is not None:
                 self.state = self.index_to_state(index=newindex)  # new state
+            if prof is not None:
+                prof.lap('state')
             return reward, self.state, done, newindex
 
         else:
@@ -992,9 +1085,19 @@ class GridOrientedPPM(Environment):
              'right': np.array([[0, 1], [-1, 0]]),
              'around': np.array([[-1, 0], [0, -1]])}
 
+    # precomputed results of the turns for every orientation
+    _TURN_NAMES = ('left', 'right', 'around')
+    _TURNED = {where: {o: tuple(int(v) for v in m.dot(o))
+                       for o in ((-1, 0), (0, 1), (1, 0), (0, -1))}
+               for where, m in TURNS.items()}
+
+    # the cell in front for the orientation floats 0, 0.25, 0.5 and 0.75
+    _FRONT = np.array([(-1, 0), (0, 1), (1, 0), (0, -1)])
+
     # slots -------------------------------------------------------------------
     __slots__ = ['action_lookup', 'shuffled_agent_list', 'state',
-                 'eaten_prey', '_view', '_bounds', '_metabolism', '_kins']
+                 'eaten_prey', '_view', '_bounds', '_metabolism', '_kins',
+                 '_pool', '_actions']
 
     # init --------------------------------------------------------------------
     def __init__(self, *, dim: tuple, agent_types: Union[Callable, tuple],
@@ -1018,6 +1121,8 @@ class GridOrientedPPM(Environment):
         self._bounds = ()  # is filled once by setting view
         self._metabolism = {}  # this is set in the environment, since its the same for all agents of a species
         self.eaten_prey = deque()
+        self._pool = None  # prepared initial configurations for reset
+        self._actions = {at.__name__: [] for at in self.agent_types}  # see action_counts
 
         # populate the grid + initial shuffled agent list
         self._populate()
@@ -1044,15 +1149,8 @@ class GridOrientedPPM(Environment):
                 raise TypeError("rewards should always be of type dict, but"
                                 " {} was given.".format(type(rewards)))
 
-        # setup of the action ACTION_LOOKUP
-        self.action_lookup = {0: self.turn("left"),
-                              1: self.turn("right"),
-                              2: self.turn("around"),
-                              3: self.move(stand_still=True),
-                              4: self.move(),
-                              5: self.eat(stand_still=True),
-                              6: self.eat(),
-                              7: self.procreate()}
+        # compatibility view of the actions, step dispatches via act
+        self.action_lookup = {a: partial(self.act, a) for a in range(8)}
 
     # properties --------------------------------------------------------------
     # env
@@ -1097,6 +1195,21 @@ class GridOrientedPPM(Environment):
             centered_bounds = (center + bounds).T.astype(int)  # if array is rolled, these are the bounds to use for slicing
             self._bounds = (bounds, center, centered_bounds)
 
+    # pool of initial configurations
+    @property
+    def pool(self) -> Optional["ConfigurationPool"]:
+        """Return the pool the initial configurations are taken from in reset, if any."""
+        return self._pool
+
+    @pool.setter
+    def pool(self, pool: Optional["ConfigurationPool"]) -> None:
+        """Set the pool of initial configurations, None populates on reset."""
+        if pool is not None and not isinstance(pool, ConfigurationPool):
+            raise TypeError("pool must be of type ConfigurationPool but type {}"
+                            " was given.".format(type(pool)))
+
+        self._pool = pool
+
     # metabolism
     @property
     def metabolism(self) -> dict:
@@ -1206,6 +1319,203 @@ class GridOrientedPPM(Environment):
 
         self.shuffled_agent_list = agent_list
 
+    def agent_indices(self) -> dict:
+        """Return a dict that maps every agent on the grid to its (y,x) index."""
+        y, x = np.where(self.env != None)  # same as in create_shuffled_agent_list
+        return {self.env[idx]: idx for idx in zip(y, x)}
+
+    # array representation ----------------------------------------------------
+    def _agents_to_fields(self, agents: np.ndarray) -> dict:
+        """Return a dictionary of 1D arrays with the attributes of the given agents."""
+        kwargs = self.agent_kwargs
+        fields = {'kind': np.array([self.KIN_LOOKUP[ag.kin] for ag in agents],
+                                   dtype=np.int8),
+                  'food': np.array([ag.food_reserve for ag in agents],
+                                   dtype=np.float32),
+                  'orient': np.array([ag.orient for ag in agents],
+                                     dtype=np.int8).reshape(-1, 2),
+                  'generation': np.array([ag.generation or 0 for ag in agents],
+                                         dtype=np.int32),
+                  'p_breed': np.array([ag.p_breed for ag in agents],
+                                      dtype=np.float32),
+                  'p_eat': np.array([getattr(ag, 'p_eat', kwargs.get('p_eat', 1.0))
+                                     for ag in agents], dtype=np.float32),
+                  'p_flee': np.array([getattr(ag, 'p_flee', kwargs.get('p_flee', 0.0))
+                                      for ag in agents], dtype=np.float32)}
+
+        return fields
+
+    def _fields_to_agent(self, fields: dict, i: int) -> Callable:
+        """Create the i-th agent described by the given attribute arrays."""
+        types = {self.KIN_LOOKUP[at.__name__]: at for at in self.agent_types}
+        kwargs = dict(self.agent_kwargs)  # same defaults as in _populate
+        kwargs.update(food_reserve=float(fields['food'][i]),
+                      generation=int(fields['generation'][i]),
+                      p_breed=float(fields['p_breed'][i]),
+                      p_eat=float(fields['p_eat'][i]),
+                      p_flee=float(fields['p_flee'][i]),
+                      orient=tuple(int(o) for o in fields['orient'][i]))
+
+        return types[int(fields['kind'][i])](**kwargs)
+
+    def kind_plane(self) -> np.ndarray:
+        """Return the grid as int8 array, with the values of KIN_LOOKUP."""
+        plane = np.zeros(self.dim, dtype=np.int8)
+        y, x = np.where(self.env != None)
+        plane[y, x] = [self.KIN_LOOKUP[ag.kin] for ag in self.env[y, x]]
+
+        return plane
+
+    def render_planes(self) -> tuple:
+        """Return the kind plane and the (H, W, 2) orientation plane for rendering."""
+        kind = np.zeros(self.dim, dtype=np.int8)
+        orient = np.zeros(self.dim + (2,), dtype=np.int8)
+        y, x = np.where(self.env != None)
+        agents = self.env[y, x]
+        kind[y, x] = [self.KIN_LOOKUP[ag.kin] for ag in agents]
+        orient[y, x] = [ag.orient for ag in agents]
+
+        return kind, orient
+
+    def to_arrays(self) -> GridArrays:
+        """Return the grid as GridArrays, i.e. one plane per agent attribute.
+
+        Empty cells are 0 in every plane.
+        """
+        y, x = np.where(self.env != None)
+        fields = self._agents_to_fields(self.env[y, x])
+
+        planes = {}
+        for k, v in fields.items():
+            plane = np.zeros(self.dim + v.shape[1:], dtype=v.dtype)
+            plane[y, x] = v
+            planes[k] = plane
+
+        return GridArrays(**planes)
+
+    def from_arrays(self, arrays: GridArrays) -> None:
+        """Replace the grid and all agents with the ones described by arrays.
+
+        The new agents start with an empty memory.
+        """
+        self._install(*self.build_grid(arrays))
+
+    def build_grid(self, arrays: GridArrays) -> tuple:
+        """Return a new object grid and the list of its agents described by arrays.
+
+        The environment itself is not touched, thus this can run on another
+        thread, e.g. in a ConfigurationPool.
+        """
+        if arrays.kind.shape != self.dim:
+            raise ValueError("arrays of shape {} don't fit the grid of shape"
+                             " {}.".format(arrays.kind.shape, self.dim))
+
+        grid = np.empty(self.dim, dtype=object)
+        y, x = np.nonzero(arrays.kind)
+        fields = {k: v[y, x] for k, v in arrays._asdict().items()}
+        agents = []
+        for i, index in enumerate(zip(y, x)):
+            ag = self._fields_to_agent(fields, i)
+            grid[index] = ag
+            agents.append(ag)
+
+        return grid, agents
+
+    def initial_arrays(self, rng: np.random.RandomState=None) -> GridArrays:
+        """Return the GridArrays of a new random initial configuration.
+
+        The agents are placed as in `_populate` and get the attributes of
+        agent_kwargs and a random orientation. Only rng (default: numpy's
+        global state) is used for drawing.
+        """
+        rng = np.random if rng is None else rng
+        kwargs = self.agent_kwargs
+        num_agents = (np.array(self.densities) * self.max_pop).astype(int)
+        kinds = np.repeat([self.KIN_LOOKUP[at.__name__]
+                           for at in self.agent_types], num_agents)
+
+        n = len(kinds)
+        cells = rng.permutation(self.max_pop)[:n]
+        fields = {'kind': kinds.astype(np.int8),
+                  'food': np.full(n, kwargs.get('food_reserve', 0), dtype=np.float32),
+                  'orient': self._FRONT[rng.randint(4, size=n)].astype(np.int8),
+                  'generation': np.full(n, kwargs.get('generation') or 0, dtype=np.int32),
+                  'p_breed': np.full(n, kwargs.get('p_breed', 1.0), dtype=np.float32),
+                  'p_eat': np.full(n, kwargs.get('p_eat', 1.0), dtype=np.float32),
+                  'p_flee': np.full(n, kwargs.get('p_flee', 0.0), dtype=np.float32)}
+
+        planes = {}
+        for k, v in fields.items():
+            plane = np.zeros((self.max_pop,) + v.shape[1:], dtype=v.dtype)
+            plane[cells] = v
+            planes[k] = plane.reshape(self.dim + v.shape[1:])
+
+        return GridArrays(**planes)
+
+    def _install(self, grid: np.ndarray, agents: list, order: deque=None) -> None:
+        """Replace the grid and all agents with grid and agents, e.g. from `build_grid`.
+
+        If order is given, it becomes the shuffled agent list.
+        """
+        # clear the sets
+        for kin in self._agents_tuple:
+            kin.clear()
+        self._agents_set.clear()
+
+        self._env = grid
+        for ag in agents:
+            self._add_to_agents_tuple(newborn=ag)
+
+        if order is not None:
+            self.shuffled_agent_list = order
+
+    def snapshot(self) -> dict:
+        """Return a compact snapshot of the current state of the environment.
+
+        The snapshot consists of numpy arrays and plain python objects only:
+        the attribute planes of the grid, the remaining agent order, the
+        eaten prey queue and the states of the random number generators of
+        `random` and `numpy`. Agent memories are not part of the snapshot.
+        """
+        eaten_index = np.array([idx for idx, _ in self.eaten_prey],
+                               dtype=int).reshape(-1, 2)
+        eaten = self._agents_to_fields([ag for _, ag in self.eaten_prey])
+        order = np.array(self.shuffled_agent_list, dtype=int).reshape(-1, 2)
+
+        return {'arrays': self.to_arrays()._asdict(),
+                'order': order,
+                'eaten_index': eaten_index,
+                'eaten': eaten,
+                'rng': (rd.getstate(), np.random.get_state())}
+
+    def restore(self, snapshot: dict) -> None:
+        """Restore the environment from a snapshot, see `snapshot`."""
+        self.from_arrays(GridArrays(**snapshot['arrays']))
+
+        # restore the agent order, same element type as in create_shuffled_agent_list
+        self.shuffled_agent_list = deque(tuple(idx) for idx in
+                                         snapshot['order'].astype(np.int64))
+
+        # eaten prey are not on the grid anymore
+        self.eaten_prey.clear()
+        eaten = snapshot['eaten']
+        for i, idx in enumerate(snapshot['eaten_index'].astype(np.int64)):
+            ag = self._fields_to_agent(eaten, i)
+            ag.got_eaten = True
+            self.eaten_prey.append((tuple(idx), ag))
+
+        # clear history
+        for kin in self.history:
+            kin.clear()
+
+        # the actions since the snapshot are taken again
+        self.action_counts()
+
+        # random number generators
+        rd_state, np_state = snapshot['rng']
+        rd.setstate(rd_state)
+        np.random.set_state(np_state)
+
     # convert agent to integer
     def _ag_to_int(self, *, ag: Callable) -> int:
         """Return a integer representation of the agent.
@@ -1327,55 +1637,56 @@ class GridOrientedPPM(Environment):
         else:  # if no conv input layer is set, the nbh needs to be flattened
             return nbh.ravel()
 
-    # rotate agent
-    def turn(self, where: str) -> Callable:
-        """Return a functional that turns the agents direction."""
-        def turn_agent(index: tuple) -> int:
-            """Turn the agent at index in the given direction.
+    # flat action dispatch
+    def act(self, action: int, index: tuple) -> int:
+        """Let the agent at index perform the action with the given number and return the reward.
 
-            Possible directions are: 'left', 'right' & 'around'. Other
-            directions raise errors.
-            """
-            if where not in self.TURNS.keys():
-                raise RuntimeError("Unknown turn direction '{}' was given."
-                                   "".format(where))
+        The actions are:
+            0, 1, 2: turn left, right or around
+            3, 4: stand still or move forward
+            5, 6: eat on the spot (only preys) or eat forward
+            7: procreate forward
+        """
+        if action < 3:
+            return self._turn(index, self._TURN_NAMES[action])
 
-            else:
-                ag = self.env[index]
-                ag.orient = tuple(self.TURNS[where].dot(ag.orient).astype(int))
-                return self.REWARDS['indifferent']
+        elif action == 3:
+            return self.REWARDS['indifferent']  # do nothing
 
-        return turn_agent
+        elif action == 4:
+            return self._move(index)
 
-    # move
-    def move(self, stand_still=False) -> Callable:
-        """Return a functional that, when called, moves the agent in direction of orientation."""
-        def move_agent(index: tuple) -> int:
-            """Move the agent.
+        elif action < 7:
+            return self._eat(index, stand_still=(action == 5))
 
-            If stand_still is set, the agent isn't moved at all. Otherwise
-            the agent is moved (or at least tries to move) in direction of its
-            orientation.
-            """
-            if stand_still:
-                return self.REWARDS['indifferent']  # do nothing
+        elif action == 7:
+            return self._procreate(index)
 
-            else:
-                # get agent
-                ag = self.env[index]
+        else:
+            raise RuntimeError("Unknown action {} was given.".format(action))
 
-                # get target index
-                target_index = tuple((np.array(index) + ag.orient) % self.dim)
+    def _target(self, index: tuple, orient: tuple) -> tuple:
+        """Return the index of the cell in front of index with periodic bounds."""
+        return ((index[0] + orient[0]) % self.dim[0],
+                (index[1] + orient[1]) % self.dim[1])
 
-                if self.env[target_index] is not None:
-                    return self.REWARDS['wrong_action']
+    def _turn(self, index: tuple, where: str) -> int:
+        """Turn the agent at index in the given direction."""
+        ag = self.env[index]
+        ag.orient = self._TURNED[where][ag.orient]
+        return self.REWARDS['indifferent']
 
-                else:
-                    self.env[target_index] = self.env[index]  # move
-                    self.env[index] = None  # clear old position
-                    return self.REWARDS['default']  # TODO: rename rewards
+    def _move(self, index: tuple) -> int:
+        """Move the agent at index in direction of its orientation, if the target is empty."""
+        target_index = self._target(index, self.env[index].orient)
 
-        return move_agent
+        if self.env[target_index] is not None:
+            return self.REWARDS['wrong_action']
+
+        else:
+            self.env[target_index] = self.env[index]  # move
+            self.env[index] = None  # clear old position
+            return self.REWARDS['default']  # TODO: rename rewards
 
     # eating helper funcion
     def _hunting(self, *, predator: Callable, target_cell: tuple, kin: str,
@@ -1390,126 +1701,177 @@ class GridOrientedPPM(Environment):
         self.eaten_prey.append((target_cell, target_agent))
         target_agent.got_eaten = True  # Preys have this prop
         self._die(target_cell)
-        self.move()(agent_index)
+        self._move(agent_index)
         return self.REWARDS['succesful_predator']
 
-    # eating
-    def eat(self, stand_still=False) -> Callable:
-        """Return a functional that, when called, lets an agent try to eat."""
-        def eat_and_move(index: tuple) -> int:
-            """Agent eats (or tries to eat) the cell in its orientation.
+    def _eat(self, index: tuple, stand_still: bool=False) -> int:
+        """Agent at index eats (or tries to eat) the cell in its orientation.
 
-            If stand_still is set (only possible for preys), the agent doesn't
-            move and eats in its cell.
-            """
-            # get agent
-            ag = self.env[index]
-            kin = ag.kin
+        If stand_still is set (only possible for preys), the agent doesn't
+        move and eats in its cell.
+        """
+        ag = self.env[index]
+        kin = ag.kin
 
-            if not stand_still:
-                # calculate target
-                target = tuple((np.array(index) + ag.orient) % self.dim)
-                target_cell = self.env[target]
+        if "Prey" in kin:
+            if stand_still:  # just stand around and do nothing
+                ag.food_reserve += self.metabolism[kin]['satiety']
+                return self.REWARDS['default_prey']
+
+            elif self.env[self._target(index, ag.orient)] is None:
+                self._move(index)  # actually move
+                ag.food_reserve += self.metabolism[kin]['satiety']
+                return self.REWARDS['default_prey']
 
             else:
-                target = None  # no target
+                return self.REWARDS['wrong_action']
 
-            if "Prey" in kin:
-                if target is None:  # just stand around and do nothing
-                    ag.food_reserve += self.metabolism[kin]['satiety']
-                    return self.REWARDS['default_prey']
+        elif "Predator" in kin:
+            if stand_still:  # predators can't eat on the spot
+                return self.REWARDS['wrong_action']
 
-                else:  # actually move
-                    # target should be calculated if in this branch
-                    if target_cell is None:
-                        self.move()(index)
-                        ag.food_reserve += self.metabolism[kin]['satiety']
-                        return self.REWARDS['default_prey']
+            target = self._target(index, ag.orient)
+            target_cell = self.env[target]
 
-                    else:
-                        return self.REWARDS['wrong_action']
+            if target_cell is None:
+                return self.REWARDS['wrong_action']  # don't eat air
 
-            elif "Predator" in kin:
-                if stand_still:  # predators can't eat on the spot
-                    return self.REWARDS['wrong_action']
+            elif target_cell.kin in ["Predator", "OrientedPredator"]:
+                # don't eat thy own specimen
+                return self.REWARDS['wrong_action']
+
+            else:  # actually try to eat
+                return self._hunting(predator=ag, agent_index=index, kin=kin,
+                                     target_cell=target,
+                                     target_agent=target_cell)
+
+        else:
+            raise RuntimeError("encountered unknown species of type {} but"
+                               " either Prey or Predator was expected! This"
+                               " should not have happened!"
+                               "".format(kin))
+
+    def _procreate(self, index: tuple) -> int:
+        """Agent at index tries to procreate in its orientation."""
+        ag = self.env[index]
+        kin = ag.kin
+
+        if ag.food_reserve <= self.metabolism[kin]['exhaust']:
+            # don't try to breed without enough food_reserve
+            return self.REWARDS['wrong_action']
+
+        target = self._target(index, ag.orient)
+        if self.env[target] is not None:
+            # target cell is not empty
+            return self.REWARDS['wrong_action']
+
+        # try to breed
+        if ag.p_breed < 1.0:
+            roll = rd.random()
+            if roll > ag.p_breed:
+                if "Prey" in kin:
+                    return self.REWARDS['default_prey']
 
                 else:
-                    if target_cell is None:
-                        return self.REWARDS['wrong_action']  # don't eat air
+                    return self.REWARDS['default_predator']
 
-                    elif target_cell.kin in ["Predator", "OrientedPredator"]:
-                        # don't eat thy own specimen
-                        return self.REWARDS['wrong_action']
+        exhaust = self.metabolism[kin]['exhaust']
+        newborn = ag.procreate(food_reserve=exhaust)
+        self.add_to_env(target_index=target, newborn=newborn)
+        ag.food_reserve -= exhaust
+        return self.REWARDS['offspring']
 
-                    else:  # actually try to eat
-                        reward = self._hunting(predator=ag, agent_index=index,
-                                               kin=kin, target_cell=target, target_agent=target_cell)
-                        return reward
+    # functionals, kept for compatibility with action_lookup
+    def turn(self, where: str) -> Callable:
+        """Return a functional that turns the agents direction."""
+        if where not in self.TURNS.keys():
+            raise RuntimeError("Unknown turn direction '{}' was given."
+                               "".format(where))
 
-            else:
-                raise RuntimeError("encountered unknown species of type {} but"
-                                   " either Prey or Predator was expected! This"
-                                   " should not have happened!"
-                                   "".format(kin))
+        return partial(self._turn, where=where)
 
-        return eat_and_move
+    def move(self, stand_still=False) -> Callable:
+        """Return a functional that, when called, moves the agent in direction of orientation."""
+        return partial(self.act, 3 if stand_still else 4)
+
+    def eat(self, stand_still=False) -> Callable:
+        """Return a functional that, when called, lets an agent try to eat."""
+        return partial(self._eat, stand_still=stand_still)
 
-    # procreating
     def procreate(self) -> Callable:
         """Return a functional that, when called, creates offspring."""
-        def procreate_forward(index: tuple) -> int:
-            """Agent at index tries to procreate in its orientation."""
-            ag = self.env[index]  # get index
-            kin = ag.kin
+        return self._procreate
 
-            # calculate target
-            target = tuple((np.array(index) + ag.orient) % self.dim)
-            target_cell = self.env[target]
+    # statistics --------------------------------------------------------
+    def action_counts(self) -> np.ndarray:
+        """Return how often every action was taken since the last call and start counting anew.
 
-            if ag.food_reserve > self.metabolism[kin]['exhaust']:
-                if target_cell is not None:
-                    # target cell is not empty
-                    return self.REWARDS['wrong_action']
+        The counts are an int32 array (kins, 2, 8), the kins in the order of
+        agent_types, [:, 0] holds the successful actions and [:, 1] the ones
+        that were rewarded with wrong_action. Actions of eaten preys aren't
+        taken and thus aren't counted.
+        """
+        n = len(self.action_lookup)
+        counts = np.stack([np.bincount(np.array(self._actions[at.__name__],
+                                                dtype=np.intp),
+                                       minlength=2*n).reshape(2, n)
+                           for at in self.agent_types])
+        for actions in self._actions.values():
+            actions.clear()
 
-                else:
-                    # try to breed
-                    if ag.p_breed < 1.0:
-                        roll = rd.random()
-                        if roll > ag.p_breed:
-                            if "Prey" in kin:
-                                return self.REWARDS['default_prey']
+        return counts.astype(np.int32)
 
-                            else:
-                                return self.REWARDS['default_predator']
+    # methods for actor-critic --------------------------------------------
+    def action_masks(self, *, states: list, kin: str) -> np.ndarray:
+        """Return a boolean mask (N, 8) of the actions that aren't wrong actions in the given states.
 
-                    exhaust = self.metabolism[kin]['exhaust']
-                    newborn = ag.procreate(food_reserve=exhaust)
-                    self.add_to_env(target_index=target, newborn=newborn)
-                    ag.food_reserve -= exhaust
-                    return self.REWARDS['offspring']
+        The states are the ones returned by `index_to_state` for agents of
+        kin. The cell in front of the agent is read from the neighbourhood via
+        the orientation, procreating also needs enough food reserve. Turning
+        and standing still are always possible.
+        """
+        views, sides = _split_states(states, 2)
+        n = len(views)
+        views = views.reshape((n,) + tuple(self.view))
+        orient = np.rint(sides[:, 1] * 4).astype(int) % 4
+        dy, dx = self._FRONT[orient].T
+        front = views[np.arange(n), self.view[0]//2 + dy, self.view[1]//2 + dx]
+
+        mask = np.ones((n, 8), dtype=bool)
+        mask[:, 4] = front == 0  # move
+        if "Prey" in kin:
+            mask[:, 6] = front == 0  # eat forward
 
-            else:
-                # don't try to eat without enough food food_reserve
-                return self.REWARDS['wrong_action']
+        else:
+            mask[:, 5] = False  # predators can't eat on the spot
+            mask[:, 6] = front == 1  # only preys
 
-        return procreate_forward
+        mask[:, 7] = (front == 0) & (sides[:, 0] > self.metabolism[kin]['exhaust'])
+        return mask
 
-    # methods for actor-critic --------------------------------------------
     def reset(self) -> None:
-        """Reset the environment."""
-        # clear the sets
-        self._agents_tuple.OrientedPredator.clear()
-        self._agents_tuple.OrientedPrey.clear()
-        self._agents_set.clear()
+        """Reset the environment.
 
-        # empty Environment
-        self._env = np.empty(self.max_pop, dtype=object)
+        With a pool, a prepared initial configuration is swapped in, otherwise
+        the grid is populated anew.
+        """
+        if self._pool is not None:
+            self._install(*self._pool.get())
 
-        # populate the grid and agent dicts
-        self._populate()
+        else:
+            # clear the sets
+            self._agents_tuple.OrientedPredator.clear()
+            self._agents_tuple.OrientedPrey.clear()
+            self._agents_set.clear()
 
-        # create new shuffled agents list
-        self.create_shuffled_agent_list()
+            # empty Environment
+            self._env = np.empty(self.max_pop, dtype=object)
+
+            # populate the grid and agent dicts
+            self._populate()
+
+            # create new shuffled agents list
+            self.create_shuffled_agent_list()
 
         # clear eaten prey list
         self.eaten_prey.clear()
@@ -1518,6 +1880,9 @@ class GridOrientedPPM(Environment):
         self.history.OrientedPredator.clear()
         self.history.OrientedPrey.clear()
 
+        # forget the actions of the last episode
+        self.action_counts()
+
         print(": [env] Reset complete...")
 
         # pop list and return state
@@ -1536,6 +1901,10 @@ class GridOrientedPPM(Environment):
         and returns the "optimal" action for the given state (with a small
         probability for a different action).
         """
+        prof = self._profiler  # None if profiling is disabled
+        if prof is not None:
+            prof.start()
+
         # check, if any species died out:
         done = any([len(kin) == 0 for kin in self._agents_tuple])
         reward = 0  # initial
@@ -1554,10 +1923,16 @@ class GridOrientedPPM(Environment):
                 state[-1] = int(ag.food_reserve)
             # -------------------------------------------------------------
 
+            if prof is not None:
+                prof.lap('state')
+
             # actual NN magic happening here
             model = policy[ag.kin]
             action = select_action(model=model, agent=ag, state=state)
 
+            if prof is not None:
+                prof.lap('policy')
+
             # since we're already in the branch for eaten prey, no need to
             # check for the eaten_prey attribute actually
             reward = self.REWARDS['death_prey']
@@ -1565,6 +1940,9 @@ class GridOrientedPPM(Environment):
             if training:
                 ag.memory.Rewards.append(reward)
 
+            if prof is not None:
+                prof.lap('reward')
+
             return reward, state, done
 
         # regular step ++++++++++++++++++++++++++++++++++++++++++++++++++++
@@ -1593,7 +1971,10 @@ class GridOrientedPPM(Environment):
 
             else:
                 ag.food_reserve -= 0  # better be explicit
-                
+
+            if prof is not None:
+                prof.lap('metabolism')
+
             state = self.index_to_state(index=index)  # get state
 
             # TODO: check if this part is needed. -------------------------
@@ -1602,6 +1983,9 @@ class GridOrientedPPM(Environment):
                 state[-1] = int(ag.food_reserve)
             # -------------------------------------------------------------
 
+            if prof is not None:
+                prof.lap('state')
+
             # if mortality is set, then check if agent starved and if,
             # let it die and return reward, state, done
             if self.agent_kwargs['mortality'] and (ag.food_reserve <= 0):
@@ -1611,8 +1995,14 @@ class GridOrientedPPM(Environment):
                 if training:
                     ag.memory.Rewards.append(reward)
 
+                if prof is not None:
+                    prof.lap('starvation')
+
                 return reward, state, done
 
+            if prof is not None:
+                prof.lap('starvation')
+
             # check for statistical death of predators
             # sorry dear reader for the long if statement
             instadeath = self.agent_kwargs['instadeath']
@@ -1626,25 +2016,41 @@ class GridOrientedPPM(Environment):
                     if training:
                         ag.memory.Rewards.append(reward)
 
+                    if prof is not None:
+                        prof.lap('instadeath')
+
                     return reward, state, done
 
+            if prof is not None:
+                prof.lap('instadeath')
+
             # if step continued this far, then act regularly
             # again, actual NN magic happening here
             model = policy[kin]  # get policy depending on agent type
             action = select_action(model=model, agent=ag, state=state)
-            act = self.action_lookup[action]  # select action
-            reward = act(index=index)  # act and get reward
-            # save the reward
-            if training:
-                ag.memory.Rewards.append(reward)
+
+            if prof is not None:
+                prof.lap('policy')
+
+            reward = self.act(action, index)  # act and get reward
 
             # TODO: remove this part since its just here for checking ---------
             if reward is None:
                 raise RuntimeError("reward should not be of type None! The"
                                    " last action was {} by agent {}"
-                                   "".format(act, ag))
+                                   "".format(action, ag))
             # -----------------------------------------------------------------
 
+            # count the action, shifted by the number of actions if it was wrong
+            wrong = reward == self.REWARDS['wrong_action']
+            self._actions[kin].append(action + len(self.action_lookup) * wrong)
+
+            if prof is not None:
+                prof.lap('action')
+            # save the reward
+            if training:
+                ag.memory.Rewards.append(reward)
+
             if done and training:
                 # the episode is finished, append the rest of the agents'
                 # memories to the environments history
@@ -1652,6 +2058,9 @@ class GridOrientedPPM(Environment):
                     if ag.memory.Rewards:  # if agent actually has memory
                         getattr(self.history, ag.kin).append(ag.memory)
 
+            if prof is not None:
+                prof.lap('reward')
+
             return reward, state, done
 
         else:
@@ -1713,3 +2122,106 @@ class GridOrientedPPM(Environment):
         fig.savefig(params['filepath'] + filename, dpi=params['dpi'],
                     format=params['fmt'])
         plt.close(fig)
+
+
+class ConfigurationPool:
+    """Prepare the initial configurations of a GridOrientedPPM in a background thread.
+
+    It has the following attributes:
+        - size, the maximal number of prepared configurations
+        - seed, the seed of the random generator of the pool, drawn from
+            np.random at construction if none is given
+
+    A worker thread draws new configurations via `env.initial_arrays`,
+    builds the agents and the shuffled agent list and keeps up to size of
+    them ready. `get` (as called by `env.reset`) then only has to swap one
+    in. The pool draws from its own random generator, thus the global
+    random states of the simulation, which are part of the snapshots, are
+    not touched by the worker.
+    """
+
+    # slots -------------------------------------------------------------------
+    __slots__ = ['_env', '_size', '_seed', '_queue', '_stop', '_thread',
+                 '_error']
+
+    # init --------------------------------------------------------------------
+    def __init__(self, *, env: GridOrientedPPM, size: int=2, seed: int=None):
+        """Initialise the pool and start the worker thread."""
+        if not isinstance(size, int) or size < 1:
+            raise ValueError("size must be a positive int, but {} was given."
+                             "".format(size))
+
+        if seed is None:
+            # reproducible, as long as the global random state is seeded
+            seed = np.random.randint(2**31)
+
+        self._env = env
+        self._size = size
+        self._seed = seed
+        self._queue = queue.Queue(maxsize=size)
+        self._stop = threading.Event()
+        self._error = None
+        self._thread = threading.Thread(target=self._worker,
+                                        name="ConfigurationPool", daemon=True)
+        self._thread.start()
+
+    # properties --------------------------------------------------------------
+    @property
+    def size(self) -> int:
+        """Return the maximal number of prepared configurations."""
+        return self._size
+
+    @property
+    def seed(self) -> int:
+        """Return the seed of the random generator of the pool."""
+        return self._seed
+
+    def __len__(self) -> int:
+        """Return the number of configurations that are ready."""
+        return self._queue.qsize()
+
+    # methods -----------------------------------------------------------------
+    def get(self) -> tuple:
+        """Return the next prepared configuration as (grid, agents, order), wait if none is ready."""
+        while True:
+            if self._error is not None:
+                raise RuntimeError("preparing a configuration failed.") from self._error
+
+            try:
+                return self._queue.get(timeout=0.1)
+
+            except queue.Empty:
+                if not self._thread.is_alive() and self._error is None:
+                    raise RuntimeError("the pool is already closed.")
+
+    def close(self) -> None:
+        """Stop the worker thread and drop the prepared configurations."""
+        self._stop.set()
+        while not self._queue.empty():
+            self._queue.get_nowait()
+
+        self._thread.join()
+
+    def _worker(self) -> None:
+        """Prepare configurations until the pool is closed."""
+        rng = np.random.RandomState(self._seed)
+        try:
+            while not self._stop.is_set():
+                arrays = self._env.initial_arrays(rng)
+                grid, agents = self._env.build_grid(arrays)
+
+                # same element type as in create_shuffled_agent_list
+                y, x = np.nonzero(arrays.kind)
+                perm = rng.permutation(len(y))
+                order = deque(zip(y[perm], x[perm]))
+
+                while not self._stop.is_set():
+                    try:
+                        self._queue.put((grid, agents, order), timeout=0.1)
+                        break
+
+                    except queue.Full:
+                        continue
+
+        except Exception as e:  # handed over to the main thread
+            self._error = e
@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+
+"""Evaluate trained oriented policies on large grids for many seeds."""
+
+import os
+
+import yaml
+import numpy as np
+import argparse as ap
+
+# make sure that the path to Imazalil/actor-critic is in $PYTHONPATH
+from agents import OrientedPredator, OrientedPrey
+import environment as Environment  # init needs to be called
+import actor_critic as ac  # init needs to be called
+import evaluation as ev
+import kernels
+from tools import timestamp
+
+# setup argparse options ------------------------------------------------------
+parser = ap.ArgumentParser(description="Command line options for the evaluation script.")
+parser.add_argument("--checkpoint", type=str, default="",
+                    help="evaluate the policies of the given state")
+parser.add_argument("--config", type=str, default="simulation_oriented_config.yml",
+                    help="load the specified configuration file")
+
+
+# load Args
+args = parser.parse_args()
+
+# load config files
+with open(args.config, "r") as ymlfile:
+    cfg = yaml.load(ymlfile)
+
+ecfg = cfg['Evaluation']
+checkpoint = args.checkpoint or ecfg['checkpoint']  # cmd line arg > cfg arg
+if not checkpoint:
+    raise ValueError("No checkpoint to evaluate was given.")
+
+# the policies only run on the cpu, without gradients
+ac.init(mode='cpu', goal="testing", policy_kind=cfg['Network']['kind'])
+Environment.init(goal="testing", policy_kind=cfg['Network']['kind'])
+
+if __name__ == '__main__':
+    # the evaluation performs the actions with the kernel, make sure it
+    # follows the rules of the training environment
+    if ecfg.get('check_kernel', True):
+        env = Environment.GridOrientedPPM(agent_types=(OrientedPredator,
+                                                       OrientedPrey),
+                                          **cfg['Model'])
+        env.create_shuffled_agent_list()
+        if not kernels.check_against_env(env):
+            raise RuntimeError("The action kernel doesn't reproduce "
+                               "GridOrientedPPM.act, not evaluating.")
+
+        print(": [eval] The action kernel reproduces GridOrientedPPM.act")
+
+    seeds = ecfg.get('first_seed', 0) + np.arange(ecfg['seeds'])
+    print(": [eval] Evaluating {} on {} for {} seeds and {} timesteps..."
+          "".format(checkpoint, ecfg['dim'], len(seeds), ecfg['steps']))
+
+    results = ev.evaluate_seeds(checkpoint=checkpoint, model=cfg['Model'],
+                                network=cfg['Network'], seeds=seeds,
+                                steps=ecfg['steps'], dim=ecfg['dim'],
+                                processes=ecfg.get('processes') or None,
+                                batch_size=ecfg.get('batch_size', 65536),
+                                backend=ecfg.get('backend', "python"))
+
+    survival = ev.survival_statistics(results['populations'])
+    oscillation = ev.oscillation_statistics(results['populations'],
+                                            burn_in=ecfg.get('burn_in', 0))
+
+    print(": [eval] Survived: {:.0%} of the seeds".format(survival['survived']))
+    for i, kin in enumerate(ev.KINS):
+        extinct = survival['extinction'][:, i]
+        print(":: {}: died out in {} of {} seeds".format(kin, np.sum(extinct >= 0),
+                                                        len(seeds)))
+        periods = oscillation['period'][:, i]
+        if np.any(np.isfinite(periods)):
+            print(":: {}: period {:.1f}, amplitude {:.3f}"
+                  "".format(kin, np.nanmean(periods),
+                            np.nanmean(oscillation['amplitude'][:, i])))
+
+    filepath = ecfg['save_to']
+    os.makedirs(filepath, exist_ok=True)
+    filename = os.path.join(filepath, "evaluation_" + timestamp() + ".npz")
+    np.savez_compressed(filename, **results, **survival, **oscillation)
+    print(": [eval] Statistics saved to {}".format(filename))
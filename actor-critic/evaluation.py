@@ -0,0 +1,443 @@
+"""This file provides an inference only evaluation of trained policies on large grids.
+
+The GridOrientedPPM keeps an object per agent and asks the policy for every
+agent on its own, which is needed for training but far too slow to evaluate
+a policy on e.g. a 512x512 grid. The EvaluationGrid keeps the grid as
+GridArrays and performs the actions with the `kernels.ActionKernel`, which
+is checked against GridOrientedPPM.act (see `kernels.check_against_env`),
+so the rules only exist once in array form. The policies are evaluated once
+per timestep for all agents of a kin, in batches and without gradients.
+Nothing is stored per agent, every timestep only yields the populations and
+the chosen actions per kin.
+
+The actions are chosen from the states at the beginning of the timestep and
+then performed one agent after the other in a random order, agents that
+were eaten before their turn don't act. In the training environment each
+agent sees the grid right before its turn instead.
+
+`evaluate_seeds` runs several seeds in worker processes and collects the
+population series, from which `survival_statistics` and
+`oscillation_statistics` are computed.
+"""
+
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, Iterator
+
+import random
+
+import numpy as np
+import torch
+from torch.distributions import Categorical
+
+import actor_critic as ac
+from environment import GridArrays, GridOrientedPPM
+import kernels
+from kernels import ActionKernel
+
+# the statistics of a single timestep, populations and actions are ordered
+# as KINS, actions holds the number of times each action was performed
+StepStatistics = namedtuple('StepStatistics', ('timestep', 'populations',
+                                               'actions'))
+
+# the kins of the oriented PPM, in the order of the densities
+KINS = ("OrientedPredator", "OrientedPrey")
+
+# the index into GridOrientedPPM._FRONT of an orientation (dy + 1, dx + 1)
+_ORIENT_INDEX = np.zeros((3, 3), dtype=np.intp)
+for _i, (_dy, _dx) in enumerate(GridOrientedPPM._FRONT):
+    _ORIENT_INDEX[_dy + 1, _dx + 1] = _i
+
+
+def load_policies(*, checkpoint, layers: dict, kind: str='fc',
+                  shared_trunk: bool=False) -> dict:
+    """Return the policies stored in checkpoint as dict kin -> model in eval mode.
+
+    checkpoint is a filename or a loaded dict of the actor-critic simulation
+    with 'PredatorState' and 'PreyState'. kind and layers are the ones of the
+    Network section in the config, shared_trunk is set if the checkpoint
+    holds the views of a MultiHeadPolicy.
+    """
+    if isinstance(checkpoint, str):
+        checkpoint = torch.load(checkpoint, map_location='cpu',
+                                weights_only=False)
+
+    keys = {"OrientedPredator": 'PredatorState', "OrientedPrey": 'PreyState'}
+    policies = {}
+    if shared_trunk:
+        shared = ac.MultiHeadPolicy(kins=KINS, **layers)
+
+    for kin in KINS:
+        if shared_trunk:
+            model = shared.for_kin(kin)
+
+        else:
+            model = (ac.ConvPolicy if kind == 'conv' else ac.Policy)(**layers)
+
+        model.load_state_dict(checkpoint[keys[kin]])
+        policies[kin] = model.eval()
+
+    return policies
+
+
+class EvaluationGrid:
+    """An array backed version of the GridOrientedPPM for evaluating policies.
+
+    It has the following attributes:
+        - dim, the dimensions of the (periodic) grid
+        - view, the agents' view of the grid, e.g. (7, 7)
+        - kind, the kind of the policies, 'fc' or 'conv'
+        - timestep, the number of timesteps since the last reset
+        - populations, the number of predators and preys
+
+    The grid is a GridArrays, i.e. one plane per agent attribute, and the
+    actions are performed by a `kernels.ActionKernel` with the given backend.
+    densities, metabolism and the agent parameters are the ones of the Model
+    section in the config. The grid is populated and the agents are shuffled
+    with the grid's own RandomState, seeded with seed; the rolls of the
+    kernel come from `random` and numpy's global state (or numba's, see
+    `kernels.seed`).
+    """
+
+    # slots -------------------------------------------------------------------
+    __slots__ = ['_dim', '_view', '_kind_policy', '_densities', '_params',
+                 '_batch_size', '_mask_actions', '_rng', '_kernel', '_arrays',
+                 '_timestep']
+
+    # init --------------------------------------------------------------------
+    def __init__(self, *, dim: tuple, densities: tuple, metabolism: dict,
+                 view: tuple=(7, 7), kind: str='fc', food_reserve: float=3,
+                 max_food_reserve: float=None, p_breed: float=1.0,
+                 p_eat: float=1.0, p_flee: float=0.0, mortality: bool=True,
+                 instadeath: float=0.0, batch_size: int=65536,
+                 mask_actions: bool=False, backend: str="python",
+                 seed: int=None, **unused_kwargs):
+        """Initialise and populate the grid.
+
+        Further keys of the Model section, e.g. rewards, are ignored.
+        """
+        if not isinstance(batch_size, int) or batch_size < 1:
+            raise ValueError("batch_size must be a positive int, but {} was "
+                             "given.".format(batch_size))
+
+        if kind not in ('fc', 'conv'):
+            raise ValueError("kind must be 'fc' or 'conv', but {} was given."
+                             "".format(kind))
+
+        self._dim = tuple(dim)
+        self._view = tuple(view)
+        self._kind_policy = kind
+        self._densities = tuple(densities)
+        self._batch_size = batch_size
+        self._mask_actions = mask_actions
+        self._rng = np.random.RandomState(seed)
+
+        # the parameters per kin, in the order of KINS
+        self._params = {'fast': tuple(metabolism[k]['fast'] for k in KINS),
+                        'exhaust': tuple(metabolism[k]['exhaust'] for k in KINS),
+                        'p_breed': p_breed, 'p_eat': p_eat, 'p_flee': p_flee,
+                        'food_reserve': food_reserve, 'mortality': mortality}
+        self._kernel = ActionKernel(metabolism={k: metabolism[k] for k in KINS},
+                                    rewards=GridOrientedPPM.REWARDS,
+                                    max_food_reserve=max_food_reserve,
+                                    backend=backend, mortality=mortality,
+                                    instadeath=instadeath)
+
+        self.reset()
+
+    # properties --------------------------------------------------------------
+    @property
+    def dim(self) -> tuple:
+        """Return the dimensions of the grid."""
+        return self._dim
+
+    @property
+    def view(self) -> tuple:
+        """Return the agents' view of the grid."""
+        return self._view
+
+    @property
+    def kind(self) -> str:
+        """Return the kind of the policies, 'fc' or 'conv'."""
+        return self._kind_policy
+
+    @property
+    def timestep(self) -> int:
+        """Return the number of timesteps since the last reset."""
+        return self._timestep
+
+    @property
+    def populations(self) -> np.ndarray:
+        """Return the number of predators and preys."""
+        return np.array([np.count_nonzero(self._arrays.kind == -1),
+                         np.count_nonzero(self._arrays.kind == 1)])
+
+    # methods -----------------------------------------------------------------
+    def reset(self) -> None:
+        """Populate the grid anew, like GridOrientedPPM.initial_arrays."""
+        p = self._params
+        max_pop = int(np.prod(self._dim))
+        num_agents = (np.array(self._densities) * max_pop).astype(int)
+        n = num_agents.sum()
+        cells = self._rng.permutation(max_pop)[:n]
+        fields = {'kind': np.repeat([-1, 1], num_agents).astype(np.int8),
+                  'food': np.full(n, p['food_reserve'], dtype=np.float32),
+                  'orient': GridOrientedPPM._FRONT[self._rng.randint(4, size=n)].astype(np.int8),
+                  'generation': np.zeros(n, dtype=np.int32),
+                  'p_breed': np.full(n, p['p_breed'], dtype=np.float32),
+                  'p_eat': np.full(n, p['p_eat'], dtype=np.float32),
+                  'p_flee': np.full(n, p['p_flee'], dtype=np.float32)}
+
+        planes = {}
+        for k, v in fields.items():
+            plane = np.zeros((max_pop,) + v.shape[1:], dtype=v.dtype)
+            plane[cells] = v
+            planes[k] = plane.reshape(self._dim + v.shape[1:])
+
+        self._arrays = GridArrays(**planes)
+        self._timestep = 0
+
+    def from_arrays(self, arrays: GridArrays) -> None:
+        """Replace the grid with (a copy of) the one described by arrays, e.g. from env.to_arrays."""
+        if arrays.kind.shape != self._dim:
+            raise ValueError("arrays of shape {} don't fit the grid of shape"
+                             " {}.".format(arrays.kind.shape, self._dim))
+
+        self._arrays = GridArrays(*[np.array(plane) for plane in arrays])
+        self._timestep = 0
+
+    def states(self, cells: np.ndarray) -> tuple:
+        """Return the views (N, *view) and sides (N, 2) of the agents in cells.
+
+        cells are flat indices into the grid. These are the states of
+        GridOrientedPPM.index_to_state: the kinds around the agent and its
+        food reserve and orientation float.
+        """
+        vy, vx = self._view
+        kind = self._arrays.kind
+        padded = np.pad(kind, ((vy // 2, vy - 1 - vy // 2),
+                               (vx // 2, vx - 1 - vx // 2)), mode='wrap')
+        windows = np.lib.stride_tricks.sliding_window_view(padded, self._view)
+        y, x = np.divmod(cells, self._dim[1])
+
+        oy, ox = self._arrays.orient[y, x].T.astype(np.intp)
+        orient = _ORIENT_INDEX[oy + 1, ox + 1]
+        sides = np.stack([self._arrays.food[y, x], orient / 4], axis=-1)
+        return windows[y, x].astype(np.float32), sides.astype(np.float32)
+
+    def action_masks(self, cells: np.ndarray, k: int) -> np.ndarray:
+        """Return the mask (N, 8) of the valid actions of the agents of KINS[k] in cells.
+
+        Same as GridOrientedPPM.action_masks, but read from the grid.
+        """
+        front = self.kind_in_front(cells)
+        mask = np.ones((len(cells), 8), dtype=bool)
+        mask[:, 4] = front == 0  # move
+        if k == 1:
+            mask[:, 6] = front == 0  # eat forward
+
+        else:
+            mask[:, 5] = False  # predators can't eat on the spot
+            mask[:, 6] = front == 1  # only preys
+
+        food = self._arrays.food.reshape(-1)[cells]
+        mask[:, 7] = (front == 0) & (food > self._params['exhaust'][k])
+        return mask
+
+    def kind_in_front(self, cells: np.ndarray) -> np.ndarray:
+        """Return the kind in the cell in front of the agents in cells."""
+        y, x = np.divmod(cells, self._dim[1])
+        dy, dx = self._arrays.orient[y, x].T
+        return self._arrays.kind[(y + dy) % self._dim[0], (x + dx) % self._dim[1]]
+
+    def select_actions(self, *, model: Callable, cells: np.ndarray,
+                       k: int) -> np.ndarray:
+        """Sample the actions of the agents of KINS[k] in cells from model.
+
+        The policy is evaluated without gradients, in batches of at most
+        batch_size states.
+        """
+        views, sides = self.states(cells)
+        masks = self.action_masks(cells, k) if self._mask_actions else None
+        actions = np.empty(len(cells), dtype=np.int64)
+        with torch.no_grad():
+            for start in range(0, len(cells), self._batch_size):
+                stop = start + self._batch_size
+                v = torch.from_numpy(views[start:stop])
+                s = torch.from_numpy(sides[start:stop])
+                n = len(v)
+                if self._kind_policy == 'conv':
+                    probs, _ = model((v.view(n, 1, *self._view), s))
+
+                else:
+                    probs, _ = model(torch.cat([v.view(n, -1), s], -1))
+
+                probs = probs.view(n, -1)
+                if masks is not None:
+                    probs = ac._mask_probs(probs, masks[start:stop])
+
+                actions[start:stop] = Categorical(probs).sample().numpy()
+
+        return actions
+
+    def step(self, *, policy: dict) -> StepStatistics:
+        """Let every agent act once and return the statistics of the timestep.
+
+        policy is a dict with the kins as keys and the models as values, e.g.
+        from `load_policies`. All agents lose their food first, starving and
+        instadeath happen at the agent's turn in the kernel, like in
+        GridOrientedPPM.step.
+        """
+        self._timestep += 1
+        cells = np.flatnonzero(self._arrays.kind)
+        self._rng.shuffle(cells)
+        food = self._arrays.food.reshape(-1)
+        k = (self._arrays.kind.reshape(-1)[cells] > 0).astype(np.intp)  # index into KINS
+
+        if self._params['mortality']:
+            food[cells] -= np.array(self._params['fast'])[k]
+            hungry = food[cells] <= 0  # these starve and don't choose
+
+        else:
+            hungry = np.zeros(len(cells), dtype=bool)
+
+        actions = np.full(len(cells), 3, dtype=np.int64)  # never performed
+        for i, kin in enumerate(KINS):
+            choose = np.flatnonzero((k == i) & ~hungry)
+            if len(choose):
+                actions[choose] = self.select_actions(model=policy[kin],
+                                                      cells=cells[choose], k=i)
+
+        indices = np.stack(np.divmod(cells, self._dim[1]), axis=-1)
+        acted = self._kernel(self._arrays, indices, actions).acted
+
+        counts = np.stack([np.bincount(actions[acted & (k == i)], minlength=8)
+                           for i in range(len(KINS))])
+        return StepStatistics(self._timestep, self.populations, counts)
+
+    def run(self, *, policy: dict, steps: int) -> Iterator[StepStatistics]:
+        """Yield the statistics of up to steps timesteps.
+
+        The run stops after the timestep in which a kin died out.
+        """
+        for _ in range(steps):
+            stats = self.step(policy=policy)
+            yield stats
+
+            if not np.all(stats.populations):
+                break
+
+
+# parallel evaluation ---------------------------------------------------------
+_worker_policies = None  # the policies of a worker process
+
+
+def _init_worker(checkpoint, network: dict) -> None:
+    """Load the policies once per worker process, with a single thread."""
+    global _worker_policies
+    torch.set_num_threads(1)
+    _worker_policies = load_policies(checkpoint=checkpoint,
+                                     layers=network['layers'],
+                                     kind=network['kind'],
+                                     shared_trunk=network.get('shared_trunk', False))
+
+
+def _evaluate_seed(seed: int, grid_kwargs: dict, steps: int) -> tuple:
+    """Run one evaluation with seed and return its populations and action counts."""
+    torch.manual_seed(seed)
+    random.seed(int(seed))  # the rolls of the kernel
+    np.random.seed(seed)
+    if grid_kwargs.get('backend') == "numba":
+        kernels.seed(int(seed))
+
+    grid = EvaluationGrid(seed=seed, **grid_kwargs)
+    populations = np.zeros((steps + 1, len(KINS)), dtype=np.int64)
+    populations[0] = grid.populations
+    actions = np.zeros((len(KINS), 8), dtype=np.int64)
+    for stats in grid.run(policy=_worker_policies, steps=steps):
+        populations[stats.timestep] = stats.populations
+        actions += stats.actions
+
+    populations[grid.timestep + 1:] = populations[grid.timestep]  # died out
+    return populations, actions
+
+
+def evaluate_seeds(*, checkpoint, model: dict, network: dict, seeds,
+                   steps: int, dim: tuple=None, processes: int=None,
+                   batch_size: int=65536, backend: str="python") -> dict:
+    """Evaluate the policies of checkpoint on one grid per seed in worker processes.
+
+    model and network are the Model and Network sections of the config, dim
+    overrides the dimensions of the grid, backend is the one of the action
+    kernel. Return a dict with
+        - seeds, the seeds
+        - populations, (seeds, steps + 1, kins); the populations at the
+            extinction of a kin are kept until the end
+        - actions, (seeds, kins, 8) the performed actions over all timesteps
+    """
+    grid_kwargs = dict(model)
+    grid_kwargs.update(dim=tuple(dim or model['dim']), kind=network['kind'],
+                       batch_size=batch_size, backend=backend,
+                       mask_actions=network.get('mask_actions', False))
+
+    seeds = list(seeds)
+    with ProcessPoolExecutor(max_workers=processes, initializer=_init_worker,
+                             initargs=(checkpoint, network)) as pool:
+        futures = [pool.submit(_evaluate_seed, seed, grid_kwargs, steps)
+                   for seed in seeds]
+        results = []
+        for seed, f in zip(seeds, futures):
+            results.append(f.result())
+            print(": [eval] seed {} done.".format(seed))
+
+    return {'seeds': np.array(seeds),
+            'populations': np.stack([r[0] for r in results]),
+            'actions': np.stack([r[1] for r in results])}
+
+
+# statistics ------------------------------------------------------------------
+def survival_statistics(populations: np.ndarray) -> dict:
+    """Return the survival statistics of the population series (seeds, steps + 1, kins).
+
+    extinction holds the first timestep at which each kin was gone, or -1 if
+    it survived, survived the fraction of the seeds in which all kins
+    survived.
+    """
+    gone = populations == 0
+    extinction = np.where(gone.any(axis=1), gone.argmax(axis=1), -1)
+    return {'extinction': extinction,
+            'survived': np.mean(np.all(extinction < 0, axis=-1))}
+
+
+def oscillation_statistics(populations: np.ndarray, burn_in: int=0) -> dict:
+    """Return the oscillation statistics of the population series (seeds, steps + 1, kins).
+
+    Only the timesteps after burn_in are used and series in which a kin
+    died out are NaN. For every seed and kin:
+        - period, the period of the dominant frequency of the spectrum
+        - amplitude, the standard deviation relative to the mean
+    lag is the shift of the predators behind the preys with the largest
+    cross-correlation, within one period of the preys.
+    """
+    series = populations[:, burn_in:].astype(float)
+    n_seeds, n, n_kins = series.shape
+    period = np.full((n_seeds, n_kins), np.nan)
+    amplitude = np.full((n_seeds, n_kins), np.nan)
+    lag = np.full(n_seeds, np.nan)
+
+    for s in range(n_seeds):
+        if n < 4 or not np.all(series[s]):
+            continue
+
+        mean = series[s].mean(axis=0)
+        dev = series[s] - mean
+        amplitude[s] = dev.std(axis=0) / mean
+        spectrum = np.abs(np.fft.rfft(dev, axis=0))[1:]  # without the mean
+        period[s] = n / (spectrum.argmax(axis=0) + 1)
+
+        prey, pred = dev[:, 1], dev[:, 0]
+        shifts = np.arange(max(1, min(int(period[s, 1]), n - 1)))
+        corr = [np.dot(prey[:n - d], pred[d:]) for d in shifts]
+        lag[s] = shifts[int(np.argmax(corr))]
+
+    return {'period': period, 'amplitude': amplitude, 'lag': lag}
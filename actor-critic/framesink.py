@@ -0,0 +1,231 @@
+"""This file provides fast rendering of the grid to videos or compressed frame archives."""
+
+import io
+import shutil
+import zipfile
+import subprocess as sp
+
+import numpy as np
+import matplotlib.colors as mcolors
+from typing import Iterator
+
+# colours of the kind plane: predator (-1), empty (0), prey (1), same as render
+COLOURS = ('#1f77b4', 'white', '#ff7f0e')  # blue, white, orange
+
+# orientations (Y, X) in the order of their stencil
+ORIENTS = ((-1, 0), (0, 1), (1, 0), (0, -1))
+
+
+def _palette(colours: tuple) -> np.ndarray:
+    """Convert matplotlib colours to an uint8 RGB palette."""
+    return (255 * np.array([mcolors.to_rgb(c) for c in colours])).astype(np.uint8)
+
+
+def _arrow_stencils(scale: int) -> np.ndarray:
+    """Return boolean (5, scale, scale) masks, a line from the cell centre in each orientation.
+
+    The fifth stencil is empty and used for empty cells.
+    """
+    stencils = np.zeros((len(ORIENTS) + 1, scale, scale), dtype=bool)
+    centre = (scale - 1) / 2
+    steps = np.linspace(0, scale / 2, 2 * scale)
+    for i, (dy, dx) in enumerate(ORIENTS):
+        py = np.clip(np.rint(centre + dy * steps), 0, scale - 1).astype(int)
+        px = np.clip(np.rint(centre + dx * steps), 0, scale - 1).astype(int)
+        stencils[i, py, px] = True
+
+    return stencils
+
+
+def orient_codes(orient: np.ndarray) -> np.ndarray:
+    """Map a (..., 2) orientation array to indices of ORIENTS, 4 for (0, 0)."""
+    codes = np.full(orient.shape[:-1], len(ORIENTS), dtype=np.uint8)
+    for i, (dy, dx) in enumerate(ORIENTS):
+        codes[(orient[..., 0] == dy) & (orient[..., 1] == dx)] = i
+
+    return codes
+
+
+class Rasterizer:
+    """Turn the kind and orientation planes of a grid into RGB frames.
+
+    Every cell becomes a `scale` x `scale` block in the colour of its kind,
+    with a line in `arrowcolour` pointing in the orientation of the agent.
+    Everything is done with numpy, there is no figure involved.
+    """
+
+    # slots -------------------------------------------------------------------
+    __slots__ = ['_scale', '_palette', '_arrow', '_stencils']
+
+    # init --------------------------------------------------------------------
+    def __init__(self, *, scale: int=8, colours: tuple=COLOURS,
+                 arrowcolour: str='r'):
+        """Initialise the palette and the orientation stencils."""
+        if not isinstance(scale, int) or scale < 1:
+            raise ValueError("scale must be a positive int, but {} was given."
+                             "".format(scale))
+
+        self._scale = scale
+        self._palette = _palette(colours)
+        self._arrow = _palette((arrowcolour,))[0]
+        # with a scale below 3 there is no space for an arrow
+        self._stencils = _arrow_stencils(scale) if scale > 2 else None
+
+    # properties --------------------------------------------------------------
+    @property
+    def scale(self) -> int:
+        """Return the number of pixels per cell and dimension."""
+        return self._scale
+
+    # methods -----------------------------------------------------------------
+    def shape(self, dim: tuple) -> tuple:
+        """Return the (height, width) of the frames for a grid of shape dim."""
+        return dim[0] * self._scale, dim[1] * self._scale
+
+    def __call__(self, kind: np.ndarray, orient: np.ndarray) -> np.ndarray:
+        """Return the frame of the given planes as (H*scale, W*scale, 3) uint8 array."""
+        s = self._scale
+        h, w = kind.shape
+        frame = self._palette[kind.astype(np.intp) + 1]  # (H, W, 3)
+        frame = np.repeat(np.repeat(frame, s, axis=0), s, axis=1)
+
+        if self._stencils is not None:
+            codes = orient_codes(orient)
+            codes[kind == 0] = len(ORIENTS)  # no arrows for empty cells
+            mask = self._stencils[codes]  # (H, W, s, s)
+            mask = mask.transpose(0, 2, 1, 3).reshape(h * s, w * s)
+            frame[mask] = self._arrow
+
+        return frame
+
+
+class FFmpegSink:
+    """Pipe frames directly into an ffmpeg subprocess that encodes a video."""
+
+    # slots -------------------------------------------------------------------
+    __slots__ = ['_filename', '_rasterize', '_proc', '_shape', '_fps',
+                 '_codec']
+
+    # init --------------------------------------------------------------------
+    def __init__(self, *, filename: str, rasterizer: Rasterizer, fps: int=25,
+                 codec: str="libx264"):
+        """Initialise the sink, ffmpeg is started with the first frame."""
+        if shutil.which("ffmpeg") is None:
+            raise RuntimeError("ffmpeg was not found, use the 'archive' render"
+                               " mode instead.")
+
+        self._filename = filename
+        self._rasterize = rasterizer
+        self._fps = fps
+        self._shape = None
+        self._proc = None
+        self._codec = codec
+
+    @property
+    def filename(self) -> str:
+        """Return the filename of the video."""
+        return self._filename
+
+    def _open(self, shape: tuple) -> None:
+        """Start ffmpeg for frames of the given (height, width)."""
+        h, w = shape
+        cmd = ["ffmpeg", "-loglevel", "error", "-y",
+               "-f", "rawvideo", "-pix_fmt", "rgb24",
+               "-s", "{}x{}".format(w, h), "-r", str(self._fps), "-i", "-",
+               "-c:v", self._codec, "-pix_fmt", "yuv420p",
+               # yuv420p needs even dimensions
+               "-vf", "pad=ceil(iw/2)*2:ceil(ih/2)*2",
+               self._filename]
+        self._proc = sp.Popen(cmd, stdin=sp.PIPE)
+        self._shape = shape
+
+    def write(self, kind: np.ndarray, orient: np.ndarray) -> None:
+        """Rasterise the planes and send the frame to ffmpeg."""
+        frame = self._rasterize(kind, orient)
+        if self._proc is None:
+            self._open(frame.shape[:2])
+
+        elif frame.shape[:2] != self._shape:
+            raise ValueError("frame shape changed from {} to {}."
+                             "".format(self._shape, frame.shape[:2]))
+
+        self._proc.stdin.write(np.ascontiguousarray(frame).tobytes())
+
+    def close(self) -> None:
+        """Finish the video."""
+        if self._proc is not None:
+            self._proc.stdin.close()
+            if self._proc.wait() != 0:
+                raise RuntimeError("ffmpeg exited with code {} while writing"
+                                   " {}.".format(self._proc.returncode,
+                                                 self._filename))
+            self._proc = None
+
+
+class ArchiveSink:
+    """Stream the kind and orientation planes into a compressed archive.
+
+    The archive is a zip file of .npy entries 'kind_<n>' and 'orient_<n>',
+    thus it can be opened with `np.load` and rendered later, see
+    `read_archive`. The frames are written one by one, so nothing is kept in
+    memory.
+    """
+
+    # slots -------------------------------------------------------------------
+    __slots__ = ['_filename', '_zip', '_frames']
+
+    # init --------------------------------------------------------------------
+    def __init__(self, *, filename: str):
+        """Open the archive for writing."""
+        self._filename = filename
+        self._zip = zipfile.ZipFile(filename, mode="w",
+                                    compression=zipfile.ZIP_DEFLATED)
+        self._frames = 0
+
+    @property
+    def filename(self) -> str:
+        """Return the filename of the archive."""
+        return self._filename
+
+    def _add(self, name: str, arr: np.ndarray) -> None:
+        """Add a single array as .npy entry."""
+        buf = io.BytesIO()
+        np.save(buf, arr)
+        self._zip.writestr(name + ".npy", buf.getvalue())
+
+    def write(self, kind: np.ndarray, orient: np.ndarray) -> None:
+        """Add the planes of a single frame to the archive."""
+        self._add("kind_{:0>6}".format(self._frames), kind.astype(np.int8))
+        self._add("orient_{:0>6}".format(self._frames), orient.astype(np.int8))
+        self._frames += 1
+
+    def close(self) -> None:
+        """Close the archive."""
+        self._zip.close()
+
+
+def read_archive(filename: str) -> Iterator[tuple]:
+    """Iterate over the (kind, orient) planes stored in an archive."""
+    with np.load(filename) as arc:
+        n_frames = sum(1 for k in arc.files if k.startswith("kind_"))
+        for i in range(n_frames):
+            yield arc["kind_{:0>6}".format(i)], arc["orient_{:0>6}".format(i)]
+
+
+def open_sink(*, mode: str, filename: str, scale: int=8, fps: int=25,
+              arrowcolour: str='r'):
+    """Return a frame sink for the given render mode ('video' or 'archive').
+
+    The file extension is appended to filename.
+    """
+    if mode == "video":
+        rasterizer = Rasterizer(scale=scale, arrowcolour=arrowcolour)
+        return FFmpegSink(filename=filename + ".mp4", rasterizer=rasterizer,
+                          fps=fps)
+
+    elif mode == "archive":
+        return ArchiveSink(filename=filename + ".npz")
+
+    else:
+        raise ValueError("Unknown render mode '{}', use 'video' or 'archive'"
+                         ".".format(mode))
@@ -0,0 +1,407 @@
+"""This file provides an array based implementation of the oriented action set.
+
+The kernel works directly on the planes of `environment.GridArrays` instead of
+agent objects and applies the actions of a whole batch of agents in their
+scheduled order. The action ids are the same as in GridOrientedPPM:
+
+    0: turn left, 1: turn right, 2: turn around, 3: stand still, 4: move,
+    5: eat on the spot, 6: eat forward, 7: procreate
+
+The same core function runs either as plain python ('python' backend) or
+compiled with numba ('numba' backend, only if numba is installed). The
+python backend draws its random numbers exactly like the closures of
+GridOrientedPPM (`random.random` for p_eat/p_breed rolls, `random.randrange`
+and `np.random.shuffle` for the orientation of newborns), thus it gives the
+same results on the same RNG stream. Numba has its own random number
+generator, so the numba backend is deterministic for a fixed numba seed
+(see `seed`) but doesn't follow the stream of `random`/`numpy`.
+
+Optionally, the kernel also lets the agents starve or die of instadeath at
+their turn, like GridOrientedPPM.step; the food reserves have to be reduced
+by the metabolism beforehand. `check_against_env` compares the python
+backend with GridOrientedPPM.act on the same RNG stream.
+"""
+
+import random
+
+import numpy as np
+from collections import namedtuple
+
+from environment import GridArrays
+
+try:
+    import numba
+    from numba.extending import register_jitable
+except ImportError:  # numba is optional
+    numba = None
+
+    def register_jitable(func):
+        """Stand-in for numba's register_jitable, just returns func."""
+        return func
+
+# the outcome of applying a batch of actions
+KernelResult = namedtuple('KernelResult', ('rewards', 'eaten', 'eaten_cells',
+                                           'births', 'acted'))
+
+# order of the rewards passed to the core function
+REWARD_KEYS = ('wrong_action', 'default_prey', 'default_predator',
+               'succesful_predator', 'offspring', 'indifferent', 'default',
+               'death_prey', 'death_starvation', 'instadeath')
+(_WRONG, _PREY, _PRED, _SUCCESS, _OFFSPRING, _INDIFF, _DEFAULT,
+ _DEATH, _STARVED, _INSTADEATH) = range(len(REWARD_KEYS))
+
+# number of actions of the oriented action set
+N_ACTIONS = 8
+
+
+@register_jitable
+def _move_cell(kind, food, orient, gen, p_breed, p_eat, p_flee, sy, sx, ty,
+               tx):
+    """Move the contents of cell (sy, sx) to (ty, tx) and clear the source."""
+    kind[ty, tx] = kind[sy, sx]
+    food[ty, tx] = food[sy, sx]
+    orient[ty, tx, 0] = orient[sy, sx, 0]
+    orient[ty, tx, 1] = orient[sy, sx, 1]
+    gen[ty, tx] = gen[sy, sx]
+    p_breed[ty, tx] = p_breed[sy, sx]
+    p_eat[ty, tx] = p_eat[sy, sx]
+    p_flee[ty, tx] = p_flee[sy, sx]
+    _clear_cell(kind, food, orient, gen, p_breed, p_eat, p_flee, sy, sx)
+
+
+@register_jitable
+def _clear_cell(kind, food, orient, gen, p_breed, p_eat, p_flee, y, x):
+    """Set every plane of cell (y, x) to 0."""
+    kind[y, x] = 0
+    food[y, x] = 0
+    orient[y, x, 0] = 0
+    orient[y, x, 1] = 0
+    gen[y, x] = 0
+    p_breed[y, x] = 0
+    p_eat[y, x] = 0
+    p_flee[y, x] = 0
+
+
+def _apply(kind, food, orient, gen, p_breed, p_eat, p_flee, indices, actions,
+           satiety, exhaust, max_food, mortality, instadeath, reward_values,
+           rewards, eaten, eaten_cells, acted):
+    """Apply the actions of all agents at indices in order, see module docstring.
+
+    satiety and exhaust are indexed with 0 for predators and 1 for prey.
+    With mortality, agents without food reserve starve at their turn, with
+    instadeath > 0, predators die with that probability at their turn, as
+    long as they aren't the last one.
+    Fills rewards, eaten, eaten_cells and acted and returns (number of eaten
+    prey, number of births).
+    """
+    H, W = kind.shape
+    n = indices.shape[0]
+
+    # batch position of the agent starting in a cell, to skip eaten agents
+    slot = np.full((H, W), -1, dtype=np.int64)
+    for i in range(n):
+        slot[indices[i, 0], indices[i, 1]] = i
+
+    n_eaten = 0
+    n_births = 0
+    n_pred = np.sum(kind < 0)  # for instadeath
+    new_orient = np.zeros(2, dtype=np.int64)
+
+    for i in range(n):
+        if eaten[i]:  # got eaten by an agent earlier in the schedule
+            rewards[i] = reward_values[_DEATH]
+            continue
+
+        y = indices[i, 0]
+        x = indices[i, 1]
+        k = kind[y, x]
+        if k == 0:  # nothing to do for empty cells
+            rewards[i] = reward_values[_INDIFF]
+            continue
+
+        kin = 0 if k < 0 else 1  # 0: predator, 1: prey
+        if mortality and food[y, x] <= 0:  # starved
+            _clear_cell(kind, food, orient, gen, p_breed, p_eat, p_flee, y, x)
+            n_pred -= 1 - kin
+            rewards[i] = reward_values[_STARVED]
+            continue
+
+        if kin == 0 and instadeath > 0 and n_pred > 1:
+            if random.random() <= instadeath:  # statistical death
+                _clear_cell(kind, food, orient, gen, p_breed, p_eat, p_flee,
+                            y, x)
+                n_pred -= 1
+                rewards[i] = reward_values[_INSTADEATH]
+                continue
+
+        acted[i] = True
+        oy = orient[y, x, 0]
+        ox = orient[y, x, 1]
+        ty = (y + oy) % H
+        tx = (x + ox) % W
+        a = actions[i]
+
+        if a == 0:  # turn left
+            orient[y, x, 0] = -ox
+            orient[y, x, 1] = oy
+            rewards[i] = reward_values[_INDIFF]
+
+        elif a == 1:  # turn right
+            orient[y, x, 0] = ox
+            orient[y, x, 1] = -oy
+            rewards[i] = reward_values[_INDIFF]
+
+        elif a == 2:  # turn around
+            orient[y, x, 0] = -oy
+            orient[y, x, 1] = -ox
+            rewards[i] = reward_values[_INDIFF]
+
+        elif a == 3:  # stand still
+            rewards[i] = reward_values[_INDIFF]
+
+        elif a == 4:  # move forward
+            if kind[ty, tx] != 0:
+                rewards[i] = reward_values[_WRONG]
+            else:
+                _move_cell(kind, food, orient, gen, p_breed, p_eat, p_flee,
+                           y, x, ty, tx)
+                rewards[i] = reward_values[_DEFAULT]
+
+        elif a == 5:  # eat on the spot
+            if kin == 1:
+                food[y, x] = min(food[y, x] + satiety[kin], max_food)
+                rewards[i] = reward_values[_PREY]
+            else:  # predators can't eat on the spot
+                rewards[i] = reward_values[_WRONG]
+
+        elif a == 6:  # eat forward
+            if kin == 1:
+                if kind[ty, tx] != 0:
+                    rewards[i] = reward_values[_WRONG]
+                else:
+                    _move_cell(kind, food, orient, gen, p_breed, p_eat,
+                               p_flee, y, x, ty, tx)
+                    food[ty, tx] = min(food[ty, tx] + satiety[kin], max_food)
+                    rewards[i] = reward_values[_PREY]
+
+            elif kind[ty, tx] <= 0:  # don't eat air or thy own specimen
+                rewards[i] = reward_values[_WRONG]
+
+            elif p_eat[y, x] < 1.0 and random.random() > p_eat[y, x]:
+                rewards[i] = reward_values[_PRED]
+
+            else:  # hunting
+                food[y, x] = min(food[y, x] + satiety[kin], max_food)
+                j = slot[ty, tx]
+                if j > i:
+                    eaten[j] = True  # the prey doesn't get to act anymore
+                eaten_cells[n_eaten, 0] = ty
+                eaten_cells[n_eaten, 1] = tx
+                n_eaten += 1
+                _clear_cell(kind, food, orient, gen, p_breed, p_eat, p_flee,
+                            ty, tx)
+                _move_cell(kind, food, orient, gen, p_breed, p_eat, p_flee,
+                           y, x, ty, tx)
+                rewards[i] = reward_values[_SUCCESS]
+
+        elif a == 7:  # procreate
+            if food[y, x] <= exhaust[kin] or kind[ty, tx] != 0:
+                rewards[i] = reward_values[_WRONG]
+
+            elif p_breed[y, x] < 1.0 and random.random() > p_breed[y, x]:
+                rewards[i] = reward_values[_PRED] if kin == 0 else reward_values[_PREY]
+
+            else:
+                # the orientation of the newborn, as Agent._generate_orient
+                new_orient[0] = (-1, 0, 1)[random.randrange(3)]
+                new_orient[1] = (-1, 1)[random.randrange(2)] if new_orient[0] == 0 else 0
+                np.random.shuffle(new_orient)
+
+                kind[ty, tx] = k
+                food[ty, tx] = min(exhaust[kin], max_food)
+                orient[ty, tx, 0] = new_orient[0]
+                orient[ty, tx, 1] = new_orient[1]
+                gen[ty, tx] = gen[y, x] + 1
+                p_breed[ty, tx] = p_breed[y, x]
+                p_eat[ty, tx] = p_eat[y, x]
+                p_flee[ty, tx] = p_flee[y, x]
+                food[y, x] -= exhaust[kin]
+                n_births += 1
+                n_pred += 1 - kin
+                rewards[i] = reward_values[_OFFSPRING]
+
+        else:
+            rewards[i] = reward_values[_WRONG]  # unknown action
+
+    return n_eaten, n_births
+
+
+# compiled variants, only created if numba is available and when needed
+_compiled = {}
+
+
+def _core(backend: str):
+    """Return the core function for the given backend."""
+    if backend == "python":
+        return _apply
+
+    elif backend == "numba":
+        if numba is None:
+            raise RuntimeError("backend 'numba' was requested, but numba is "
+                               "not installed.")
+
+        if not _compiled:
+            _compiled['apply'] = numba.njit(cache=True)(_apply)
+
+        return _compiled['apply']
+
+    else:
+        raise ValueError("Unknown backend '{}', use 'python' or 'numba'."
+                         "".format(backend))
+
+
+def seed(seed: int) -> None:
+    """Seed the random number generator of the numba backend."""
+    if numba is None:
+        raise RuntimeError("numba is not installed.")
+
+    @numba.njit
+    def _seed(s):
+        random.seed(s)
+        np.random.seed(s)
+
+    _seed(seed)
+
+
+class ActionKernel:
+    """Apply the oriented actions of a batch of agents to GridArrays.
+
+    It has the following attributes:
+        - backend, either 'python' or 'numba'
+        - satiety, exhaust, the metabolism values as array with index 0 for
+            predators and 1 for prey
+        - max_food_reserve, the food reserve is clipped at this value
+        - reward_values, the rewards in the order of REWARD_KEYS
+        - mortality, whether agents without food reserve starve at their turn
+        - instadeath, the probability of a predator to die at its turn
+
+    The planes of the given GridArrays are modified in place. Conflicts are
+    resolved in the scheduled order, i.e. every agent sees the grid as left
+    by the agents before it. Prey that gets eaten before its turn doesn't
+    act and gets the 'death_prey' reward. Without mortality and instadeath,
+    a call is the same as GridOrientedPPM.act for every agent in turn.
+    """
+
+    # slots -------------------------------------------------------------------
+    __slots__ = ['_backend', '_core', 'satiety', 'exhaust', 'max_food_reserve',
+                 'reward_values', 'mortality', 'instadeath']
+
+    # init --------------------------------------------------------------------
+    def __init__(self, *, metabolism: dict, rewards: dict,
+                 max_food_reserve: float, backend: str="python",
+                 mortality: bool=False, instadeath: float=0.0):
+        """Initialise the kernel with the metabolism and rewards of an environment."""
+        pred = [v for k, v in metabolism.items() if "Predator" in k]
+        prey = [v for k, v in metabolism.items() if "Prey" in k]
+        if len(pred) != 1 or len(prey) != 1:
+            raise ValueError("metabolism must contain exactly one predator "
+                             "and one prey species, but {} was given."
+                             "".format(list(metabolism.keys())))
+
+        self._backend = backend
+        self._core = _core(backend)
+        self.satiety = np.array([pred[0]['satiety'], prey[0]['satiety']],
+                                dtype=np.float64)
+        self.exhaust = np.array([pred[0]['exhaust'], prey[0]['exhaust']],
+                                dtype=np.float64)
+        self.max_food_reserve = float(max_food_reserve or np.inf)
+        self.reward_values = np.array([rewards[k] for k in REWARD_KEYS],
+                                      dtype=np.float64)
+        self.mortality = bool(mortality)
+        self.instadeath = float(instadeath)
+
+    @classmethod
+    def from_env(cls, env, backend: str="python") -> "ActionKernel":
+        """Create a kernel with the settings of a GridOrientedPPM instance.
+
+        It only performs the actions, like GridOrientedPPM.act.
+        """
+        return cls(metabolism=env.metabolism, rewards=env.REWARDS,
+                   max_food_reserve=env.agent_kwargs['max_food_reserve'],
+                   backend=backend)
+
+    # properties --------------------------------------------------------------
+    @property
+    def backend(self) -> str:
+        """Return the backend of the kernel."""
+        return self._backend
+
+    # methods -----------------------------------------------------------------
+    def __call__(self, arrays: GridArrays, indices: np.ndarray,
+                 actions: np.ndarray) -> KernelResult:
+        """Apply actions[i] for the agent at indices[i], in order.
+
+        indices is a (N, 2) array of (y, x) positions at the beginning of the
+        batch, actions an array of N action ids.
+        """
+        indices = np.ascontiguousarray(indices, dtype=np.int64).reshape(-1, 2)
+        actions = np.ascontiguousarray(actions, dtype=np.int64).ravel()
+        if len(indices) != len(actions):
+            raise ValueError("Got {} indices but {} actions."
+                             "".format(len(indices), len(actions)))
+
+        n = len(actions)
+        rewards = np.zeros(n, dtype=np.float64)
+        eaten = np.zeros(n, dtype=np.bool_)
+        eaten_cells = np.zeros((n, 2), dtype=np.int64)
+        acted = np.zeros(n, dtype=np.bool_)
+
+        n_eaten, n_births = self._core(arrays.kind, arrays.food,
+                                       arrays.orient, arrays.generation,
+                                       arrays.p_breed, arrays.p_eat,
+                                       arrays.p_flee, indices, actions,
+                                       self.satiety, self.exhaust,
+                                       self.max_food_reserve, self.mortality,
+                                       self.instadeath, self.reward_values,
+                                       rewards, eaten, eaten_cells, acted)
+
+        return KernelResult(rewards, eaten, eaten_cells[:n_eaten], n_births,
+                            acted)
+
+
+def check_against_env(env, *, seed: int=0) -> bool:
+    """Return whether the python kernel gives the same grid and rewards as GridOrientedPPM.act.
+
+    Every agent of env gets a random action and acts in the order of the
+    shuffled agent list, once via env.act and once via the kernel on
+    env.to_arrays(), both with `random` and `numpy` seeded with seed. A
+    prey eaten before its turn doesn't act in either. env is restored
+    afterwards, including the states of the random number generators.
+    """
+    snapshot = env.snapshot()
+    try:
+        indices = np.array(env.shuffled_agent_list, dtype=np.int64).reshape(-1, 2)
+        actions = np.random.RandomState(seed).randint(N_ACTIONS, size=len(indices))
+        arrays = env.to_arrays()
+
+        random.seed(seed)
+        np.random.seed(seed)
+        result = ActionKernel.from_env(env)(arrays, indices, actions)
+
+        random.seed(seed)
+        np.random.seed(seed)
+        agents = [env.env[tuple(idx)] for idx in indices]
+        rewards = []
+        for idx, ag, a in zip(map(tuple, indices), agents, actions):
+            if env.env[idx] is not ag:  # eaten before its turn
+                rewards.append(env.REWARDS['death_prey'])
+
+            else:
+                rewards.append(env.act(int(a), idx))
+
+        expected = env.to_arrays()
+        return (np.array_equal(result.rewards, rewards)
+                and all(np.array_equal(a, b) for a, b in zip(arrays, expected)))
+
+    finally:
+        env.restore(snapshot)
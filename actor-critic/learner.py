@@ -0,0 +1,97 @@
+"""This file provides the concurrent optimisation of independent policies.
+
+The prey and predator models, their optimizers and histories don't share
+anything, so their updates can run at the same time. The Learner runs one
+update per kin in a pool of threads; torch releases the GIL in its
+operators, thus the forward and backward passes of the kins overlap. Since
+`submit` returns right away, the next rollout can start while the updates
+are still running.
+
+Note that the intra-op thread pool of torch is global for the process, the
+thread count can't be split between the learner threads. Set the
+`intra_op_threads` such that the rollout and both updates fit the cores.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+
+
+class Learner:
+    """Run the updates of several kins concurrently in background threads.
+
+    It has the following attributes:
+        - workers, the number of threads, i.e. updates running at once
+        - pending, whether there are submitted updates that weren't waited for
+        - running, whether some of the pending updates aren't done yet
+
+    The updates are callables without arguments, e.g. a partial of
+    `finish_episode`, given per kin to `submit`. `wait` blocks until all of
+    them are done and returns their results per kin. Exceptions of an update
+    are raised by `wait` on the calling thread.
+
+    While updates are pending, nothing else may use their models or
+    optimizers, i.e. the rollout has to run on exported copies.
+    """
+
+    # slots -------------------------------------------------------------------
+    __slots__ = ['_workers', '_pool', '_futures']
+
+    # init --------------------------------------------------------------------
+    def __init__(self, *, workers: int=2):
+        """Initialise the learner and its thread pool."""
+        if not isinstance(workers, int) or workers < 1:
+            raise ValueError("workers must be a positive int, but {} was "
+                             "given.".format(workers))
+
+        self._workers = workers
+        self._pool = ThreadPoolExecutor(max_workers=workers,
+                                        thread_name_prefix="Learner")
+        self._futures = {}
+
+    # properties --------------------------------------------------------------
+    @property
+    def workers(self) -> int:
+        """Return the number of learner threads."""
+        return self._workers
+
+    @property
+    def pending(self) -> bool:
+        """Return whether there are updates that weren't waited for."""
+        return bool(self._futures)
+
+    @property
+    def running(self) -> bool:
+        """Return whether there are pending updates that aren't done yet."""
+        return any(not f.done() for f in self._futures.values())
+
+    # methods -----------------------------------------------------------------
+    def submit(self, updates: dict) -> None:
+        """Start the updates, a dict kin -> callable, and return immediately."""
+        if self._pool is None:
+            raise RuntimeError("the learner is already closed.")
+
+        if self._futures:
+            raise RuntimeError("there are still pending updates, wait for them "
+                               "first.")
+
+        self._futures = {kin: self._pool.submit(update)
+                         for kin, update in updates.items()}
+
+    def run(self, updates: dict) -> dict:
+        """Run the updates concurrently and return their results per kin."""
+        self.submit(updates)
+        return self.wait()
+
+    def wait(self) -> dict:
+        """Block until the pending updates are done and return their results per kin."""
+        futures, self._futures = self._futures, {}
+        return {kin: f.result() for kin, f in futures.items()}
+
+    def close(self) -> None:
+        """Wait for the pending updates and stop the threads."""
+        if self._pool is not None:
+            try:
+                self.wait()
+
+            finally:
+                self._pool.shutdown(wait=True)
+                self._pool = None
@@ -0,0 +1,185 @@
+"""This file provides a compact storage for the states in the agents' memories.
+
+A neighbourhood holds only -1 (predator), 0 (empty) and 1 (prey), which fit
+into 2 bits per cell, and the side information (food reserve, orientation)
+takes multiples of 0.25, which float16 stores exactly. Thus a 7x7 view plus
+food reserve and orientation takes 17 bytes instead of several hundred for
+the numpy arrays returned by `index_to_state`.
+"""
+
+import numpy as np
+from typing import Iterable
+
+import torch
+
+
+class StateCodec:
+    """Pack states into fixed size records of bytes and back.
+
+    It has the following attributes:
+        - view, the shape of the neighbourhood, e.g. (7, 7)
+        - n_side, the number of side information values
+        - conv, whether the states are lists [view, side] (for ConvPolicy)
+            or flat arrays with the side information at the end (for Policy)
+        - record_size, the number of bytes of a packed state
+
+    Every cell is stored as value + 1 in 2 bits, the side information as
+    float16 after the packed neighbourhood.
+    """
+
+    # slots -------------------------------------------------------------------
+    __slots__ = ['_view', '_n_side', '_conv', '_n_cells', '_view_bytes']
+
+    # init --------------------------------------------------------------------
+    def __init__(self, *, view: tuple, n_side: int=2, conv: bool=True):
+        """Initialise the codec for the given state layout."""
+        self._view = tuple(view)
+        self._n_side = n_side
+        self._conv = conv
+        self._n_cells = int(np.prod(self._view))
+        self._view_bytes = (2 * self._n_cells + 7) // 8
+
+    # properties --------------------------------------------------------------
+    @property
+    def view(self) -> tuple:
+        """Return the shape of the neighbourhood."""
+        return self._view
+
+    @property
+    def n_side(self) -> int:
+        """Return the number of side information values."""
+        return self._n_side
+
+    @property
+    def conv(self) -> bool:
+        """Return whether the states are lists [view, side]."""
+        return self._conv
+
+    @property
+    def record_size(self) -> int:
+        """Return the number of bytes of a packed state."""
+        return self._view_bytes + 2 * self._n_side
+
+    # methods -----------------------------------------------------------------
+    def _split(self, state) -> tuple:
+        """Return the neighbourhood and side information of a state."""
+        if self._conv:
+            view, side = state
+            return np.ravel(view), np.ravel(side)
+
+        state = np.asarray(state)
+        return state[:-self._n_side], state[-self._n_side:]
+
+    def pack(self, state) -> bytes:
+        """Return the record of a single state."""
+        view, side = self._split(state)
+        codes = np.asarray(view, dtype=np.int64) + 1  # 0, 1 or 2
+        bits = np.stack([codes >> 1, codes & 1], axis=-1).astype(np.uint8)
+        return (np.packbits(bits.ravel()).tobytes() +
+                np.asarray(side, dtype=np.float16).tobytes())
+
+    def unpack_arrays(self, records: np.ndarray) -> tuple:
+        """Return the neighbourhoods (N, *view) and side information (N, n_side) of records.
+
+        records is a uint8 array (N, record_size), the results are float32.
+        """
+        records = np.asarray(records, dtype=np.uint8).reshape(-1, self.record_size)
+        n = len(records)
+        bits = np.unpackbits(records[:, :self._view_bytes], axis=1)
+        bits = bits[:, :2 * self._n_cells].reshape(n, self._n_cells, 2)
+        views = (2 * bits[..., 0] + bits[..., 1]).astype(np.float32) - 1
+        sides = np.ascontiguousarray(records[:, self._view_bytes:]).view(np.float16)
+        return views.reshape((n,) + self._view), sides.astype(np.float32)
+
+    def unpack(self, record: bytes):
+        """Return a single state in the format of `index_to_state`."""
+        views, sides = self.unpack_arrays(np.frombuffer(record, dtype=np.uint8))
+        if self._conv:
+            return [views[0], sides[0]]
+
+        return np.concatenate([views[0].ravel(), sides[0]])
+
+    def to_tensors(self, records: np.ndarray, device=None) -> tuple:
+        """Return records as float tensors ready for the policy, one per input.
+
+        For conv these are (N, 1, *view) and (N, n_side), otherwise (N, D).
+        """
+        views, sides = self.unpack_arrays(records)
+        n = len(views)
+        views, sides = torch.from_numpy(views), torch.from_numpy(sides)
+        if self._conv:
+            return (views.view(n, 1, *self._view).to(device),
+                    sides.to(device))
+
+        return (torch.cat([views.view(n, -1), sides], -1).to(device),)
+
+
+class PackedStates:
+    """A sequence of states stored as packed records, a drop-in for the States deque.
+
+    States are packed on `append` and unpacked on access, so the environment
+    and everything reading the memories doesn't notice the difference. The
+    records are kept in a single growing bytearray, `records` returns them
+    as uint8 array for a vectorised unpack, e.g. via `codec.to_tensors`.
+    """
+
+    # slots -------------------------------------------------------------------
+    __slots__ = ['_codec', '_data']
+
+    # init --------------------------------------------------------------------
+    def __init__(self, codec: StateCodec, states: Iterable=()):
+        """Initialise the sequence, optionally with some states."""
+        self._codec = codec
+        self._data = bytearray()
+        for state in states:
+            self.append(state)
+
+    # properties --------------------------------------------------------------
+    @property
+    def codec(self) -> StateCodec:
+        """Return the codec of the records."""
+        return self._codec
+
+    @property
+    def nbytes(self) -> int:
+        """Return the number of bytes of all records."""
+        return len(self._data)
+
+    # methods -----------------------------------------------------------------
+    def __len__(self) -> int:
+        """Return the number of states."""
+        return len(self._data) // self._codec.record_size
+
+    def __getitem__(self, i):
+        """Return the unpacked state i, or a list of them for a slice."""
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+
+        n = len(self)
+        if i < 0:
+            i += n
+        if not 0 <= i < n:
+            raise IndexError("state index out of range")
+
+        size = self._codec.record_size
+        return self._codec.unpack(bytes(self._data[i * size:(i + 1) * size]))
+
+    def __iter__(self):
+        """Iterate over the unpacked states."""
+        for i in range(len(self)):
+            yield self[i]
+
+    def append(self, state) -> None:
+        """Pack and append a state."""
+        self._data += self._codec.pack(state)
+
+    def clear(self) -> None:
+        """Remove all states."""
+        self._data = bytearray()
+
+    def records(self, n: int=None) -> np.ndarray:
+        """Return the first n (default all) records as uint8 array (n, record_size)."""
+        n = len(self) if n is None else min(n, len(self))
+        size = self._codec.record_size
+        return np.frombuffer(bytes(self._data[:n * size]),
+                             dtype=np.uint8).reshape(n, size)
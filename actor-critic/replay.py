@@ -0,0 +1,285 @@
+"""This file provides a prioritised experience replay for the actor critic."""
+
+import numpy as np
+from collections import namedtuple
+from typing import Iterable
+
+import torch
+import torch.nn.functional as F
+from torch.distributions import Categorical
+
+from trajectories import _split_state, _to_numpy
+
+# a batch of transitions as numpy arrays
+Transitions = namedtuple('Transitions', ('views', 'sides', 'actions',
+                                         'rewards', 'next_views',
+                                         'next_sides', 'dones', 'log_probs'))
+
+
+class SumTree:
+    """A binary tree in an array, where every node holds the sum of its children.
+
+    The leaves hold the priorities, thus updating a priority and finding the
+    leaf for a given cumulative priority both are O(log n).
+    """
+
+    # slots -------------------------------------------------------------------
+    __slots__ = ['_capacity', '_tree']
+
+    # init --------------------------------------------------------------------
+    def __init__(self, capacity: int):
+        """Initialise the tree with all priorities 0."""
+        # the leaves are padded to a power of 2, such that the tree is complete
+        self._capacity = 1 << (capacity - 1).bit_length()
+        self._tree = np.zeros(2 * self._capacity, dtype=np.float64)  # root at 1
+
+    # properties --------------------------------------------------------------
+    @property
+    def total(self) -> float:
+        """Return the sum of all priorities."""
+        return self._tree[1]
+
+    # methods -----------------------------------------------------------------
+    def __getitem__(self, i: int) -> float:
+        """Return the priority of leaf i."""
+        return self._tree[i + self._capacity]
+
+    def update(self, i: int, priority: float) -> None:
+        """Set the priority of leaf i and update the sums above it."""
+        node = i + self._capacity
+        change = priority - self._tree[node]
+        while node >= 1:
+            self._tree[node] += change
+            node //= 2
+
+    def find(self, value: float) -> int:
+        """Return the leaf where the cumulative priority exceeds value."""
+        node = 1
+        while node < self._capacity:
+            left = 2 * node
+            if value < self._tree[left] or self._tree[left + 1] <= 0:
+                node = left
+            else:
+                value -= self._tree[left]
+                node = left + 1
+
+        return node - self._capacity
+
+
+class ReplayBuffer:
+    """A fixed capacity ring buffer of transitions with prioritised sampling.
+
+    It has the following attributes:
+        - capacity, the maximal number of transitions, the oldest ones are
+            overwritten
+        - alpha, how strongly the priorities are used, 0 samples uniformly
+        - beta, the exponent of the importance sampling weights that correct
+            for the prioritised sampling
+
+    The transitions are stored in preallocated arrays: int8 neighbourhoods,
+    float32 side information, the action, the reward, the next state, a done
+    flag and the log probability of the action under the behaviour policy,
+    which is needed for the off-policy correction.
+    """
+
+    # slots -------------------------------------------------------------------
+    __slots__ = ['_capacity', '_alpha', '_beta', '_tree', '_max_priority',
+                 '_size', '_next', '_data']
+
+    # init --------------------------------------------------------------------
+    def __init__(self, *, capacity: int, view: tuple, n_side: int=2,
+                 alpha: float=0.6, beta: float=0.4):
+        """Allocate the arrays for capacity transitions of the given view shape."""
+        if not isinstance(capacity, int) or capacity < 1:
+            raise ValueError("capacity must be a positive int, but {} was "
+                             "given.".format(capacity))
+
+        self._capacity = capacity
+        self._alpha = alpha
+        self._beta = beta
+        self._tree = SumTree(capacity)
+        self._max_priority = 1.0
+        self._size = 0
+        self._next = 0
+        self._data = Transitions(views=np.zeros((capacity,) + tuple(view), dtype=np.int8),
+                                 sides=np.zeros((capacity, n_side), dtype=np.float32),
+                                 actions=np.zeros(capacity, dtype=np.int64),
+                                 rewards=np.zeros(capacity, dtype=np.float32),
+                                 next_views=np.zeros((capacity,) + tuple(view), dtype=np.int8),
+                                 next_sides=np.zeros((capacity, n_side), dtype=np.float32),
+                                 dones=np.zeros(capacity, dtype=bool),
+                                 log_probs=np.zeros(capacity, dtype=np.float32))
+
+    # properties --------------------------------------------------------------
+    @property
+    def capacity(self) -> int:
+        """Return the maximal number of transitions."""
+        return self._capacity
+
+    @property
+    def alpha(self) -> float:
+        """Return the priority exponent."""
+        return self._alpha
+
+    @property
+    def beta(self) -> float:
+        """Return the importance sampling exponent."""
+        return self._beta
+
+    @beta.setter
+    def beta(self, beta: float) -> None:
+        """Set the importance sampling exponent, e.g. annealed towards 1."""
+        self._beta = beta
+
+    def __len__(self) -> int:
+        """Return the number of stored transitions."""
+        return self._size
+
+    # methods -----------------------------------------------------------------
+    def add(self, *, view, side, action: int, reward: float, next_view,
+            next_side, done: bool, log_prob: float) -> None:
+        """Add a single transition with the maximal priority seen so far."""
+        i = self._next
+        d = self._data
+        d.views[i] = np.reshape(view, d.views.shape[1:])
+        d.sides[i] = side
+        d.actions[i] = action
+        d.rewards[i] = reward
+        d.next_views[i] = np.reshape(next_view, d.views.shape[1:])
+        d.next_sides[i] = next_side
+        d.dones[i] = done
+        d.log_probs[i] = log_prob
+        self._tree.update(i, self._max_priority ** self._alpha)
+
+        self._next = (i + 1) % self._capacity
+        self._size = min(self._size + 1, self._capacity)
+
+    def add_memories(self, memories: Iterable, *, terminal: bool,
+                     gamma: float=1.0) -> int:
+        """Extract the transitions from agent memories and add them, return their number.
+
+        The next state of a step is the state of the agent's following step.
+        If terminal is set, the agents are dead and their last step is added
+        with done=True, otherwise it is skipped since there is no next state
+        yet. The rewards of a death without a step of its own (starvation,
+        instadeath) come after the last action; they are discounted with
+        gamma and added to the reward of the terminal transition. This has to
+        be called before the rewards are reversed in finish_episode.
+        """
+        added = 0
+        for states, rewards, saved_actions in memories:
+            n = min(len(states), len(rewards), len(saved_actions))
+            if n == 0:
+                continue
+
+            states = [_split_state(s, self._data.sides.shape[1])
+                      for s in list(states)[:n]]
+            rewards = list(rewards)
+            saved_actions = list(saved_actions)[:n]
+            last = n if terminal else n - 1
+            for t in range(last):
+                view, side = states[t]
+                next_view, next_side = states[min(t + 1, n - 1)]
+                reward = rewards[t]
+                if t == n - 1:  # the final rewards go to the terminal step
+                    reward += sum(gamma ** (k + 1) * r
+                                  for k, r in enumerate(rewards[n:]))
+
+                lp = _to_numpy(saved_actions[t].log_prob).item()
+                self.add(view=view, side=side,
+                         action=saved_actions[t].action_nr,
+                         reward=reward, next_view=next_view,
+                         next_side=next_side, done=(t == n - 1), log_prob=lp)
+                added += 1
+
+        return added
+
+    def sample(self, n: int) -> tuple:
+        """Sample n transitions proportional to their priorities.
+
+        Returns the transitions, their indices (for `update_priorities`) and
+        their normalised importance sampling weights.
+        """
+        if self._size == 0:
+            raise RuntimeError("cannot sample from an empty replay buffer.")
+
+        # one sample per equally sized part of the total priority
+        total = self._tree.total
+        bounds = np.linspace(0, total, n + 1)
+        values = np.random.uniform(bounds[:-1], bounds[1:])
+        indices = np.array([self._tree.find(v) for v in values])
+        indices = np.minimum(indices, self._size - 1)
+
+        probs = np.array([self._tree[i] for i in indices]) / total
+        weights = (self._size * probs) ** -self._beta
+        weights /= weights.max()
+
+        batch = Transitions(*[arr[indices] for arr in self._data])
+        return batch, indices, weights.astype(np.float32)
+
+    def update_priorities(self, indices: np.ndarray, errors: np.ndarray,
+                          eps: float=1e-3) -> None:
+        """Set the priorities of the sampled transitions to their TD errors."""
+        priorities = np.abs(errors) + eps
+        for i, p in zip(indices, priorities):
+            self._tree.update(int(i), p ** self._alpha)
+
+        self._max_priority = max(self._max_priority, priorities.max())
+
+
+def _policy_inputs(views: np.ndarray, sides: np.ndarray, conv: bool, device):
+    """Return the batched policy input for the given views and sides."""
+    n = len(views)
+    views = torch.from_numpy(views.astype(np.float32)).to(device)
+    sides = torch.from_numpy(sides).to(device)
+    if conv:
+        return views.view(n, 1, *views.shape[1:]), sides
+
+    return torch.cat([views.view(n, -1), sides], -1)
+
+
+def replay_update(*, model, optimizer, buffer: ReplayBuffer, batch_size: int,
+                  gamma: float, conv: bool, rho_max: float=1.0) -> float:
+    """Do a single off-policy corrected actor critic update on a replayed batch.
+
+    The critic is trained on the one step TD target r + gamma * V(s') with
+    the importance sampling weights of the prioritised sampling. The actor
+    uses the TD error as advantage, weighted with the truncated importance
+    ratio min(rho_max, pi(a|s) / mu(a|s)) between the current and the
+    behaviour policy. The priorities are updated with the new TD errors.
+    Returns the loss.
+    """
+    batch, indices, weights = buffer.sample(batch_size)
+    device = next(model.parameters()).device
+    n = len(indices)
+
+    probs, values = model(_policy_inputs(batch.views, batch.sides, conv,
+                                         device))
+    probs, values = probs.view(n, -1), values.view(n)
+    with torch.no_grad():
+        _, next_values = model(_policy_inputs(batch.next_views,
+                                              batch.next_sides, conv, device))
+        next_values = next_values.view(n)
+
+    rewards = torch.from_numpy(batch.rewards).to(device)
+    not_done = torch.from_numpy(~batch.dones).float().to(device)
+    targets = rewards + gamma * not_done * next_values
+    td = targets - values
+
+    actions = torch.from_numpy(batch.actions).to(device)
+    log_probs = Categorical(probs).log_prob(actions)
+    behaviour = torch.from_numpy(batch.log_probs).to(device)
+    rho = torch.exp(log_probs.detach() - behaviour).clamp(max=rho_max)
+
+    weights = torch.from_numpy(weights).to(device)
+    policy_loss = -(weights * rho * td.detach() * log_probs).mean()
+    value_loss = (weights * F.smooth_l1_loss(values, targets,
+                                             reduction='none')).mean()
+    loss = policy_loss + value_loss
+
+    optimizer.zero_grad()
+    loss.backward()
+    optimizer.step()
+
+    buffer.update_priorities(indices, td.detach().cpu().numpy())
+    return loss.item()
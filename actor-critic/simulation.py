@@ -10,11 +10,15 @@ import torch
 import torch.optim as optim
 import argparse as ap
 from collections import deque
+from functools import partial
 
 from agents import Predator, Prey
+import agents  # init sets the storage of the states
 import environment as Environment
 from tools import timestamp, keyboard_interrupt_handler, sum_calls, chunkify
+from tools import StepProfiler
 import actor_critic as ac  # also ensures GPU usage when available
+from packing import StateCodec, PackedStates
 
 # setup argparse options
 parser = ap.ArgumentParser(description="Command line options for the simulation script.")
@@ -44,10 +48,20 @@ training = True if goal == "training" else False
 # make sure, that everything is ported to the gpu if one should be used
 ac.init(mode=mode, goal=goal, policy_kind=cfg['Network']['kind'])
 
+# threads for the many tiny forward passes, 0 keeps the torch default
+ac.set_threads(intra_op=cfg['Network'].get('intra_op_threads', 0),
+               inter_op=cfg['Network'].get('inter_op_threads', 0))
+
 # Environment init settings ---------------------------------------------------
 # simulation goal
 Environment.init(goal=goal, policy_kind=cfg['Network']['kind'])
 
+# store the states in the agents' memories packed, 2 bits per cell
+if cfg['Sim'].get('pack_states', False):
+    codec = StateCodec(view=(int(np.sqrt(cfg['Model'].get('neighbourhood', 9))),) * 2, n_side=1,
+                       conv=cfg['Network']['kind'] == 'conv')
+    agents.init(states=partial(PackedStates, codec))
+
 cfg_res = cfg['Sim']['resume_state_from']  # resume filepath
 
 resume = None  # initialize
@@ -74,6 +88,11 @@ elif cfg_res:
 env = Environment.GridPPM(agent_types=(Predator, Prey), **cfg['Model'])
 # env.seed(12345678)
 
+# per phase timing of env.step, only if wanted
+if cfg['Sim'].get('profile', False):
+    env.profiler = StepProfiler()
+prof = env.profiler  # the policy forward happens outside of env.step
+
 # Initialize the policies and averages ----------------------------------------
 Policy = ac.Policy if cfg['Network']['kind'] == 'fc' else ac.ConvPolicy
 PreyModel = Policy(**cfg['Network']['layers'])
@@ -94,6 +113,9 @@ avg = {  # 'mean_gens': deque(),  # in step units
 # deque of episode/step pairs
 epsbatch = deque()  # list of tuples of episode/step number
 
+# deque of per timestep profiling breakdowns (episode, step, times, calls)
+profile = deque()
+
 # simulation parameters
 resume_pars = {'last_episode': 0}
 
@@ -121,6 +143,31 @@ if resume is not None:  # resume the parameters..
     PreyOptimizer.load_state_dict(resume['PreyOptimizerState'])
     PredatorOptimizer.load_state_dict(resume['PredatorOptimizerState'])
 
+# policy lookup tables, only if the state space is small enough ---------------
+tables = {'Prey': None, 'Predator': None}
+if cfg['Network'].get('lookup_table', False):
+    n_cells = cfg['Model'].get('neighbourhood', 9)
+    max_fr = cfg['Model'].get('max_food_reserve')
+    if ac.PolicyTable.enumerable(n_cells=n_cells, max_food_reserve=max_fr):
+        tables = {kin: ac.PolicyTable(n_cells=n_cells, max_food_reserve=max_fr)
+                  for kin in tables.keys()}
+    else:
+        warnings.warn("The states of a neighbourhood of {} with a maximal food "
+                      "reserve of {} can't be put into a lookup table, "
+                      "the networks are used instead.".format(n_cells, max_fr),
+                      RuntimeWarning)
+
+# only sample actions which aren't wrong actions in the current state
+masker = env.action_masks if cfg['Network'].get('mask_actions', False) else None
+
+
+def compile_tables():
+    """Evaluate the current policies on all states, if tables are used."""
+    for kin, model in (('Prey', PreyModel), ('Predator', PredatorModel)):
+        if tables[kin] is not None:
+            tables[kin].compile(model)
+
+
 # save function ---------------------------------------------------------------
 save_state = {'PreyState': PreyModel.state_dict(),
               'PredatorState': PredatorModel.state_dict(),
@@ -130,7 +177,8 @@ save_state = {'PreyState': PreyModel.state_dict(),
               'mean_pred_rewards': avg['mean_pred_rewards'],
               'mean_prey_loss': avg['mean_prey_loss'],
               'mean_pred_loss': avg['mean_pred_loss'],
-              'epsbatch': epsbatch}
+              'epsbatch': epsbatch,
+              'profile': profile}
 
 
 def save():
@@ -141,6 +189,7 @@ def save():
 
     # clear episode/timestep/function call counter
     epsbatch.clear()
+    profile.clear()
 
 
 # main loop -------------------------------------------------------------------
@@ -157,6 +206,7 @@ def main():
         eps_time = timestamp(return_obj=True)  # record episode starting time
         print("\n: Environment resetting now...")
         state, idx = env.reset()  # returns state and object of random agent
+        compile_tables()  # the policies changed in the last optimisation
 
         # save data
         if i_eps % cfg['Sim']['save_state_every'] == 0:
@@ -190,8 +240,14 @@ def main():
 
                     # env.state = state
                     model = PreyModel
+                    if prof is not None:
+                        prof.start()
                     action = ac.select_action(model=model, agent=ag,
-                                              state=state)
+                                              state=state,
+                                              table=tables['Prey'],
+                                              masker=masker)
+                    if prof is not None:
+                        prof.lap('policy')
                     reward, state, done, idx = env.step(model=model,
                                                         agent=ag,
                                                         index=tmpidx,
@@ -202,8 +258,14 @@ def main():
                     # ag.memory.States.append(state)
                     # select model and action
                     model = PreyModel if ag.kin == "Prey" else PredatorModel
+                    if prof is not None:
+                        prof.start()
                     action = ac.select_action(model=model, agent=ag,
-                                              state=state)
+                                              state=state,
+                                              table=tables[ag.kin],
+                                              masker=masker)
+                    if prof is not None:
+                        prof.lap('policy')
                     # take a step
                     reward, state, done, idx = env.step(model=model,
                                                         agent=ag,
@@ -249,6 +311,9 @@ def main():
             for f in env.action_lookup.values():
                 f.calls = 0  # reset the call counter
 
+            if prof is not None:
+                prof.next_timestep()  # close the timestep
+
             # simulation again ------------------------------------------------
             if done or ((_ + 1) % cfg['Sim']['steps'] == 0):
                 # save the episode number with number of steps
@@ -275,24 +340,29 @@ def main():
         print("\n: Episode Runtime: {}".format(timestamp(return_obj=True) -
                                                eps_time))
 
+        if prof is not None:
+            times, calls = prof.breakdown()
+            profile.append([(i_eps, _), times, calls])
+            print(": Step profile: {}".format(prof.summary(times)))
+
         # only do updates if both kins have a history
         if len(env.history.Predator) and len(env.history.Prey) and training:
             print("\n: optimizing now...")
             opt_time_start = timestamp(return_obj=True)
-            l, mr = ac.finish_episode(model=PreyModel, optimizer=PreyOptimizer,
-                                      history=env.history.Prey,
-                                      gamma=cfg['Network']['gamma'],
-                                      return_means=True)
+            l, mr, _ = ac.finish_episode(model=PreyModel, optimizer=PreyOptimizer,
+                                         history=env.history.Prey,
+                                         gamma=cfg['Network']['gamma'],
+                                         return_means=True)
             print(":: [avg] Prey loss:\t{}\t Prey reward: {}"
                   "".format(l.item(), mr))
             avg['mean_prey_loss'].append(l.item())
             avg['mean_prey_rewards'].append(mr)
 
-            l, mr = ac.finish_episode(model=PredatorModel,
-                                      optimizer=PredatorOptimizer,
-                                      history=env.history.Predator,
-                                      gamma=cfg['Network']['gamma'],
-                                      return_means=True)
+            l, mr, _ = ac.finish_episode(model=PredatorModel,
+                                         optimizer=PredatorOptimizer,
+                                         history=env.history.Predator,
+                                         gamma=cfg['Network']['gamma'],
+                                         return_means=True)
             print(":: [avg] Predator loss:\t{}\t Predator reward: {}"
                   "".format(l.item(), mr))
             avg['mean_pred_loss'].append(l.item())
@@ -10,12 +10,21 @@ import torch
 import torch.optim as optim
 import argparse as ap
 from collections import deque
+from functools import partial
 
 # make sure that the path to Imazalil/actor-critic is in $PYTHONPATH
 from agents import OrientedPredator, OrientedPrey
+import agents  # init sets the storage of the states
 import environment as Environment  # init needs to be called
 from tools import timestamp, keyboard_interrupt_handler, sum_calls, chunkify
+from tools import StepProfiler
 import actor_critic as ac  # init needs to be called
+from packing import StateCodec, PackedStates
+from checkpoint import CheckpointWriter, StatisticsLog
+from trajectories import TrajectoryRecorder, memories_to_trajectories
+from replay import ReplayBuffer, replay_update
+from learner import Learner
+import framesink
 
 # setup argparse options ------------------------------------------------------
 parser = ap.ArgumentParser(description="Command line options for the simulation script.")
@@ -46,10 +55,20 @@ training = True if goal == "training" else False
 # make sure, that everything is ported to the gpu if one should be used
 ac.init(mode=mode, goal=goal, policy_kind=cfg['Network']['kind'])
 
+# threads for the many tiny forward passes, 0 keeps the torch default
+ac.set_threads(intra_op=cfg['Network'].get('intra_op_threads', 0),
+               inter_op=cfg['Network'].get('inter_op_threads', 0))
+
 # Environment init settings ---------------------------------------------------
 # simulation goal
 Environment.init(goal=goal, policy_kind=cfg['Network']['kind'])
 
+# store the states in the agents' memories packed, 2 bits per cell
+if cfg['Sim'].get('pack_states', False):
+    codec = StateCodec(view=cfg['Model']['view'], n_side=2,
+                       conv=cfg['Network']['kind'] == 'conv')
+    agents.init(states=partial(PackedStates, codec))
+
 cfg_res = cfg['Sim']['resume_state_from']  # resume filepath
 
 resume = None  # initialize
@@ -77,10 +96,28 @@ env = Environment.GridOrientedPPM(agent_types=(OrientedPredator, OrientedPrey),
                                   **cfg['Model'])
 # env.seed(12345678)
 
+# initial configurations are prepared in the background, if wanted
+if cfg['Sim'].get('reset_pool', 0):
+    env.pool = Environment.ConfigurationPool(env=env,
+                                             size=cfg['Sim']['reset_pool'],
+                                             seed=cfg['Sim'].get('reset_pool_seed'))
+
+# per phase timing of env.step, only if wanted
+if cfg['Sim'].get('profile', False):
+    env.profiler = StepProfiler()
+
 # Initialize the policies and averages ----------------------------------------
 Policy = ac.Policy if cfg['Network']['kind'] == 'fc' else ac.ConvPolicy
-PreyModel = Policy(**cfg['Network']['layers'])
-PredatorModel = Policy(**cfg['Network']['layers'])
+SharedModel = None  # policy with a trunk shared by both kins, if wanted
+if cfg['Network'].get('shared_trunk', False):
+    SharedModel = ac.MultiHeadPolicy(kins=("OrientedPredator", "OrientedPrey"),
+                                     **cfg['Network']['layers'])
+    PreyModel = SharedModel.for_kin("OrientedPrey")
+    PredatorModel = SharedModel.for_kin("OrientedPredator")
+
+else:
+    PreyModel = Policy(**cfg['Network']['layers'])
+    PredatorModel = Policy(**cfg['Network']['layers'])
 # policy needed for env.step
 Policy = {"OrientedPredator": PredatorModel,
           "OrientedPrey": PreyModel}
@@ -90,17 +127,55 @@ if use_cuda:
     PreyModel.cuda()
     PredatorModel.cuda()
 
+# the rollout can run on exported copies, the eager models are trained
+inference = cfg['Network'].get('inference', 'eager')
+example = ac.example_state(view=cfg['Model']['view'])
+
+# the kins are optimised concurrently, while the next episode is rolled out
+learner = None
+if cfg['Network'].get('parallel_learner', False) and SharedModel is None:
+    learner = Learner(workers=len(Policy))
+
+
+def rollout_policies() -> dict:
+    """Return the policies for env.step, exported for inference if wanted.
+
+    With the learner, the rollout always runs on exported copies, since the
+    eager models are updated in the background.
+    """
+    if learner is not None and cache is not None:
+        cache.invalidate()  # not watching the optimizers, see below
+
+    if inference == 'eager' and learner is None:
+        return Policy
+
+    elif inference == 'quantize':
+        return {kin: ac.quantize_policy(model) for kin, model in Policy.items()}
+
+    return {kin: ac.export_policy(model, example=example,
+                                  fuse=cfg['Network'].get('fuse', True))
+            for kin, model in Policy.items()}
+
 # averages
 avg = {'mean_prey_rewards': deque(),  # in episode units
        'mean_pred_rewards': deque(),
        'mean_prey_loss': deque(),  # in episode units
        'mean_pred_loss': deque()}
 
-# deque of episode/step pairs
+# deque of episode/step pairs, with the per timestep statistics and action
+# counts (timesteps, kins, successful/wrong, actions) of the episode
 epsbatch = deque()  # list of tuples of episode/step number
 
+# deque of per timestep profiling breakdowns (episode, step, times, calls)
+profile = deque()
+
 # simulation parameters
-resume_pars = {'last_episode': 0}
+resume_pars = {'last_episode': 0, 'timestep': 0}
+env_resume = None  # environment snapshot to resume the episode from
+
+# append-only log for the statistics, the checkpoints only hold the models
+log = StatisticsLog(cfg['Sim']['save_state_to'] + "statistics_" +
+                    timestamp() + ".pkl")
 
 if resume is not None:
     print(": [init] Found the following keys: {}".format(resume.keys()))
@@ -108,7 +183,14 @@ if resume is not None:
     PreyModel.load_state_dict(resume['PreyState'])
     PredatorModel.load_state_dict(resume['PredatorState'])
     # resume parameter averages
-    for p in avg.keys():
+    if 'stats_log' in resume:
+        # continue the log, forget whatever was written after the checkpoint
+        log = StatisticsLog(resume['stats_log'])
+        log.truncate(resume['stats_offset'])
+        for p in avg.keys():
+            avg[p] = log.collect(p)
+
+    for p in avg.keys():  # checkpoints without statistics log
         if p in resume:
             avg[p] = resume[p]
 
@@ -116,44 +198,294 @@ if resume is not None:
         if p in resume:
             resume_pars[p] = resume[p]
 
-    if 'last_episode' in resume:
+    if 'env' in resume:
+        # the episode can be continued exactly where it was snapshotted
+        env_resume = resume['env']
+        torch.set_rng_state(resume['torch_rng'])
+
+    elif 'last_episode' in resume:
         resume_pars['last_episode'] += 1  # if resume, don't rerun the last step
 
 PreyOptimizer = optim.Adam(PreyModel.parameters(), lr=1e-4)
-PredatorOptimizer = optim.Adam(PredatorModel.parameters(), lr=1e-4)
+if SharedModel is None:
+    PredatorOptimizer = optim.Adam(PredatorModel.parameters(), lr=1e-4)
+
+else:  # a single optimizer for the shared parameters
+    PredatorOptimizer = PreyOptimizer
+
+Optimizer = {"OrientedPredator": PredatorOptimizer,
+             "OrientedPrey": PreyOptimizer}
+
+# cache of the action distributions, cleared by every optimisation step
+cache = None
+select_action = ac.select_action
+if cfg['Network'].get('inference_cache', 0):
+    cache = ac.InferenceCache(capacity=cfg['Network']['inference_cache'])
+    # the learner threads must not clear it during the rollout, so it is
+    # invalidated in rollout_policies instead
+    for opt in {id(o): o for o in Optimizer.values()}.values():
+        if learner is None:
+            cache.watch(opt)
+    select_action = partial(ac.select_action, cache=cache)
+
+# only sample actions which aren't wrong actions in the current state
+if cfg['Network'].get('mask_actions', False):
+    select_action = partial(select_action, masker=env.action_masks)
+
+# prioritised experience replay for additional off-policy updates
+replay = {}
+if cfg['Network'].get('replay_capacity', 0):
+    replay = {kin: ReplayBuffer(capacity=cfg['Network']['replay_capacity'],
+                                view=cfg['Model']['view'],
+                                alpha=cfg['Network'].get('replay_alpha', 0.6),
+                                beta=cfg['Network'].get('replay_beta', 0.4))
+              for kin in Policy.keys()}
 
 if resume is not None:  # resume the parameters..
     PreyOptimizer.load_state_dict(resume['PreyOptimizerState'])
     PredatorOptimizer.load_state_dict(resume['PredatorOptimizerState'])
 
+# trajectories of every episode are written to disk, if a path is given
+recorder = None
+if cfg['Sim'].get('record_trajectories_to'):
+    recorder = TrajectoryRecorder(cfg['Sim']['record_trajectories_to'])
+
 # save function ---------------------------------------------------------------
+# checkpoints are written by a background thread
+writer = CheckpointWriter(keep=cfg['Sim'].get('keep_states', 0),
+                          asynchronous=cfg['Sim'].get('save_async', True))
+
 save_state = {'PreyState': PreyModel.state_dict(),
               'PredatorState': PredatorModel.state_dict(),
               'PreyOptimizerState': PreyOptimizer.state_dict(),
-              'PredatorOptimizerState': PredatorOptimizer.state_dict(),
-              'mean_prey_rewards': avg['mean_prey_rewards'],
-              'mean_pred_rewards': avg['mean_pred_rewards'],
-              'mean_prey_loss': avg['mean_prey_loss'],
-              'mean_pred_loss': avg['mean_pred_loss'],
-              'epsbatch': epsbatch}
+              'PredatorOptimizerState': PredatorOptimizer.state_dict()}
 
+# number of rows of each average that already are in the log
+logged = {p: len(avg[p]) for p in avg.keys()}
 
-def save():
-    """Save the current state of the simulation to a resumeable file."""
+
+def save(wait: bool=False, latest: bool=False):
+    """Save the current state of the simulation to a resumeable file.
+
+    The models and optimizers are stored as checkpoint, the statistics since
+    the last save are appended to the statistics log. Both are written in the
+    background. If wait is set, block until every checkpoint is on disk.
+    Running updates are waited for, such that the checkpoint is consistent.
+    With latest, the checkpoint replaces the file state_latest instead of
+    adding a new one, i.e. it isn't part of the rotation.
+    """
+    collect_updates()
     print("\n: [sim] Storing the following keys: {}".format(save_state.keys()))
-    filename = cfg['Sim']['save_state_to'] + "state_" + timestamp()
-    ac.save_checkpoint(state=save_state, filename=filename)
+    # the optimizer state dicts are created on call, so refresh them
+    save_state['PreyOptimizerState'] = PreyOptimizer.state_dict()
+    save_state['PredatorOptimizerState'] = PredatorOptimizer.state_dict()
+
+    # only the new rows go to the log
+    statistics = {'last_episode': save_state.get('last_episode'),
+                  'epsbatch': list(epsbatch),
+                  'profile': list(profile)}
+    for p in avg.keys():
+        statistics[p] = list(avg[p])[logged[p]:]
+        logged[p] = len(avg[p])
+
+    filename = cfg['Sim']['save_state_to'] + "state_"
+    filename += "latest" if latest else timestamp()
+    writer.save(state=save_state, filename=filename, statistics=statistics,
+                log=log, rotate=not latest)
 
     # clear episode/timestep/function call counter
     epsbatch.clear()
+    profile.clear()
+
+    if wait:
+        writer.close()
+        if learner is not None:
+            learner.close()
+
+
+def save_and_wait():
+    """Save the current state and wait until it is written, e.g. before exiting."""
+    save(wait=True)
+
+
+def snapshot_env(timestep: int):
+    """Store a snapshot of the environment and the RNGs for resuming.
+
+    This should only be called at the beginning of a timestep, where the
+    environment is in a consistent state. The snapshot is written with the
+    next save.
+    """
+    save_state['env'] = env.snapshot()
+    save_state['timestep'] = timestep
+    save_state['torch_rng'] = torch.get_rng_state()
+
+
+def drop_snapshot():
+    """Forget the environment snapshot once its episode is finished.
+
+    A state saved afterwards resumes with the next episode instead of
+    replaying the finished one.
+    """
+    for key in ('env', 'timestep', 'torch_rng'):
+        save_state.pop(key, None)
+
+
+def fill_replay():
+    """Add the transitions of the history and the living agents to the replay buffers.
+
+    At the end of an episode (done), env.step already put the memories of
+    the living agents into the history; they are only added once and not as
+    terminal. The last step of a living agent has no next state yet and is
+    skipped.
+    """
+    for kin, buf in replay.items():
+        living = [ag.memory for ag in env._agents_set if ag.kin == kin]
+        alive = {id(mem) for mem in living}
+        buf.add_memories([mem for mem in getattr(env.history, kin)
+                          if id(mem) not in alive], terminal=True,
+                         gamma=cfg['Network']['gamma'])
+        buf.add_memories(living, terminal=False)
+
+
+def replay_updates(kins: tuple=None):
+    """Do the configured number of off-policy updates from the replay buffers of kins (default all)."""
+    batch_size = cfg['Network'].get('replay_batch', 256)
+    for kin, buf in replay.items():
+        if len(buf) < batch_size or (kins is not None and kin not in kins):
+            continue
+
+        losses = [replay_update(model=Policy[kin], optimizer=Optimizer[kin],
+                                buffer=buf, batch_size=batch_size,
+                                gamma=cfg['Network']['gamma'],
+                                conv=cfg['Network']['kind'] == 'conv',
+                                rho_max=cfg['Network'].get('replay_rho_max', 1.0))
+                  for _ in range(cfg['Network'].get('replay_updates', 1))]
+        print(":: [ac] {} replay loss:\t{}".format(kin, np.mean(losses)))
+
+
+def update_kin(kin: str, history: list) -> tuple:
+    """Optimise the policy of kin on history, followed by its replay updates.
+
+    Only touches the model, optimizer and replay buffer of kin, thus the
+    kins can be updated concurrently by the learner.
+    """
+    means = ac.finish_episode(model=Policy[kin], optimizer=Optimizer[kin],
+                              history=history, gamma=cfg['Network']['gamma'],
+                              return_means=True)
+    replay_updates(kins=(kin,))
+    return means
+
+
+# the start of the updates running in the learner
+running = {'start': None}
+
+
+def record_updates(means: dict) -> None:
+    """Print and store the losses and mean rewards of the kins."""
+    for kin, name, key in (("OrientedPrey", "Prey", 'prey'),
+                           ("OrientedPredator", "Predator", 'pred')):
+        l, mr, _ = means[kin]
+        print(":: [ac] {} loss:\t{}\t {} reward: {}"
+              "".format(name, l.item(), name, mr))
+        avg['mean_{}_loss'.format(key)].append(l.item())
+        avg['mean_{}_rewards'.format(key)].append(mr)
+
+
+def collect_updates() -> None:
+    """Wait for the updates running in the learner, if any, and record them."""
+    if learner is None or not learner.pending:
+        return
+
+    record_updates(learner.wait())
+    print("\n: [ac] optimization time (in the background): "
+          "{}".format(timestamp(return_obj=True) - running['start']))
+
+
+def train_segment() -> dict:
+    """Train on the trajectories since the last update, free them and return the rollout policies.
+
+    Living agents bootstrap from the value of their current state, dead
+    agents (in the history) from 0. Afterwards, the history and the memories
+    of all agents are cleared, so the memory doesn't grow with Sim.steps.
+    The exported rollout policies (and the cache entries) are stale after the
+    update, so the returned policies are exported from the new parameters.
+    """
+    collect_updates()  # the episode update touches the replay buffers
+    fill_replay()
+    indices = env.agent_indices()
+    histories, bootstraps = {}, {}
+    for kin, model in Policy.items():
+        memories = list(getattr(env.history, kin))
+        boots = [0.] * len(memories)  # dead agents
+        for ag, idx in indices.items():
+            if ag.kin == kin and ag.memory.Rewards:
+                memories.append(ag.memory)
+                boots.append(ac.state_value(model=model,
+                                            state=env.index_to_state(index=idx)))
+
+        histories[kin] = memories
+        bootstraps[kin] = boots
+
+    if not all(histories.values()):
+        print(": [ac] Not enough history to train on the segment...")
+        return rollout_policies()
+
+    # the segment is freed below, the recorder writes it with the episode
+    if recorder is not None:
+        recorder.add(memories=histories)
+
+    if SharedModel is not None:
+        means = ac.finish_episode_shared(model=SharedModel,
+                                         optimizer=PreyOptimizer,
+                                         histories=histories,
+                                         gamma=cfg['Network']['gamma'],
+                                         bootstraps=bootstraps)
+        losses = {kin: m[:2] for kin, m in means.items()}
+
+    elif learner is not None:
+        losses = learner.run({kin: partial(ac.finish_segment, model=model,
+                                           optimizer=Optimizer[kin],
+                                           history=histories[kin],
+                                           bootstraps=bootstraps[kin],
+                                           gamma=cfg['Network']['gamma'])
+                              for kin, model in Policy.items()})
+
+    else:
+        losses = {kin: ac.finish_segment(model=model,
+                                         optimizer=Optimizer[kin],
+                                         history=histories[kin],
+                                         bootstraps=bootstraps[kin],
+                                         gamma=cfg['Network']['gamma'])
+                  for kin, model in Policy.items()}
+
+    for kin, (l, mr) in losses.items():
+        print(":: [ac] {} segment loss:\t{}\t reward: {}"
+              "".format(kin, l.item(), mr))
+
+    replay_updates()
+
+    # free the trained segment
+    for hist in env.history:
+        hist.clear()
+    for ag in indices:
+        for mem in ag.memory:
+            mem.clear()
+
+    return rollout_policies()  # invalidates the cache with the learner
 
 
 # main loop +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
-@keyboard_interrupt_handler(save=save, abort=None)
+@keyboard_interrupt_handler(save=save_and_wait, abort=writer.close)
 def main():
     """The main simulation loop."""
+    global env_resume
     inittime = timestamp(return_obj=True)  # initial datetime object
     batch = deque()  # initial batch deque to append values to
+    actions = deque()  # action counts per timestep
+    snapshot_every = cfg['Sim'].get('snapshot_every', 0)
+    render_mode = cfg['Plot'].get('mode', 'png')
+    train_every = cfg['Sim'].get('train_every', 0)
+    rollout = None  # exported at the start of an episode, if not given
 
     # if no resume was given above, this starts from 0: -----------------------
     for i_eps in range(resume_pars['last_episode'], cfg['Sim']['episodes']):
@@ -161,28 +493,70 @@ def main():
         save_state['last_episode'] = i_eps
 
         eps_time = timestamp(return_obj=True)  # record episode starting time
-        print("\n: [env] Resetting now...")
-        env.reset()  # returns None in this scenario
+        if env_resume is not None:
+            print("\n: [env] Restoring episode {} at step {}..."
+                  "".format(i_eps, resume_pars['timestep']))
+            env.restore(env_resume)
+            first_ts = resume_pars['timestep']
+            env_resume = None  # only for the first episode
+
+        else:
+            print("\n: [env] Resetting now...")
+            env.reset()  # returns None in this scenario
+            first_ts = 0
+
+        snapshot_env(first_ts)
+        snapshot_due = False  # mid episode, taken as soon as the learner is idle
+
+        # export the current parameters for this episode, with the learner
+        # they were exported before the last update was started
+        if rollout is None:
+            collect_updates()
+            rollout = rollout_policies()
 
         # save data
         if i_eps % cfg['Sim']['save_state_every'] == 0:
             save()
 
-        for ts in range(cfg['Sim']['steps']):  # ts = timestep ----------------
+        # frames go directly into a video or archive if not rendering to png
+        render = cfg['Plot']['render'] and (i_eps % cfg['Plot']['every'] == 0)
+        sink = None
+        if render and render_mode != 'png':
+            params = cfg['Plot']['params']
+            sink = framesink.open_sink(mode=render_mode,
+                                       filename=params['filepath'] +
+                                       "{}_{:0>3}".format(timestamp(), i_eps),
+                                       scale=params.get('scale', 8),
+                                       fps=params.get('fps', 25),
+                                       arrowcolour=params['arrowcolor'])
+
+        for ts in range(first_ts, cfg['Sim']['steps']):  # ts = timestep ------
             print("\n:: [sim] Episode {}, Step {}".format(i_eps, ts))
 
+            # environment snapshot, saved right away to state_latest; the
+            # rollout doesn't wait for the learner for it, but defers it
+            if snapshot_every and ts != first_ts and ts % snapshot_every == 0:
+                snapshot_due = True
+
+            if snapshot_due and (learner is None or not learner.running):
+                snapshot_env(ts)
+                save(latest=True)
+                snapshot_due = False
+
             # if ts should be rendered:
-            if cfg['Plot']['render']:
-                if i_eps % cfg['Plot']['every'] == 0:  # plot every nth episode
-                    print("::: [sim] Plotting current state...")
-                    env.render(episode=i_eps, timestep=ts,
-                               params=cfg['Plot']['params'])
+            if sink is not None:
+                sink.write(*env.render_planes())
+
+            elif render:  # plot every nth episode
+                print("::: [sim] Plotting current state...")
+                env.render(episode=i_eps, timestep=ts,
+                           params=cfg['Plot']['params'])
 
             # run while there are agents to play with
             while(len(env.shuffled_agent_list) > 0 or len(env.eaten_prey) > 0):
                 # take a step
-                reward, state, done = env.step(policy=Policy,
-                                               select_action=ac.select_action)
+                reward, state, done = env.step(policy=rollout,
+                                               select_action=select_action)
 
                 if done or ((ts + 1) % cfg['Sim']['steps'] == 0):
                     print(":: [sim] Breakpoint reached " + 40 * "-")
@@ -210,22 +584,40 @@ def main():
             # storage
             batch.append([mean_pred_fr, mean_prey_fr, len(preds), len(preys),
                           mean_pred_gen, mean_prey_gen])
+            actions.append(env.action_counts())
+
+            if env.profiler is not None:
+                env.profiler.next_timestep()  # close the timestep
 
             # back to simulation ----------------------------------------------
             if done or ((ts + 1) % cfg['Sim']['steps'] == 0):
+                # the rest of the episode is trained in finish_episode
                 # save the episode number with number of steps
-                epsbatch.append([(i_eps, ts), batch.copy()])
+                epsbatch.append([(i_eps, ts), batch.copy(), np.stack(actions)])
 
-                # clear current batch deque
+                # clear current batch and action deques
                 batch.clear()
+                actions.clear()
                 break
 
+            # truncated updates on the segment since the last update
+            if training and train_every and (ts + 1) % train_every == 0:
+                rollout = train_segment()
+
             # create new shuffled agent list
             env.create_shuffled_agent_list()
         # ---------------------------------------------------------------------
 
+        # the last update ran during this rollout, it has to be done before
+        # anything touches the models or replay buffers again
+        collect_updates()
+
+        if sink is not None:
+            sink.close()
+
         # append memory of remaining agents to history
         if training:
+            fill_replay()
             for ag in env._agents_set:
                 if ag.memory.Rewards:  # if that agent actually has memory
                     getattr(env.history, ag.kin).append(ag.memory)
@@ -233,38 +625,76 @@ def main():
         print("\n: [sim] Episode Runtime: {}"
               "".format(timestamp(return_obj=True) - eps_time))
 
+        if cache is not None:
+            print(": [ac] Inference cache: {} hits, {} misses"
+                  "".format(cache.hits, cache.misses))
+            cache.reset_stats()
+
+        if env.profiler is not None:
+            times, calls = env.profiler.breakdown()
+            profile.append([(i_eps, ts), times, calls])
+            print(": [sim] Step profile: {}"
+                  "".format(env.profiler.summary(times)))
+
+        # record the trajectories before the rewards are reversed while training
+        if recorder is not None and training:
+            print(": [sim] Recording trajectories to {}"
+                  "".format(recorder.record(episode=i_eps,
+                                            history=env.history)))
+
+        # how far the quantised rollout policies are off on this episode
+        check_every = cfg['Network'].get('quantize_check_every', 0)
+        if (inference == 'quantize' and training and check_every and
+                i_eps % check_every == 0):
+            for kin, model in Policy.items():
+                traj = memories_to_trajectories(getattr(env.history, kin))
+                if len(traj.actions) == 0:
+                    continue
+
+                div = ac.policy_divergence(reference=model,
+                                           candidate=rollout[kin],
+                                           views=traj.views, sides=traj.sides)
+                print(": [ac] {} quantisation: mean KL {:.2e}, max TV {:.2e},"
+                      " argmax agreement {:.3f}".format(kin, div['mean_kl'],
+                                                        div['max_tv'],
+                                                        div['argmax_agreement']))
+
         # optimization --------------------------------------------------------
+        rollout = None  # exported anew, unless the learner runs in the background
         optimize = all([len(hist) > 0 for hist in env.history]) and training
 
-        if optimize:
+        if optimize and learner is not None:
+            print("\n: [ac] optimizing in the background...")
+            # the next rollout runs on the parameters before this update
+            rollout = rollout_policies()
+            running['start'] = timestamp(return_obj=True)
+            learner.submit({kin: partial(update_kin, kin,
+                                         list(getattr(env.history, kin)))
+                            for kin in Policy.keys()})
+
+        elif optimize:
             print("\n: [ac] optimizing now...")
             opt_time_start = timestamp(return_obj=True)
-            fcalls = {}
-            l, mr, sa = ac.finish_episode(model=PreyModel,
-                                          optimizer=PreyOptimizer,
-                                          history=env.history.OrientedPrey,
-                                          gamma=cfg['Network']['gamma'],
-                                          return_means=True)
-            fcalls['Prey'] = sa
-            print(":: [ac] Prey loss:\t{}\t Prey reward: {}"
-                  "".format(l.item(), mr))
-            avg['mean_prey_loss'].append(l.item())
-            avg['mean_prey_rewards'].append(mr)
-
-            l, mr, sa = ac.finish_episode(model=PredatorModel,
-                                          optimizer=PredatorOptimizer,
-                                          history=env.history.OrientedPredator,
-                                          gamma=cfg['Network']['gamma'],
-                                          return_means=True)
-            fcalls['Predator'] = sa  # sa = selected actions
-
-            print(":: [ac] Predator loss:\t{}\t Predator reward: {}"
-                  "".format(l.item(), mr))
-            avg['mean_pred_loss'].append(l.item())
-            avg['mean_pred_rewards'].append(mr)
-            epsbatch[-1].append(fcalls)  # save the function calls
-            # FIXME: function calls is still broken!! there is no information
-            # about the timesteps! :(
+            if SharedModel is not None:
+                # a single backward pass over the agents of both kins
+                hist = {kin: getattr(env.history, kin)
+                        for kin in SharedModel.kins}
+                means = ac.finish_episode_shared(model=SharedModel,
+                                                 optimizer=PreyOptimizer,
+                                                 histories=hist,
+                                                 gamma=cfg['Network']['gamma'])
+
+            else:
+                means = {kin: ac.finish_episode(model=model,
+                                                optimizer=Optimizer[kin],
+                                                history=getattr(env.history, kin),
+                                                gamma=cfg['Network']['gamma'],
+                                                return_means=True)
+                         for kin, model in Policy.items()}
+
+            record_updates(means)
+
+            replay_updates()
 
             print("\n: [ac] optimization time: "
                   "{}".format(timestamp(return_obj=True) - opt_time_start))
@@ -272,11 +702,17 @@ def main():
         else:
             print("\n: [ac] Not enough history to train...")
 
+        # the episode is done, resuming continues with the next one
+        drop_snapshot()
+
     print("\n: [sim] Entire simulation runtime: "
           "{}".format(timestamp(return_obj=True) - inittime))
 
     # save everything
-    save()
+    save_and_wait()
+
+    if env.pool is not None:
+        env.pool.close()
 # +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
 
 # actual execution of loop:
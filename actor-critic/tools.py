@@ -2,8 +2,9 @@
 import sys
 import datetime as dt
 import numpy as np
+from time import perf_counter
 from typing import Callable, Optional, Iterable
-from collections import ChainMap
+from collections import ChainMap, deque
 
 
 def timestamp(return_obj: bool=False):
@@ -102,6 +103,72 @@ def keyboard_interrupt_handler(*, save: Optional[Callable],
     return wrap
 
 
+class StepProfiler:
+    """Accumulate wall time and call counts for the phases of an env step.
+
+    The profiler works with laps: `start` sets the reference time and every
+    call of `lap(phase)` books the time since the last lap onto `phase`. The
+    environment only calls the profiler if one is set, so there is close to
+    no overhead if profiling is disabled.
+
+    `next_timestep` closes the current timestep, such that the breakdown can
+    be stored per timestep next to the population statistics.
+    """
+
+    # class constants
+    PHASES = ('metabolism', 'starvation', 'instadeath', 'state', 'policy',
+              'action', 'reward')
+
+    __slots__ = ['_phases', '_lookup', '_times', '_calls', '_last', '_history']
+
+    def __init__(self, phases: tuple=None):
+        """Initialise the profiler with the given (or the default) phases."""
+        self._phases = tuple(phases) if phases else self.PHASES
+        self._lookup = {p: i for i, p in enumerate(self._phases)}
+        self._times = [0.0] * len(self._phases)  # lists are faster than arrays
+        self._calls = [0] * len(self._phases)
+        self._history = deque()
+        self._last = perf_counter()
+
+    @property
+    def phases(self) -> tuple:
+        """Return the names of the profiled phases."""
+        return self._phases
+
+    def start(self) -> None:
+        """Set the reference time for the next lap."""
+        self._last = perf_counter()
+
+    def lap(self, phase: str) -> None:
+        """Book the time since the last lap onto `phase`."""
+        now = perf_counter()
+        i = self._lookup[phase]
+        self._times[i] += now - self._last
+        self._calls[i] += 1
+        self._last = now
+
+    def next_timestep(self) -> None:
+        """Store the counters of the current timestep and reset them."""
+        self._history.append((self._times, self._calls))
+        self._times = [0.0] * len(self._phases)
+        self._calls = [0] * len(self._phases)
+
+    def breakdown(self, clear: bool=True) -> tuple:
+        """Return the per-timestep times and calls as (timesteps, phases) arrays."""
+        times = np.array([t for t, _ in self._history], dtype=float)
+        calls = np.array([c for _, c in self._history], dtype=int)
+        if clear:
+            self._history.clear()
+
+        return times.reshape(-1, len(self._phases)), calls.reshape(-1, len(self._phases))
+
+    def summary(self, times: np.ndarray) -> str:
+        """Return a printable summary of the given breakdown of times."""
+        total = times.sum(axis=0)
+        return "\t".join("{}: {:.3f}s".format(p, t) for p, t in
+                         zip(self._phases, total))
+
+
 # for deleting elements not just in the first layer
 class DeepChainMap(ChainMap):
     """Variant of ChainMap that allows direct updates to inner scopes."""
@@ -0,0 +1,219 @@
+"""This file provides a compact on-disk format for the trajectories of the agents.
+
+The history of an episode is written to one directory per episode, which has
+one subdirectory per kin. Each of those holds plain .npy files, so they can be
+memory-mapped with `np.load(..., mmap_mode='r')`:
+    - views, int8 (N, ...) the neighbourhoods of the agents
+    - sides, float16 (N, S) the side information (food reserve, orientation)
+    - actions, uint8 (N,) the numbers of the chosen actions
+    - rewards, int8 (N,) the rewards
+    - offsets, int64 (A + 1,) the steps of agent a are offsets[a]:offsets[a+1]
+    - final_rewards, int16 (A,) the rewards of agent a after its last step
+    - died, bool (A,) whether agent a died without a step of its own, i.e.
+        starved or was killed by instadeath (its penalty is in final_rewards)
+where N is the number of steps of all A agents of that kin in the episode.
+Eaten preys still act in the step they die, their last reward is the penalty
+for being eaten.
+"""
+
+import os
+import shutil
+
+import numpy as np
+from collections import namedtuple
+from typing import Iterator
+
+import torch
+
+# the arrays of a single kin in a single episode
+Trajectories = namedtuple('Trajectories', ('views', 'sides', 'actions',
+                                           'rewards', 'offsets',
+                                           'final_rewards', 'died'))
+
+
+def _to_numpy(x) -> np.ndarray:
+    """Return x as numpy array, x might be a tensor holding a state."""
+    if isinstance(x, torch.Tensor):
+        return x.detach().cpu().numpy()
+
+    return np.asarray(x)
+
+
+def _split_state(state, n_side: int) -> tuple:
+    """Split a state in its neighbourhood and side information.
+
+    The state is either a list [nbh, side] (conv) or a flat array whose last
+    n_side values are the side information (fc).
+    """
+    if isinstance(state, (list, tuple)):
+        view, side = state
+        view = _to_numpy(view)
+        return view.reshape(view.shape[-2:]), _to_numpy(side).ravel()
+
+    state = _to_numpy(state)
+    return state[:-n_side], state[-n_side:]
+
+
+def memories_to_trajectories(memories, n_side: int=2) -> Trajectories:
+    """Convert an iterable of agent memories (States, Rewards, Actions) to arrays.
+
+    Only the steps that have a state, a reward and an action are kept. The
+    rewards of a death without a step of its own (starvation, instadeath)
+    come after the last action and are summed up in final_rewards. This
+    has to be called before `finish_episode`, which reverses the rewards.
+    """
+    views, sides, actions, rewards = [], [], [], []
+    offsets = [0]
+    final_rewards, died = [], []
+    for (states, agent_rewards, saved_actions) in memories:
+        # zip stops at the shortest of the three
+        for state, r, sa in zip(states, agent_rewards, saved_actions):
+            view, side = _split_state(state, n_side)
+            views.append(view)
+            sides.append(side)
+            actions.append(sa.action_nr)
+            rewards.append(r)
+
+        offsets.append(len(rewards))
+        trailing = list(agent_rewards)[min(len(states), len(saved_actions)):]
+        final_rewards.append(sum(trailing))
+        died.append(len(trailing) > 0)
+
+    if views:
+        views = np.stack(views).astype(np.int8)
+        sides = np.stack(sides).astype(np.float16)
+
+    else:
+        views = np.zeros((0,), dtype=np.int8)
+        sides = np.zeros((0, n_side), dtype=np.float16)
+
+    return Trajectories(views=views, sides=sides,
+                        actions=np.array(actions, dtype=np.uint8),
+                        rewards=np.array(rewards, dtype=np.int8),
+                        offsets=np.array(offsets, dtype=np.int64),
+                        final_rewards=np.array(final_rewards, dtype=np.int16),
+                        died=np.array(died, dtype=bool))
+
+
+def _concatenate(parts: list) -> Trajectories:
+    """Concatenate the trajectories of one kin, e.g. of several segments."""
+    steps = [p for p in parts if len(p.actions)]
+    if len(steps) > 1:
+        views = np.concatenate([p.views for p in steps])
+        sides = np.concatenate([p.sides for p in steps])
+
+    else:  # keeps the shape of the empty arrays
+        views, sides = (steps or parts)[0].views, (steps or parts)[0].sides
+
+    offsets = [np.zeros(1, dtype=np.int64)]
+    for p in parts:
+        offsets.append(p.offsets[1:] + offsets[-1][-1])
+
+    return Trajectories(views=views, sides=sides,
+                        actions=np.concatenate([p.actions for p in parts]),
+                        rewards=np.concatenate([p.rewards for p in parts]),
+                        offsets=np.concatenate(offsets),
+                        final_rewards=np.concatenate([p.final_rewards
+                                                      for p in parts]),
+                        died=np.concatenate([p.died for p in parts]))
+
+
+class TrajectoryRecorder:
+    """Write the history of every episode to disk.
+
+    Every episode is written into a temporary directory first, which is then
+    renamed, thus an episode directory is either complete or missing. If the
+    memories are freed during the episode (truncated updates on segments),
+    every segment has to be passed to `add` before; `record` then writes them
+    together with the rest of the episode. The agents that live through a
+    segment border have one trajectory per segment.
+    """
+
+    # slots -------------------------------------------------------------------
+    __slots__ = ['_path', '_n_side', '_segments']
+
+    # init --------------------------------------------------------------------
+    def __init__(self, path: str, n_side: int=2):
+        """Initialise the recorder, path is created if needed."""
+        self._path = path
+        self._n_side = n_side
+        self._segments = {}  # kin -> list of Trajectories of this episode
+        os.makedirs(path, exist_ok=True)
+
+    # properties --------------------------------------------------------------
+    @property
+    def path(self) -> str:
+        """Return the directory of the recorded episodes."""
+        return self._path
+
+    # methods -----------------------------------------------------------------
+    def add(self, *, memories: dict) -> None:
+        """Keep the memories (a dict kin -> iterable of memories) of a segment until `record`."""
+        for kin, mems in memories.items():
+            traj = memories_to_trajectories(mems, n_side=self._n_side)
+            self._segments.setdefault(kin, []).append(traj)
+
+    def record(self, *, episode: int, history: tuple) -> str:
+        """Write the added segments and the given history (a namedtuple of deques of memories) and return the directory."""
+        dirname = os.path.join(self._path, "episode_{:0>6}".format(episode))
+        tmpname = dirname + ".tmp"
+        shutil.rmtree(tmpname, ignore_errors=True)
+
+        segments, self._segments = self._segments, {}
+        for kin, memories in zip(history._fields, history):
+            traj = memories_to_trajectories(memories, n_side=self._n_side)
+            traj = _concatenate(segments.get(kin, []) + [traj])
+            os.makedirs(os.path.join(tmpname, kin))
+            for field, arr in zip(traj._fields, traj):
+                np.save(os.path.join(tmpname, kin, field + ".npy"), arr)
+
+        shutil.rmtree(dirname, ignore_errors=True)  # e.g. a resumed episode
+        os.replace(tmpname, dirname)
+        return dirname
+
+
+class TrajectoryDataset:
+    """Read the episodes written by a TrajectoryRecorder."""
+
+    # slots -------------------------------------------------------------------
+    __slots__ = ['_path']
+
+    # init --------------------------------------------------------------------
+    def __init__(self, path: str):
+        """Initialise the dataset from the given directory."""
+        self._path = path
+
+    # properties --------------------------------------------------------------
+    @property
+    def episodes(self) -> list:
+        """Return the sorted numbers of the recorded episodes."""
+        return sorted(int(d.split("_")[-1]) for d in os.listdir(self._path)
+                      if d.startswith("episode_") and not d.endswith(".tmp"))
+
+    # methods -----------------------------------------------------------------
+    def load(self, *, episode: int, kin: str, mmap: bool=True) -> Trajectories:
+        """Return the trajectories of kin in episode, memory-mapped if wanted."""
+        dirname = os.path.join(self._path, "episode_{:0>6}".format(episode),
+                               kin)
+        mode = 'r' if mmap else None
+        return Trajectories(*[np.load(os.path.join(dirname, f + ".npy"),
+                                      mmap_mode=mode)
+                              for f in Trajectories._fields])
+
+    def agents(self, *, kin: str, mmap: bool=True) -> Iterator[Trajectories]:
+        """Iterate over the trajectories of every single agent of kin in all episodes.
+
+        The yielded offsets are (0, steps) of that agent, final_rewards and
+        died hold its single entry.
+        """
+        for episode in self.episodes:
+            traj = self.load(episode=episode, kin=kin, mmap=mmap)
+            for a, (start, stop) in enumerate(zip(traj.offsets[:-1],
+                                                  traj.offsets[1:])):
+                yield Trajectories(views=traj.views[start:stop],
+                                   sides=traj.sides[start:stop],
+                                   actions=traj.actions[start:stop],
+                                   rewards=traj.rewards[start:stop],
+                                   offsets=np.array([0, stop - start]),
+                                   final_rewards=traj.final_rewards[a:a+1],
+                                   died=traj.died[a:a+1])
@@ -0,0 +1,125 @@
+"""Rules for the classic ABM from policies trained with the actor-critic GridPPM.
+
+The policies see the same states as in the GridPPM: the kinds in the
+neighbourhood (-1 predator, 0 empty, 1 prey) and the food reserve of the
+agent. They are evaluated once per timestep for all agents, in batches and
+without gradients, see `ABM.Grid.step`.
+"""
+
+import os
+import sys
+
+import numpy as np
+import torch
+from torch.distributions import Categorical
+
+# the actor-critic modules aren't a package
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                "actor-critic"))
+import actor_critic as ac  # noqa: E402
+
+
+class PolicyRules:
+    """Choose the actions of the agents of an ABM.Grid with trained policies.
+
+    It has the following attributes:
+        - kind, the kind of the policies, 'fc' or 'conv'
+        - neighbourhood, the number of cells the policies see, e.g. 9
+        - batch_size, the maximal number of states propagated at once
+        - kins, the kins driven by a policy, "B" (prey) and/or "J" (predator)
+
+    The policies are Policy or ConvPolicy networks with the given layers,
+    their weights are loaded from a checkpoint of the actor-critic
+    simulation, i.e. a dict with 'PreyState' and 'PredatorState'. Agents of
+    other kins keep the default rules.
+    """
+
+    # the state dicts of the kins in the checkpoints
+    CHECKPOINT_KEYS = {"B": 'PreyState', "J": 'PredatorState'}
+
+    __slots__ = ['_kind', '_neighbourhood', '_batch_size', '_models']
+
+    def __init__(self, *, checkpoint, layers, kind='fc', neighbourhood=9,
+                 kins=("B", "J"), batch_size=65536):
+        """Load the policies of kins from checkpoint, a filename or a loaded dict."""
+        r = int(np.sqrt(neighbourhood))
+        if r * r != neighbourhood or r % 2 == 0:
+            raise ValueError("neighbourhood must be a square of an odd number, "
+                             "but {} was given.".format(neighbourhood))
+
+        if not isinstance(batch_size, int) or batch_size < 1:
+            raise ValueError("batch_size must be a positive int, but {} was "
+                             "given.".format(batch_size))
+
+        if isinstance(checkpoint, str):
+            checkpoint = torch.load(checkpoint, map_location='cpu')
+
+        self._kind = kind
+        self._neighbourhood = neighbourhood
+        self._batch_size = batch_size
+        self._models = {}
+        Policy = ac.ConvPolicy if kind == 'conv' else ac.Policy
+        for kin in kins:
+            model = Policy(**layers)
+            model.load_state_dict(checkpoint[self.CHECKPOINT_KEYS[kin]])
+            self._models[kin] = model.eval()
+
+    @property
+    def kind(self):
+        """Return the kind of the policies, 'fc' or 'conv'."""
+        return self._kind
+
+    @property
+    def neighbourhood(self):
+        """Return the number of cells the policies see."""
+        return self._neighbourhood
+
+    @property
+    def batch_size(self):
+        """Return the maximal number of states propagated at once."""
+        return self._batch_size
+
+    @property
+    def kins(self):
+        """Return the kins that are driven by a policy."""
+        return tuple(self._models.keys())
+
+    def states(self, kind, fr, index):
+        """
+        Return the neighbourhoods (N, r, r) and food reserves (N, 1) of the agents at index.
+
+        kind is the grid of kinds (-1, 0, 1), fr the grid of food reserves and
+        index a tuple (y, x) of index arrays. The grid is periodic.
+        """
+        r = int(np.sqrt(self._neighbourhood))
+        padded = np.pad(kind, r // 2, mode='wrap')  # index + offset is in padded
+        y, x = index
+        nbh = np.stack([padded[y + j, x + i] for j in range(r) for i in range(r)],
+                       axis=-1)
+        return (nbh.reshape(-1, r, r).astype(np.float32),
+                np.asarray(fr[y, x], dtype=np.float32).reshape(-1, 1))
+
+    def actions(self, kin, kind, fr, index):
+        """
+        Return the sampled actions of the agents of kin at index, see `states`.
+
+        The policy is evaluated without gradients, in batches of at most
+        batch_size states.
+        """
+        model = self._models[kin]
+        nbh, side = self.states(kind, fr, index)
+        out = np.empty(len(nbh), dtype=np.int64)
+        with torch.no_grad():
+            for start in range(0, len(nbh), self._batch_size):
+                views = torch.from_numpy(nbh[start:start + self._batch_size])
+                sides = torch.from_numpy(side[start:start + self._batch_size])
+                n = len(views)
+                if self._kind == 'conv':
+                    probs, _ = model((views.view(n, 1, *views.shape[1:]), sides))
+
+                else:
+                    probs, _ = model(torch.cat([views.view(n, -1), sides], -1))
+
+                out[start:start + n] = Categorical(probs.view(n, -1)).sample().numpy()
+
+        return out
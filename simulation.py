@@ -3,6 +3,7 @@ import numpy as np
 import matplotlib.pyplot as plt
 import yaml
 import datetime as dt
+from functools import partial
 
 
 with open("simconfig.yml", 'r') as ymlfile:
@@ -18,6 +19,8 @@ h = cfg['Grid']['NY']
 rhoprey = cfg['Sim']['RhoPrey']
 rhopred = cfg['Sim']['RhoPred']
 ff = cfg['Sim']['FastForward']
+engine = cfg['Sim'].get('Engine', "default")
+workers = cfg['Sim'].get('Workers', None)  # only for the striped engine, None uses all cores
 
 pFlee = cfg['Prey']['Pflee']
 pBreedPrey = cfg['Prey']['Pbreed']
@@ -34,18 +37,49 @@ figsize = cfg['Plots']['figsize']
 DPI = cfg['Plots']['DPI']
 fmt = cfg['Plots']['format']
 
+# rules, the kins with "NN" are driven by trained actor-critic policies
+nnkins = tuple(k for k, sec in (("B", 'Prey'), ("J", 'Pred'))
+               if cfg[sec].get('Rules', "default") == "NN")
+rules = None
+if(nnkins):
+    if(engine != "default"):
+        raise ValueError("The NN rules are only implemented for the default engine, but {} was "
+                         "given.".format(engine))
+
+    from policyrules import PolicyRules  # needs torch, so only if wanted
+
+    with open(cfg['NN']['Config'], 'r') as ymlfile:
+        accfg = yaml.load(ymlfile)
+    rules = PolicyRules(checkpoint=cfg['NN']['Checkpoint'], layers=accfg['Network']['layers'],
+                        kind=accfg['Network']['kind'],
+                        neighbourhood=accfg['Model'].get('neighbourhood', 9),
+                        kins=nnkins, batch_size=cfg['NN'].get('BatchSize', 65536))
+
 # Grid setup
-grid = abm.Grid(h,                  # height of the grid
-                w,                  # width of the grid
-                rhoprey,            # rhoprey
-                rhopred,            # rhopred
-                FoodReservePrey,    # food reserve prey
-                FoodReservePred,    # fr pred
-                MaxFrPrey,          # max food reserve prey
-                MaxFrPred,          # max fr pred
-                pBreedPrey,         # pBreed prey
-                pBreedPred,         # pBreed pred
-                pFlee)              # pFlee for prey
+if(engine == "event"):
+    GridClass = abm.EventGrid  # event driven, lazy food reserves
+
+elif(engine == "striped"):
+    GridClass = partial(abm.StripedGrid, workers=workers)  # stripes in several processes
+
+elif(engine == "default"):
+    GridClass = partial(abm.Grid, rules=rules)
+
+else:
+    raise ValueError("Engine must be 'default', 'event' or 'striped', but {} was given."
+                     "".format(engine))
+
+grid = GridClass(h,                  # height of the grid
+                 w,                  # width of the grid
+                 rhoprey,            # rhoprey
+                 rhopred,            # rhopred
+                 FoodReservePrey,    # food reserve prey
+                 FoodReservePred,    # fr pred
+                 MaxFrPrey,          # max food reserve prey
+                 MaxFrPred,          # max fr pred
+                 pBreedPrey,         # pBreed prey
+                 pBreedPred,         # pBreed pred
+                 pFlee)              # pFlee for prey
 # actual sim
 cycles = h*w
 
@@ -74,13 +108,17 @@ if(__name__ == '__main__'):
     for _ in range(ts):
         stepcnt += 1
         start = dt.datetime.now()
-        _y, _x = np.where(grid.get_grid() != '')  # indices of agents
-        idc = np.array([_y, _x]).T
-        np.random.shuffle(idc)  # shuffle the indices
-        for idx in idc:
-            j, i = idx
+        if(engine in ("event", "striped") or rules is not None):
+            grid.step()
+
+        else:
+            _y, _x = np.where(grid.get_grid() != '')  # indices of agents
+            idc = np.array([_y, _x]).T
+            np.random.shuffle(idc)  # shuffle the indices
+            for idx in idc:
+                j, i = idx
 
-            grid.TakeAction([j, i], FoodReservePrey, FoodReservePred)
+                grid.TakeAction([j, i], FoodReservePrey, FoodReservePred)
 
         if(grid.get_num_pred() == 0):  # precaution, if predator dies out, the simulation stops
             print(":: Predator died out !")
@@ -97,5 +135,7 @@ if(__name__ == '__main__'):
             plt.close()
             stepcnt = 0  # reset counter
     stoptime = dt.datetime.now()
+    if(engine == "striped"):
+        grid.close()  # stop the workers and free the shared memory
     print(": Simulation stop", stoptime)
     print(": Total Runtime: ", stoptime - inittime)